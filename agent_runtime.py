@@ -0,0 +1,2202 @@
+"""
+Agents SDK side of the service: the agents, the session class, AgentService and the job runner.
+
+Importing the Agents SDK (and the OpenAI types under it) is most of the app's import time, so main.py
+only loads this module through main.warm_imports(): from the startup hook in each worker, or once in
+the gunicorn master with --preload so the workers share it copy-on-write.
+"""
+
+import asyncio
+import copy
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import random
+import time
+import uuid
+import weakref
+import zlib
+from collections import deque
+from contextlib import aclosing, asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, List, Optional, Set, Tuple
+
+import httpx
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncOpenAI,
+    BadRequestError,
+    InternalServerError,
+    NotFoundError,
+    RateLimitError,
+)
+from openai.types.shared.reasoning import Reasoning
+from sqlalchemy import (
+    TIMESTAMP,
+    Column,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    delete,
+    func,
+    insert,
+    select,
+    update,
+)
+from sqlalchemy import text as sql_text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.exc import TimeoutError as SQLAlchemyTimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from agents import Agent, Model, ModelProvider, ModelSettings, OpenAIProvider, RunHooks, Runner, RunConfig, trace
+from agents.extensions.memory.sqlalchemy_session import SQLAlchemySession
+from agents.result import RunResult, RunResultStreaming
+from agents.run import CallModelData, ModelInputData
+
+# Depending on your Agents SDK version, this import can vary:
+try:
+    from agents import TResponseInputItem
+except Exception:
+    from agents.items import TResponseInputItem
+
+from config import (
+    ADVISORY_LOCK_NAMESPACE,
+    ARCHIVE_AFTER_DAYS,
+    CONTEXT_PORTFOLIO_FORMAT,
+    CONVERSATION_STATE,
+    CREATE_SESSION_TABLES,
+    DB_LOCK_POOL_SIZE,
+    DB_POOL_RECYCLE,
+    DB_READY_TIMEOUT,
+    HISTORY_MAX_TURNS,
+    HISTORY_SUMMARY_BATCH,
+    HISTORY_SUMMARY_CACHE_TTL_SECONDS,
+    HISTORY_SUMMARY_MODEL,
+    IDEMPOTENCY_PRUNE_EVERY,
+    IDEMPOTENCY_TTL_SECONDS,
+    JOB_CONCURRENCY,
+    JOB_MAX_ATTEMPTS,
+    JOB_POLL_SECONDS,
+    JOB_STALE_SECONDS,
+    MESSAGE_COMPRESS_MIN_BYTES,
+    MESSAGE_STORAGE,
+    MESSAGES_TABLE,
+    MODEL_PRICES,
+    PHASE_ROUTING,
+    PROFILE_CACHE_SIZE,
+    PROFILE_CACHE_TTL_SECONDS,
+    PROMPT_CACHE_KEY,
+    RESPONSE_CACHE_MAX_TURNS,
+    SEEDED_CACHE_SIZE,
+    SEEDED_CACHE_TTL_SECONDS,
+    SESSION_ARCHIVE,
+    SESSION_ARCHIVE_TABLE,
+    SESSION_DB_URL,
+    SESSION_LOCK,
+    SESSION_LOCK_TIMEOUT,
+    SESSION_WRITE_BATCH_ROWS,
+    SESSION_WRITE_RETRIES,
+    SESSION_WRITES,
+    SESSIONS_TABLE,
+    UPSTREAM_BACKOFF,
+    UPSTREAM_CONNECT_TIMEOUT,
+    UPSTREAM_DEADLINE,
+    UPSTREAM_HTTP2,
+    UPSTREAM_KEEPALIVE_EXPIRY,
+    UPSTREAM_MAX_BACKOFF,
+    UPSTREAM_MAX_CONNECTIONS,
+    UPSTREAM_MAX_KEEPALIVE,
+    UPSTREAM_MAX_RETRIES,
+    json_env,
+)
+from context import (
+    DEFAULT_PRICES,
+    NO_SUMMARY,
+    PHASE_DEFAULTS,
+    HistorySummary,
+    PhaseState,
+    TurnContext,
+    canonical_json,
+    compact_json,
+    estimate_tokens,
+    is_context_item,
+    item_text,
+    render_transcript,
+    split_context,
+    stream_frames,
+    turn_starts,
+)
+from metrics import (
+    FLOW_TURN_COST,
+    FLOW_TURN_SECONDS,
+    HISTORY_ITEMS,
+    JOB_QUEUE_SECONDS,
+    JOB_SECONDS,
+    JOBS_RUNNING,
+    RESPONSE_CACHE_LOOKUPS,
+    UPSTREAM_REJECTED,
+    UPSTREAM_RETRIES,
+    UPSTREAM_SECONDS,
+    WRITE_LAG_SECONDS,
+    WRITE_QUEUE_ROWS,
+    ContextStats,
+    HistoryStats,
+    LiveStats,
+    PhaseStats,
+    WriteStats,
+    engine_kwargs,
+    observe_phase,
+    pool_stats,
+    record_usage,
+    timed_phase,
+    track_request,
+    watch_pool,
+)
+from resilience import CircuitBreaker, RetryBudget, UpstreamTimeout, UpstreamUnavailable
+from stores import (
+    CONTEXT_REF,
+    ChatJob,
+    ChatJobStore,
+    ContextBlobStore,
+    InvestorProfile,
+    ProfileNotFound,
+    ProfileStore,
+    ResponseCache,
+    SessionBusy,
+    SessionStateStore,
+    SQLAlchemyProfileStore,
+    TTLCache,
+    insert_ignore,
+    load_default_profile,
+    pack_text,
+    unpack_text,
+    utcnow,
+)
+
+logger = logging.getLogger("sabbi.agent")
+
+
+# -----------------------------
+# Agent (all behavior in prompt)
+# -----------------------------
+_PORTFOLIO_TABLE = (
+    "portafolio_inversionista vs portafolio_promedio (tabla precalculada): una fila por clase de activo "
+    "(la sangría marca subclases) con columnas `clase | inversionista % | promedio % | Δ pp` "
+    "(% del portafolio total; Δ = inversionista − promedio, en puntos porcentuales), seguida de concentración "
+    "(HHI, N efectivo, top 3, posiciones), peso de club deals, mayores sobre/infraponderaciones y notas "
+    "sobre subtotales que no cuadran"
+)
+_PORTFOLIO_JSON = ("portafolio_inversionista (JSON)", "portafolio_promedio (JSON)")
+
+
+def _inputs_section(portfolio_format: str) -> str:
+    # Describe the portfolio blocks ContextPayload.build actually sends for this CONTEXT_PORTFOLIO_FORMAT
+    if portfolio_format == "json":
+        portfolios = list(_PORTFOLIO_JSON)
+        note = ""
+    elif portfolio_format == "both":
+        portfolios = [_PORTFOLIO_TABLE, *_PORTFOLIO_JSON]
+        note = "La tabla resume los dos JSON; si difieren, manda el JSON.\n"
+    else:
+        portfolios = [_PORTFOLIO_TABLE]
+        note = "Si en lugar de la tabla ves los dos portafolios en JSON, trabaja directamente con ellos.\n"
+    inputs = [
+        *portfolios,
+        "mi_filosofia (texto libre del inversionista)",
+        "club_deals_information (definición y racional)",
+    ]
+    return (
+        "## 📥 INSUMOS DISPONIBLES (YA EN CONTEXTO)\n"
+        + "".join(f"{number}) {text}\n" for number, text in enumerate(inputs, 1))
+        + note
+        + "\n"
+    )
+
+
+filosofia_de_inversion = Agent(
+    name="Filosofía de Inversión — WOW",
+    model="gpt-5.1",
+    model_settings=ModelSettings(
+        store=True,
+        reasoning=Reasoning(effort="high", summary="auto"),
+    ),
+    instructions=(
+        "Eres un experto creando una **FILOSOFÍA DE INVERSIÓN personalizada con efecto “WOW”**.\n"
+        "Tu rol es cuestionar, interpretar y destilar el pensamiento real del inversionista a partir de su portafolio y sus respuestas, "
+        "y luego transformarlo en una filosofía clara, profunda y accionable.\n\n"
+        + _inputs_section(CONTEXT_PORTFOLIO_FORMAT)
+        + "## 🎯 OBJETIVO\n"
+        "Crear una **Filosofía de Inversión WOW**, coherente y justificable, alineada a los insumos, que refleje:\n"
+        "- cómo piensa realmente el inversionista\n"
+        "- su nivel de sofisticación (inferido, no declarado)\n"
+        "- sus convicciones, sesgos y criterios de decisión\n"
+        "- el rol estratégico de cada tipo de activo\n\n"
+        "## 🧠 REGLAS DE INTERACCIÓN (OBLIGATORIAS)\n"
+        "### 1) PREGUNTAS OBLIGATORIAS (POR RONDA)\n"
+        "Antes de generar la filosofía final, debes hacer **exactamente 4 preguntas** en una primera ronda.\n"
+        "- Las preguntas deben **cuestionar directamente el portafolio del inversionista**.\n"
+        "- No puedes generar la filosofía sin haber hecho y recibido respuesta a estas 4 preguntas.\n\n"
+        "### 2) FORMATO DE PREGUNTAS\n"
+        "- Las preguntas se hacen **DE UNA EN UNA**.\n"
+        "- En cada respuesta tuya, entrega **SOLO 1 pregunta y nada más**.\n"
+        "- Prohibido: listas, dobles preguntas, preámbulos, explicaciones, diagnósticos o resúmenes antes de terminar la ronda.\n\n"
+        "### 3) ORDEN Y COBERTURA DE LAS 4 PREGUNTAS\n"
+        "Las 4 preguntas, en conjunto, deben cubrir:\n"
+        "1. **Convicción central**: qué principio guía su asignación actual.\n"
+        "2. **Decisión reveladora**: qué parte del portafolio refleja mayor convicción y cuál le genera duda/tensión.\n"
+        "3. **Diagnóstico de sofisticación** (sin preguntarlo explícitamente): cómo evalúa riesgo, managers, rebalanceos o salidas.\n"
+        "4. **Gestión de tensiones / incoherencias**: si hay contradicciones entre discurso y portafolio, prioriza resolverlas; si no, profundiza disciplina y reglas.\n\n"
+        "### 4) CONTRADICCIONES\n"
+        "- Si detectas contradicciones entre mi_filosofia y portafolio_inversionista, o frente al portafolio_promedio, "
+        "debes priorizarlas en la **siguiente pregunta disponible**.\n"
+        "- No inventes contradicciones.\n\n"
+        "### 5) SOFISTICACIÓN (INFERIDA, NO DECLARADA)\n"
+        "- NO preguntes escalas ni 'qué tan avanzado eres'.\n"
+        "- Debes **inferir** el nivel de sofisticación por la calidad de sus respuestas: claridad, profundidad, trade-offs, "
+        "lenguaje, entendimiento de riesgo/liquidez/ciclos, criterios de manager selection, etc.\n"
+        "- Ajusta el nivel de tecnicismo y profundidad del output final según lo inferido.\n\n"
+        "### 6) GATE PARA CONTINUAR AFINANDO (OBLIGATORIO)\n"
+        "Después de la 4ta pregunta y su respuesta, NO generes aún la filosofía. "
+        "Debes hacer una pregunta de gate (y solo esa pregunta) para decidir si se afina más o se genera:\n"
+        "'¿Quieres que haga 4 preguntas más para afinar tu filosofía de inversión o prefieres que ya la genere?'\n"
+        "Si el usuario responde que quiere seguir afinando (ej. 'continuemos', 'más', 'afinar'), inicias otra ronda de **exactamente 4 preguntas** "
+        "(una por mensaje) siguiendo las mismas reglas.\n"
+        "Si el usuario responde que ya está listo (ej. 'genera', 'listo', 'ya'), entonces generas la filosofía final.\n\n"
+        "## ✨ CUANDO GENERES LA FILOSOFÍA FINAL (WOW)\n"
+        "Entrega la filosofía con esta estructura obligatoria:\n"
+        "## PRINCIPIOS FUNDAMENTALES\n"
+        "## OBJETIVOS DE INVERSIÓN\n"
+        "## ESTRATEGIA / METODOLOGÍA\n"
+        "## GESTIÓN DEL RIESGO\n"
+        "## DISCIPLINA Y SESGOS\n"
+        "## REFLEXIÓN FINAL\n\n"
+        "### 🌟 REQUISITOS WOW\n"
+        "- Debe sentirse **profundamente personalizada**: usa detalles concretos de portafolio_inversionista y mi_filosofia.\n"
+        "- Compara brevemente vs portafolio_promedio y explica qué diferencias son intencionales vs qué ajustes conceptuales se justifican.\n"
+        "- Define y justifica el rol de **Club Deals** usando club_deals_information.\n"
+        "- Incluye **3–5 reglas accionables** (criterio + gatillo + límite + qué monitorear).\n"
+        "- Si hubo contradicciones, explícitalas y muestra cómo se resolvieron o qué supuesto se tomó.\n"
+        "- Mantén un tono sofisticado, claro y narrativo; evita sonar académico o genérico.\n\n"
+        "## 🚫 RESTRICCIONES\n"
+        "- No recomendar productos.\n"
+        "- No sugerir compra/venta.\n"
+        "- No usar jerga innecesaria.\n"
+        "- No mencionar porcentajes en el texto final (puedes razonar internamente con ellos, pero no mostrarlos).\n\n"
+        "## 🟢 FLUJO\n"
+        "1) Haz la pregunta 1 (solo la pregunta).\n"
+        "2) Con la respuesta, haz la pregunta 2 (solo la pregunta).\n"
+        "3) Con la respuesta, haz la pregunta 3 (solo la pregunta).\n"
+        "4) Con la respuesta, haz la pregunta 4 (solo la pregunta).\n"
+        "5) Haz el gate: '¿Quieres que haga 4 preguntas más para afinar tu filosofía de inversión o prefieres que ya la genere?'\n"
+        "6) Si 'afinar' → repite ronda de 4 preguntas y vuelve al gate.\n"
+        "7) Si 'generar' → entrega Filosofía WOW completa.\n"
+    ),
+)
+
+# Folds old turns into a running summary (see HISTORY_MAX_TURNS)
+history_summarizer = Agent(
+    name="Resumen de conversación — WOW",
+    model=HISTORY_SUMMARY_MODEL,
+    model_settings=ModelSettings(
+        store=False,
+        reasoning=Reasoning(effort="low"),
+    ),
+    instructions=(
+        "Resumes una conversación entre un asesor y un inversionista que está construyendo su filosofía de inversión.\n"
+        "Recibes un RESUMEN ANTERIOR (opcional) y NUEVOS TURNOS. Devuelve un único resumen actualizado que los integre.\n"
+        "- Conserva cada pregunta hecha por el asesor y lo esencial de la respuesta del inversionista, en orden.\n"
+        "- Conserva contradicciones detectadas, convicciones, sesgos y señales de sofisticación.\n"
+        "- Indica en qué ronda de preguntas va la conversación, cuántas preguntas lleva la ronda actual "
+        "y qué respondió en cada gate (afinar o generar).\n"
+        "- No inventes nada ni agregues recomendaciones. Texto plano, en español, sin preámbulos.\n"
+    ),
+)
+
+
+# Changes whenever the agent instructions do, so cache keys never mix two different prefixes
+_PROMPT_CACHE_PREFIX = "wow-" + hashlib.sha256(filosofia_de_inversion.instructions.encode("utf-8")).hexdigest()[:8]
+
+
+# -----------------------------
+# Sessions & model hooks
+# -----------------------------
+class WowSession(SQLAlchemySession):
+    """
+    SQLAlchemySession plus an atomic, idempotent seed for new sessions, with per-phase timings,
+    and the compact row format (MESSAGE_STORAGE): context by reference, big payloads compressed.
+    With a `writer`, new items go to the write-behind queue and reads wait for the session's queued rows.
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        *,
+        blobs: Optional[ContextBlobStore] = None,
+        writer: Optional["SessionWriter"] = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(session_id, **kwargs)
+        self._blobs = blobs
+        self._writer = writer
+
+    async def _serialize_item(self, item: TResponseInputItem) -> str:
+        text = await super()._serialize_item(item)
+        if MESSAGE_STORAGE != "compact":
+            return text
+        if self._blobs is not None and is_context_item(item):
+            return CONTEXT_REF + await self._blobs.put(text)
+        return pack_text(text) if len(text) >= MESSAGE_COMPRESS_MIN_BYTES else text
+
+    async def _deserialize_item(self, item: str) -> TResponseInputItem:
+        try:
+            if item.startswith(CONTEXT_REF):
+                text = await self._blobs.get(item[len(CONTEXT_REF) :]) if self._blobs is not None else None
+                if text is None:
+                    raise ValueError(f"missing context blob {item}")
+            else:
+                text = unpack_text(item)
+        except (zlib.error, ValueError) as e:
+            # The SDK skips rows it cannot decode as JSON; do the same for broken compact rows
+            raise json.JSONDecodeError(str(e), item[:32], 0) from e
+        return await super()._deserialize_item(text)
+
+    async def create_indexes(self) -> None:
+        """
+        Indexes for retention, created if missing. On a large existing table, create them by hand first
+        with CREATE INDEX CONCURRENTLY (same names) to avoid blocking writes.
+        get_items is served by the SDK's own idx_<messages>_session_time (session_id, created_at).
+        """
+        sessions = self._sessions
+        # archive.py: idle sessions by last write
+        indexes = [Index(f"idx_{sessions.name}_updated", sessions.c.updated_at)]
+        async with self.engine.begin() as conn:
+            await conn.run_sync(lambda sync_conn: [index.create(sync_conn, checkfirst=True) for index in indexes])
+
+    async def exists(self) -> bool:
+        sessions = self._sessions
+        async with self.engine.connect() as conn:
+            query = select(sessions.c.session_id).where(sessions.c.session_id == self.session_id)
+            row = (await conn.execute(query)).first()
+        return row is not None
+
+    async def get_items(self, limit: Optional[int] = None) -> List[TResponseInputItem]:
+        with timed_phase("history_load"):
+            if self._writer is not None:
+                await self._writer.wait(self.session_id)
+            items = await super().get_items(limit)
+        if limit is None:
+            HISTORY_ITEMS.observe(len(items))
+        return items
+
+    async def add_items(self, items: List[TResponseInputItem]) -> None:
+        with timed_phase("write"):
+            if items and self._writer is not None and self._writer.running:
+                self._writer.add(self.session_id, [await self._serialize_item(item) for item in items])
+            else:
+                await super().add_items(items)
+
+    async def pop_item(self) -> Optional[TResponseInputItem]:
+        if self._writer is not None:
+            await self._writer.wait(self.session_id)
+        return await super().pop_item()
+
+    async def clear_session(self) -> None:
+        if self._writer is not None:
+            await self._writer.wait(self.session_id)
+        await super().clear_session()
+
+    async def seed_if_absent(self, items: List[TResponseInputItem]) -> bool:
+        """
+        Create the session row and write `items` in ONE transaction, only if the row did not exist.
+        Concurrent callers race on the primary key, so exactly one of them seeds.
+        """
+        payload = [{"session_id": self.session_id, "message_data": await self._serialize_item(item)} for item in items]
+
+        async with self.engine.begin() as conn:
+            dialect = conn.dialect.name
+            if dialect in ("postgresql", "sqlite"):
+                insert_ = postgresql.insert if dialect == "postgresql" else sqlite.insert
+                stmt = insert_(self._sessions).values(session_id=self.session_id)
+                created = (await conn.execute(stmt.on_conflict_do_nothing(index_elements=["session_id"]))).rowcount == 1
+            else:
+                try:
+                    async with conn.begin_nested():
+                        await conn.execute(insert(self._sessions).values(session_id=self.session_id))
+                    created = True
+                except IntegrityError:
+                    created = False
+
+            if created and payload:
+                await conn.execute(insert(self._messages), payload)
+
+        return created
+
+
+class LiveSession(WowSession):
+    """
+    The session of one WebSocket connection. History is read from the DB once and then served from
+    memory; new items go to memory at once and to the DB through the write-behind queue (in order).
+    AgentService waits for those writes (flush) before it releases the session lock, and at the start
+    of each turn compares the newest row id with the last one it knows, so a turn written through
+    another channel (HTTP, another worker) drops the cache instead of being missed.
+    The phase state is kept here too; the rest of a turn's state still comes from the usual stores.
+    """
+
+    def __init__(self, session_id: str, *, investor_id: Optional[str], stats: LiveStats, **kwargs: Any) -> None:
+        super().__init__(session_id, **kwargs)
+        self.investor_id = investor_id
+        self.phase_state: Optional[PhaseState] = None
+        self._stats = stats
+        self._items: Optional[List[TResponseInputItem]] = None
+        self._tail: Optional[int] = None  # newest message id of this session, as of our last read or write
+        self._pending: "Optional[asyncio.Future[Optional[int]]]" = None  # our newest queued write
+
+    async def _tail_id(self) -> Optional[int]:
+        messages = self._messages
+        async with self.engine.connect() as conn:
+            query = select(func.max(messages.c.id)).where(messages.c.session_id == self.session_id)
+            return (await conn.execute(query)).scalar()
+
+    def invalidate(self) -> None:
+        self._items = None
+        self.phase_state = None
+
+    async def refresh(self) -> None:
+        """Before a turn, under the session lock: forget the cache if someone else wrote since."""
+        if self._items is None:
+            return
+        await self.flush()
+        if await self._tail_id() != self._tail:
+            self._stats.reloads += 1
+            self.invalidate()
+
+    async def get_items(self, limit: Optional[int] = None) -> List[TResponseInputItem]:
+        if self._items is None:
+            await self.flush()
+            items = await super().get_items()
+            self._tail = await self._tail_id()
+            self._items = items
+            self._stats.loads += 1
+        else:
+            self._stats.memory_reads += 1
+        items = self._items[-limit:] if limit else self._items
+        # Copies: the SDK may mutate what it is given
+        return copy.deepcopy(items)
+
+    async def add_items(self, items: List[TResponseInputItem]) -> None:
+        if not items:
+            return
+        if self._items is not None:
+            self._items.extend(copy.deepcopy(items))
+        await super().add_items(items)
+        self._stats.writes += 1
+        self._pending = self._writer.last(self.session_id) if self._writer is not None else None
+        if self._pending is None:
+            self._tail = await self._tail_id()  # the queue is not running; the write above went straight in
+
+    async def flush(self) -> None:
+        """Wait until every write so far is in the DB, even if the caller is cancelled meanwhile."""
+        future = self._pending
+        if future is None:
+            return
+        try:
+            tail = await _await_through_cancel(future)
+        except asyncio.CancelledError:
+            raise  # the write has settled; the next flush takes its outcome
+        except Exception:
+            self._pending = None
+            self._stats.write_failures += 1
+            self.invalidate()  # memory has items the DB does not
+            raise
+        if self._pending is future:
+            self._pending = None
+        self._tail = tail if tail is not None else await self._tail_id()
+
+    async def pop_item(self) -> Optional[TResponseInputItem]:
+        await self.flush()
+        self.invalidate()
+        return await super().pop_item()
+
+    async def clear_session(self) -> None:
+        await self.flush()
+        self.invalidate()
+        await super().clear_session()
+
+
+class _ModelTimingHooks(RunHooks):
+    """Times each model call of a run (one instance per run)."""
+
+    def __init__(self) -> None:
+        self._started = 0.0
+
+    async def on_llm_start(self, context, agent, system_prompt, input_items) -> None:
+        self._started = time.perf_counter()
+
+    async def on_llm_end(self, context, agent, response) -> None:
+        observe_phase("model", time.perf_counter() - self._started)
+
+
+def _is_expired_state_error(e: Exception) -> bool:
+    # The provider no longer has the response we tried to continue from
+    return isinstance(e, (NotFoundError, BadRequestError)) and "previous" in str(e).lower()
+
+
+# -----------------------------
+# Write-behind session writes
+# -----------------------------
+async def _await_through_cancel(future: "asyncio.Future[Any]") -> Any:
+    """Wait for `future` even if the caller is cancelled meanwhile; its own error wins over the cancellation."""
+    cancelled: Optional[asyncio.CancelledError] = None
+    while not future.done():
+        try:
+            await asyncio.wait({future})
+        except asyncio.CancelledError as e:
+            cancelled = cancelled or e
+    if cancelled is not None and (future.cancelled() or future.exception() is None):
+        raise cancelled
+    return future.result()
+
+
+class _QueuedWrite:
+    __slots__ = ("session_id", "rows", "future", "queued_at")
+
+    def __init__(self, session_id: str, rows: List[str]) -> None:
+        self.session_id = session_id
+        self.rows = rows  # serialized message_data, in order
+        self.future: "asyncio.Future[Optional[int]]" = asyncio.get_running_loop().create_future()
+        self.queued_at = time.perf_counter()
+
+
+class SessionWriter:
+    """
+    The per-worker write-behind queue. add() only queues a write; one task takes everything queued (up to
+    SESSION_WRITE_BATCH_ROWS rows) and writes it in one transaction: missing session rows, one bulk insert of
+    every session's messages, one updated_at touch. A single task in queue order keeps each session's rows in
+    order. Once a write fails, the session's later writes fail too until its turn ends (reset, from the lock
+    release), so a session never has gaps. Each write's future resolves to the newest message id it inserted (None where the driver cannot return ids).
+    """
+
+    def __init__(self, stats: WriteStats) -> None:
+        self.stats = stats
+        self._engine: Optional[AsyncEngine] = None
+        self._messages: Optional[Table] = None
+        self._sessions: Optional[Table] = None
+        self._queue: "Deque[_QueuedWrite]" = deque()
+        self._last: Dict[str, _QueuedWrite] = {}  # newest write per session, until committed or reset
+        self._failed: Dict[str, Exception] = {}  # sessions whose current turn lost a write
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional["asyncio.Task[None]"] = None
+        self._closing = False
+
+    async def startup(self, engine: AsyncEngine, session: WowSession) -> None:
+        self._engine, self._messages, self._sessions = engine, session._messages, session._sessions
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def shutdown(self, timeout: float = 10.0) -> None:
+        """Stop taking writes and drain the queue; whatever is still queued after `timeout` is lost (logged)."""
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        done, _ = await asyncio.wait({self._task}, timeout=timeout)
+        if not done:
+            self._task.cancel()
+            lost = sum(len(write.rows) for write in self._queue)
+            logger.error("write-behind queue not drained on shutdown: %d rows lost", lost)
+        self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._closing
+
+    def add(self, session_id: str, rows: List[str]) -> "asyncio.Future[Optional[int]]":
+        write = _QueuedWrite(session_id, rows)
+        self._last[session_id] = write
+        self.stats.queued += len(rows)
+        WRITE_QUEUE_ROWS.inc(len(rows))
+        error = self._failed.get(session_id)
+        if error is not None:
+            self._fail([write], error)
+        else:
+            self._queue.append(write)
+            self._wakeup.set()
+        return write.future
+
+    def reset(self, session_id: str) -> None:
+        """The session's turn is over: forget a failed write, so the next turn writes again."""
+        if self._failed.pop(session_id, None) is not None:
+            self._last.pop(session_id, None)
+
+    def last(self, session_id: str) -> "Optional[asyncio.Future[Optional[int]]]":
+        """The session's newest write not yet committed (or failed this turn); it settles after every earlier one."""
+        write = self._last.get(session_id)
+        return write.future if write is not None else None
+
+    async def wait(self, session_id: str) -> None:
+        """Read-your-writes: return once the session's queued rows are committed (or given up on)."""
+        future = self.last(session_id)
+        if future is not None and not future.done():
+            self.stats.waits += 1
+            await asyncio.wait({future})
+
+    async def _run(self) -> None:
+        while True:
+            if not self._queue:
+                if self._closing:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            # Group commit: whatever piled up while the previous batch was being written goes in this one
+            batch = [self._queue.popleft()]
+            rows = len(batch[0].rows)
+            while self._queue and rows + len(self._queue[0].rows) <= SESSION_WRITE_BATCH_ROWS:
+                rows += len(self._queue[0].rows)
+                batch.append(self._queue.popleft())
+            await self._write(batch)
+
+    async def _write(self, batch: List[_QueuedWrite]) -> None:
+        for attempt in range(SESSION_WRITE_RETRIES + 1):
+            try:
+                tails = await self._insert(batch)
+            except Exception as e:
+                if attempt == SESSION_WRITE_RETRIES:
+                    error = e
+                    break
+                self.stats.retries += 1
+                logger.warning("write-behind batch failed (%s), retrying", type(e).__name__)
+                await asyncio.sleep(min(2.0, 0.05 * 2**attempt))
+            else:
+                self._resolve(batch, tails)
+                return
+
+        sessions: Dict[str, List[_QueuedWrite]] = {}
+        for write in batch:
+            sessions.setdefault(write.session_id, []).append(write)
+        if len(sessions) == 1:
+            self._fail(batch, error)
+            return
+        # One bad session must not take the others down with it
+        for writes in sessions.values():
+            try:
+                tails = await self._insert(writes)
+            except Exception as e:
+                self._fail(writes, e)
+            else:
+                self._resolve(writes, tails)
+
+    async def _insert(self, batch: List[_QueuedWrite]) -> Dict[str, int]:
+        messages, sessions = self._messages, self._sessions
+        payload = [{"session_id": write.session_id, "message_data": row} for write in batch for row in write.rows]
+        session_ids = sorted({write.session_id for write in batch})  # same lock order in every worker
+        tails: Dict[str, int] = {}
+        async with self._engine.begin() as conn:
+            for session_id in session_ids:
+                await insert_ignore(conn, sessions, {"session_id": session_id}, ["session_id"])
+            if conn.dialect.insert_executemany_returning:
+                result = await conn.execute(insert(messages).returning(messages.c.session_id, messages.c.id), payload)
+                for session_id, message_id in result:
+                    tails[session_id] = max(message_id, tails.get(session_id, message_id))
+            else:
+                await conn.execute(insert(messages), payload)
+            await conn.execute(
+                update(sessions)
+                .where(sessions.c.session_id.in_(session_ids))
+                .values(updated_at=sql_text("CURRENT_TIMESTAMP"))
+            )
+        return tails
+
+    def _resolve(self, batch: List[_QueuedWrite], tails: Dict[str, int]) -> None:
+        now = time.perf_counter()
+        rows = sum(len(write.rows) for write in batch)
+        self.stats.batches += 1
+        self.stats.written += rows
+        self.stats.max_batch = max(self.stats.max_batch, rows)
+        WRITE_QUEUE_ROWS.dec(rows)
+        for write in batch:
+            if self._last.get(write.session_id) is write:
+                del self._last[write.session_id]
+            WRITE_LAG_SECONDS.observe(now - write.queued_at)
+            if not write.future.done():
+                write.future.set_result(tails.get(write.session_id))
+
+    def _fail(self, writes: List[_QueuedWrite], error: Exception) -> None:
+        failed = set(writes)
+        for session_id in {write.session_id for write in writes}:
+            self._failed[session_id] = error
+            failed.update(write for write in self._queue if write.session_id == session_id)
+        self._queue = deque(write for write in self._queue if write not in failed)
+        rows = sum(len(write.rows) for write in failed)
+        WRITE_QUEUE_ROWS.dec(rows)
+        for write in failed:
+            if not write.future.done():
+                write.future.set_exception(error)
+                write.future.exception()  # the lock release reports it; do not warn when nobody waits
+        self.stats.failed += rows
+        logger.error("write-behind gave up on %d rows: %s: %s", rows, type(error).__name__, error)
+
+
+# -----------------------------
+# Upstream model client
+# -----------------------------
+# Seconds allowed per model call; AgentService sets it from the turn's phase around each run
+_UPSTREAM_DEADLINE: ContextVar[float] = ContextVar("upstream_deadline", default=UPSTREAM_DEADLINE)
+
+
+@contextmanager
+def _upstream_deadline(seconds: float) -> Iterator[None]:
+    token = _UPSTREAM_DEADLINE.set(seconds)
+    try:
+        yield
+    finally:
+        _UPSTREAM_DEADLINE.reset(token)
+
+
+def _upstream_error_kind(e: BaseException) -> Optional[str]:
+    """Transient error kind (worth a retry, counts against the breaker), or None for anything else."""
+    if isinstance(e, (asyncio.TimeoutError, APITimeoutError)):
+        return "timeout"
+    if isinstance(e, RateLimitError):
+        return "rate_limit"
+    if isinstance(e, APIConnectionError):
+        return "connection"
+    if isinstance(e, InternalServerError):
+        return "server"
+    return None
+
+
+def _retry_after(e: BaseException) -> Optional[float]:
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(headers[header]) * scale
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+class UpstreamProvider(ModelProvider):
+    """
+    The model provider of a worker. By default one AsyncOpenAI client (one pooled httpx client, HTTP/2
+    when h2 is installed, SDK retries off) serves every call; `inner` swaps in another provider
+    (benchmarks). Either way each model comes wrapped in ResilientModel.
+    """
+
+    def __init__(self, inner: Optional[ModelProvider] = None) -> None:
+        self.inner = inner
+        self.budget = RetryBudget()
+        self.breaker = CircuitBreaker()
+        self.http2 = UPSTREAM_HTTP2 and importlib.util.find_spec("h2") is not None
+        if UPSTREAM_HTTP2 and not self.http2:
+            logger.warning("UPSTREAM_HTTP2 is on but h2 is not installed (pip install 'httpx[http2]'); using HTTP/1.1")
+        self._http_client: Optional[httpx.AsyncClient] = None
+        self._client: Optional[AsyncOpenAI] = None
+        self._providers: Dict[float, ModelProvider] = {}
+
+    def _provider(self, deadline: float) -> ModelProvider:
+        if self.inner is not None:
+            return self.inner
+        provider = self._providers.get(deadline)
+        if provider is None:
+            if self._client is None:
+                # Built on first use, inside the worker: sockets must not be shared across a fork
+                self._http_client = httpx.AsyncClient(
+                    http2=self.http2,
+                    limits=httpx.Limits(
+                        max_connections=UPSTREAM_MAX_CONNECTIONS,
+                        max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+                        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+                    ),
+                    timeout=httpx.Timeout(UPSTREAM_DEADLINE, connect=UPSTREAM_CONNECT_TIMEOUT),
+                )
+                self._client = AsyncOpenAI(http_client=self._http_client, max_retries=0)
+            # Same connection pool; the timeout bounds the wait for each chunk, so it also caps stream stalls
+            client = self._client.with_options(timeout=httpx.Timeout(deadline, connect=UPSTREAM_CONNECT_TIMEOUT))
+            provider = self._providers[deadline] = OpenAIProvider(openai_client=client)
+        return provider
+
+    def get_model(self, model_name: Optional[str]) -> Model:
+        deadline = _UPSTREAM_DEADLINE.get()
+        return ResilientModel(self._provider(deadline).get_model(model_name), self, str(model_name), deadline)
+
+    async def aclose(self) -> None:
+        if self._http_client is not None:
+            await self._http_client.aclose()
+        self._http_client = self._client = None
+        self._providers.clear()
+
+    def admit(self) -> None:
+        wait = self.breaker.allow()
+        if wait is not None:
+            UPSTREAM_REJECTED.labels("breaker_open").inc()
+            raise UpstreamUnavailable("Model API unavailable (circuit open), retry later", retry_after=wait)
+
+    def succeeded(self, model: str, seconds: float) -> None:
+        UPSTREAM_SECONDS.labels(model, "ok").observe(seconds)
+        self.breaker.success()
+
+    def failed(self, model: str, e: Exception, seconds: float, attempt: int, deadline: float, retryable: bool) -> float:
+        """Account a failed attempt; returns the backoff before the next one or raises what the caller should see."""
+        kind = _upstream_error_kind(e)
+        UPSTREAM_SECONDS.labels(model, kind or "error").observe(seconds)
+        if kind is None:
+            self.breaker.success()  # the API answered; the request itself was wrong
+            raise e
+        self.breaker.failure()
+
+        retry_after = _retry_after(e)
+        delay = retry_after
+        if delay is None:
+            delay = random.uniform(0, min(UPSTREAM_MAX_BACKOFF, UPSTREAM_BACKOFF * 2**attempt))
+        if retryable and attempt < UPSTREAM_MAX_RETRIES and time.monotonic() + delay < deadline:
+            if self.budget.withdraw():
+                UPSTREAM_RETRIES.labels(kind).inc()
+                logger.warning("model call failed (%s), retry %d in %.2fs", kind, attempt + 1, delay)
+                return delay
+            UPSTREAM_REJECTED.labels("budget_exhausted").inc()
+
+        if kind == "timeout":
+            raise UpstreamTimeout(f"Model API did not answer in time ({type(e).__name__})") from e
+        raise UpstreamUnavailable(f"Model API error: {type(e).__name__}: {e}", retry_after=retry_after) from e
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "http2": self.http2,
+            "max_connections": UPSTREAM_MAX_CONNECTIONS,
+            "breaker": self.breaker.stats(),
+            "retry_budget": self.budget.stats(),
+        }
+
+
+class ResilientModel(Model):
+    """A model call with a deadline, budgeted retries with full jitter, and the provider's circuit breaker."""
+
+    def __init__(self, inner: Model, upstream: UpstreamProvider, name: str, deadline: float) -> None:
+        self.inner = inner
+        self.upstream = upstream
+        self.name = name
+        self.deadline = deadline
+
+    async def get_response(self, *args: Any, **kwargs: Any) -> Any:
+        deadline = time.monotonic() + self.deadline
+        self.upstream.budget.deposit()
+        attempt = 0
+        while True:
+            self.upstream.admit()
+            started = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(
+                    self.inner.get_response(*args, **kwargs), timeout=max(0.0, deadline - time.monotonic())
+                )
+            except Exception as e:
+                delay = self.upstream.failed(self.name, e, time.perf_counter() - started, attempt, deadline, True)
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self.upstream.succeeded(self.name, time.perf_counter() - started)
+            return response
+
+    async def stream_response(self, *args: Any, **kwargs: Any) -> AsyncIterator[Any]:
+        # The client's per-chunk timeout (see UpstreamProvider._provider) catches a stalled stream; the check
+        # between events catches one that keeps trickling past the deadline (overshoot: at most one chunk wait).
+        # Not wait_for per chunk: each wait would run the SDK's generator in another task, and its tracing
+        # spans are context variables.
+        deadline = time.monotonic() + self.deadline
+        self.upstream.budget.deposit()
+        attempt = 0
+        while True:
+            self.upstream.admit()
+            started = time.perf_counter()
+            streamed = False
+            try:
+                async with aclosing(self.inner.stream_response(*args, **kwargs)) as events:
+                    async for event in events:
+                        if time.monotonic() > deadline:
+                            raise asyncio.TimeoutError(f"stream still running after {self.deadline:g}s")
+                        streamed = True
+                        yield event
+            except Exception as e:
+                # Once events went out, a retry would repeat them downstream
+                retryable = not streamed
+                delay = self.upstream.failed(self.name, e, time.perf_counter() - started, attempt, deadline, retryable)
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self.upstream.succeeded(self.name, time.perf_counter() - started)
+            return
+
+    def get_retry_advice(self, request: Any) -> Any:
+        return self.inner.get_retry_advice(request)
+
+    async def _cleanup_on_run_end(self, owner: object) -> None:
+        await self.inner._cleanup_on_run_end(owner)
+
+    async def close(self) -> None:
+        await self.inner.close()
+
+
+# -----------------------------
+# Retention & archive
+# -----------------------------
+class SessionArchive:
+    """
+    Idle sessions moved out of the hot tables, one row each: the message rows exactly as stored (so the
+    context stays a reference) plus the session's state rows, zlib-packed together.
+    archive.py moves them out periodically; `restore` puts a session back as it was.
+    """
+
+    def __init__(self, table_name: str = SESSION_ARCHIVE_TABLE) -> None:
+        self._engine: Optional[AsyncEngine] = None
+        self._metadata = MetaData()
+        self._table = Table(
+            table_name,
+            self._metadata,
+            Column("session_id", String, primary_key=True),
+            Column("data", Text, nullable=False),
+            Column("item_count", Integer, nullable=False),
+            Column("created_at", TIMESTAMP(timezone=False), nullable=False),
+            Column("updated_at", TIMESTAMP(timezone=False), nullable=False),
+            Column("archived_at", TIMESTAMP(timezone=False), nullable=False),
+        )
+        self._sessions: Optional[Table] = None
+        self._messages: Optional[Table] = None
+        self._state: Optional[Table] = None
+
+    async def startup(self, engine: AsyncEngine, session: WowSession, state: Table) -> None:
+        self._engine = engine
+        self._sessions, self._messages, self._state = session._sessions, session._messages, state
+        if CREATE_SESSION_TABLES:
+            async with engine.begin() as conn:
+                await conn.run_sync(self._metadata.create_all)
+
+    async def candidates(self, cutoff: datetime, finished_only: bool, limit: int) -> List[str]:
+        """
+        Sessions last written before `cutoff` (naive UTC), oldest first. updated_at comes from the DB's
+        CURRENT_TIMESTAMP, so a DB on local time shifts this by its UTC offset; irrelevant at days of idleness.
+        """
+        sessions, state = self._sessions, self._state
+        query = (
+            select(sessions.c.session_id)
+            .where(sessions.c.updated_at < cutoff)
+            .order_by(sessions.c.updated_at)
+            .limit(limit)
+        )
+        if finished_only:
+            done = select(state.c.session_id).where(state.c.key == "phase", state.c.value.like('%"stage":"done"%'))
+            query = query.where(sessions.c.session_id.in_(done))
+        async with self._engine.connect() as conn:
+            return [row.session_id for row in (await conn.execute(query)).all()]
+
+    async def archive(self, session_id: str, cutoff: datetime) -> bool:
+        """Move one session out in a single transaction; False if it was written to since `cutoff`."""
+        sessions, messages, state = self._sessions, self._messages, self._state
+        async with self._engine.begin() as conn:
+            session = (
+                await conn.execute(
+                    select(sessions).where(sessions.c.session_id == session_id, sessions.c.updated_at < cutoff)
+                )
+            ).first()
+            if session is None:
+                return False
+            rows = (
+                await conn.execute(
+                    select(messages.c.message_data, messages.c.created_at)
+                    .where(messages.c.session_id == session_id)
+                    .order_by(messages.c.created_at, messages.c.id)
+                )
+            ).all()
+            values = (await conn.execute(select(state.c.key, state.c.value).where(state.c.session_id == session_id))).all()
+            data = {
+                "items": [[row.created_at.isoformat(), row.message_data] for row in rows],
+                "state": {row.key: row.value for row in values},
+            }
+
+            # Conditional delete = the claim: a turn that wrote in between moved updated_at past the cutoff
+            claimed = await conn.execute(
+                delete(sessions).where(sessions.c.session_id == session_id, sessions.c.updated_at < cutoff)
+            )
+            if claimed.rowcount != 1:
+                return False
+            await conn.execute(delete(messages).where(messages.c.session_id == session_id))
+            await conn.execute(delete(state).where(state.c.session_id == session_id))
+            await conn.execute(
+                insert(self._table).values(
+                    session_id=session_id,
+                    data=pack_text(compact_json(data)),
+                    item_count=len(rows),
+                    created_at=session.created_at,
+                    updated_at=session.updated_at,
+                    archived_at=utcnow(),
+                )
+            )
+        return True
+
+    async def restore(self, session_id: str) -> bool:
+        """Move an archived session back; False if it is not archived or a live session took its id."""
+        sessions, messages, state = self._sessions, self._messages, self._state
+        async with self._engine.begin() as conn:
+            row = (await conn.execute(select(self._table).where(self._table.c.session_id == session_id))).first()
+            if row is None:
+                return False
+            if not await insert_ignore(
+                conn, sessions, {"session_id": session_id, "created_at": row.created_at}, ["session_id"]
+            ):
+                return False
+
+            data = json.loads(unpack_text(row.data))
+            if data["items"]:
+                await conn.execute(
+                    insert(messages),
+                    [
+                        {"session_id": session_id, "message_data": message_data, "created_at": datetime.fromisoformat(at)}
+                        for at, message_data in data["items"]
+                    ],
+                )
+            for key, value in data["state"].items():
+                await conn.execute(insert(state).values(session_id=session_id, key=key, value=value))
+            await conn.execute(delete(self._table).where(self._table.c.session_id == session_id))
+        return True
+
+
+# -----------------------------
+# Phase routing
+# -----------------------------
+class PhaseRouter:
+    """
+    Picks the agent variant (model + reasoning effort) for each phase from PHASE_ROUTING and accounts
+    latency and cost per phase. Phases are tracked even with routing off, so both setups can be compared.
+    """
+
+    def __init__(self, base: Agent, routes: Optional[Dict[str, Dict[str, str]]] = None) -> None:
+        self.base = base
+        self.enabled = PHASE_ROUTING.lower() != "off"
+        self.routes = routes if routes is not None else json_env(PHASE_ROUTING if self.enabled else "", PHASE_DEFAULTS)
+        self.prices = json_env(MODEL_PRICES, DEFAULT_PRICES)
+        self._agents: Dict[str, Agent] = {}
+        self._stats: Dict[str, PhaseStats] = {}
+
+    def agent(self, phase: str) -> Agent:
+        if not self.enabled:
+            return self.base
+        agent = self._agents.get(phase)
+        if agent is None:
+            route = self.routes.get(phase, {})
+            settings = self.base.model_settings
+            if "effort" in route:
+                summary = settings.reasoning.summary if settings.reasoning else None
+                settings = settings.resolve(ModelSettings(reasoning=Reasoning(effort=route["effort"], summary=summary)))
+            agent = self._agents[phase] = self.base.clone(
+                model=route.get("model", self.base.model), model_settings=settings
+            )
+        return agent
+
+    def fingerprint(self, phase: str) -> str:
+        """Hash of everything in the phase's agent that shapes a reply (model, instructions, settings)."""
+        agent = self.agent(phase)
+        config = {
+            "model": str(agent.model),
+            "instructions": agent.instructions,
+            "settings": agent.model_settings.to_json_dict(),
+        }
+        return hashlib.sha256(canonical_json(config).encode("utf-8")).hexdigest()
+
+    def deadline(self, phase: str) -> float:
+        return float(self.routes.get(phase, {}).get("deadline", UPSTREAM_DEADLINE))
+
+    def cost(self, model: str, input_tokens: int, cached_tokens: int, output_tokens: int) -> float:
+        price = self.prices.get(model)
+        if not price:
+            return 0.0
+        uncached = max(0, input_tokens - cached_tokens)
+        return (
+            uncached * price.get("input", 0.0)
+            + cached_tokens * price.get("cached_input", price.get("input", 0.0))
+            + output_tokens * price.get("output", 0.0)
+        ) / 1_000_000
+
+    def record(self, session_id: str, phase: str, result: RunResult, seconds: float) -> None:
+        agent = self.agent(phase)
+        model = str(agent.model)
+        usage = result.context_wrapper.usage
+        cached = getattr(usage.input_tokens_details, "cached_tokens", 0) or 0
+        cost = self.cost(model, usage.input_tokens, cached, usage.output_tokens)
+
+        FLOW_TURN_SECONDS.labels(phase, model).observe(seconds)
+        FLOW_TURN_COST.labels(phase, model).inc(cost)
+
+        stats = self._stats.setdefault(phase, PhaseStats())
+        stats.turns += 1
+        stats.seconds += seconds
+        stats.input_tokens += usage.input_tokens
+        stats.cached_tokens += cached
+        stats.output_tokens += usage.output_tokens
+        stats.cost_usd += cost
+        logger.info(
+            "turn session=%s phase=%s model=%s effort=%s seconds=%.2f input=%d cached=%d output=%d cost_usd=%.5f",
+            session_id,
+            phase,
+            model,
+            agent.model_settings.reasoning.effort if agent.model_settings.reasoning else None,
+            seconds,
+            usage.input_tokens,
+            cached,
+            usage.output_tokens,
+            cost,
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        input_tokens = sum(s.input_tokens for s in self._stats.values())
+        cached_tokens = sum(s.cached_tokens for s in self._stats.values())
+        return {
+            "enabled": self.enabled,
+            "phases": {phase: s.as_dict() for phase, s in self._stats.items()},
+            "prompt_cache": {
+                "key_mode": PROMPT_CACHE_KEY,
+                "input_tokens": input_tokens,
+                "cached_tokens": cached_tokens,
+                "hit_ratio": round(cached_tokens / input_tokens, 3) if input_tokens else 0.0,
+            },
+        }
+
+
+# -----------------------------
+# Service
+# -----------------------------
+def _abandon_acquire(acquire: "asyncio.Future[bool]", lock: asyncio.Lock) -> None:
+    """Give up on a lock.acquire() task; if it got (or still gets) the lock, hand it straight back."""
+
+    def release(task: "asyncio.Future[bool]") -> None:
+        if not task.cancelled() and task.exception() is None:
+            lock.release()
+
+    acquire.cancel()
+    acquire.add_done_callback(release)
+
+
+class AgentService:
+    """
+    Owns:
+    - one SQLAlchemy engine (shared)
+    - session creation per request (by session_id)
+    - seeding the initial context ONCE per session (from the investor's profile)
+    - a per-worker cache of rendered investor profiles
+    """
+
+    def __init__(
+        self, profile_store: Optional[ProfileStore] = None, session_state: Optional[SessionStateStore] = None
+    ) -> None:
+        self._bootstrap: Optional[SQLAlchemySession] = None
+        self._engine = None
+
+        # Every model call goes through here (shared client, deadlines, retries, breaker)
+        self.upstream = UpstreamProvider()
+
+        self.profile_store = profile_store or SQLAlchemyProfileStore()
+        self._profiles: TTLCache[str, InvestorProfile] = TTLCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL_SECONDS)
+        # session_id -> prompt cache key of its seeded context
+        self._seeded: TTLCache[str, str] = TTLCache(SEEDED_CACHE_SIZE, SEEDED_CACHE_TTL_SECONDS)
+        self.context_stats = ContextStats()
+
+        self.session_state = session_state or SessionStateStore()
+        self.context_blobs = ContextBlobStore()
+        self.archive = SessionArchive()
+        self._summaries: TTLCache[str, HistorySummary] = TTLCache(SEEDED_CACHE_SIZE, HISTORY_SUMMARY_CACHE_TTL_SECONDS)
+        self._compacting: Set[str] = set()
+        self._background: Set["asyncio.Task[None]"] = set()
+        self._results_stored = 0
+        self.history_stats = HistoryStats()
+        self.live_stats = LiveStats()
+        self.write_stats = WriteStats()
+        self.writer = SessionWriter(self.write_stats)
+        self.router = PhaseRouter(filosofia_de_inversion)
+        self.response_cache = ResponseCache()
+
+        # Per-session serialization and in-flight coalescing (see SESSION_LOCK)
+        self._lock_engine: Optional[AsyncEngine] = None
+        self._local_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        self._inflight: Dict[Tuple[str, str], "asyncio.Future[str]"] = {}
+        # session_id -> state rows this turn changed, with their previous values (see _settle_writes)
+        self._undo: Dict[str, Dict[str, Optional[str]]] = {}
+
+    async def startup(self) -> None:
+        # Create a single engine for the whole process
+        self._engine = create_async_engine(SESSION_DB_URL, **engine_kwargs(SESSION_DB_URL))
+        watch_pool(self._engine)
+        self._bootstrap = SQLAlchemySession(
+            "bootstrap",
+            engine=self._engine,
+            create_tables=CREATE_SESSION_TABLES,
+            sessions_table=SESSIONS_TABLE,
+            messages_table=MESSAGES_TABLE,
+        )
+
+        # Force table creation if enabled
+        if CREATE_SESSION_TABLES:
+            await self._bootstrap.get_items(limit=1)
+
+        await self.profile_store.startup(self._engine)
+        await self.session_state.startup(self._engine)
+        await self.context_blobs.startup(self._engine)
+        tables = self._make_session("bootstrap")
+        if CREATE_SESSION_TABLES:
+            await tables.create_indexes()
+        await self.archive.startup(self._engine, tables, self.session_state.table)
+        await self.writer.startup(self._engine, tables)
+        await self.response_cache.startup(self._engine)
+
+        if SESSION_LOCK == "auto" and self._engine.dialect.name == "postgresql":
+            # A full lock pool means as many turns in flight as it has connections: wait no longer than for the lock
+            self._lock_engine = create_async_engine(
+                SESSION_DB_URL,
+                pool_size=DB_LOCK_POOL_SIZE,
+                max_overflow=0,
+                pool_timeout=SESSION_LOCK_TIMEOUT,
+                pool_recycle=DB_POOL_RECYCLE,
+            )
+
+    async def shutdown(self, timeout: float = 10.0) -> None:
+        # Let in-flight background work (turns, history compaction) finish, drain queued writes, then close
+        # pooled connections
+        if self._background:
+            await asyncio.wait(list(self._background), timeout=timeout)
+        await self.writer.shutdown(timeout)
+        if self._engine is not None:
+            await self._engine.dispose()
+            self._engine = None
+        if self._lock_engine is not None:
+            await self._lock_engine.dispose()
+            self._lock_engine = None
+        await self.upstream.aclose()
+
+    async def ready(self) -> Dict[str, Any]:
+        """DB readiness: one `SELECT 1` through the pool, bounded by DB_READY_TIMEOUT."""
+        if self._engine is None:
+            raise RuntimeError("engine not started")
+
+        async def ping() -> None:
+            async with self._engine.connect() as conn:
+                await conn.execute(sql_text("SELECT 1"))
+
+        started = time.perf_counter()
+        await asyncio.wait_for(ping(), timeout=DB_READY_TIMEOUT)
+        return {
+            "db": "ok",
+            "db_latency_ms": round((time.perf_counter() - started) * 1000, 1),
+            "pool": pool_stats(self._engine),
+        }
+
+    @property
+    def model_provider(self) -> Optional[ModelProvider]:
+        """None = the shared OpenAI client; benchmarks swap in a local fake (still behind the resilience layer)."""
+        return self.upstream.inner
+
+    @model_provider.setter
+    def model_provider(self, provider: Optional[ModelProvider]) -> None:
+        self.upstream.inner = provider
+
+    @property
+    def engine(self) -> AsyncEngine:
+        if self._engine is None:
+            raise RuntimeError("AgentService not initialized (engine missing). Did startup run?")
+        return self._engine
+
+    def _make_session(self, session_id: str) -> WowSession:
+        if self._engine is None:
+            raise RuntimeError("AgentService not initialized (engine missing). Did startup run?")
+        return WowSession(
+            session_id=session_id,
+            engine=self._engine,
+            create_tables=False,
+            sessions_table=SESSIONS_TABLE,
+            messages_table=MESSAGES_TABLE,
+            blobs=self.context_blobs,
+            writer=self.writer if SESSION_WRITES == "behind" else None,
+            ensure_ascii=MESSAGE_STORAGE != "compact",  # raw UTF-8 is about half the size for Spanish text
+        )
+
+    def open_live(self, session_id: str, investor_id: Optional[str] = None) -> LiveSession:
+        """The session of a WebSocket connection (no I/O until its first turn); pass it to chat_stream."""
+        if self._engine is None:
+            raise RuntimeError("AgentService not initialized (engine missing). Did startup run?")
+        self.live_stats.open += 1
+        return LiveSession(
+            session_id=session_id,
+            investor_id=investor_id,
+            stats=self.live_stats,
+            engine=self._engine,
+            create_tables=False,
+            sessions_table=SESSIONS_TABLE,
+            messages_table=MESSAGES_TABLE,
+            blobs=self.context_blobs,
+            writer=self.writer,
+            ensure_ascii=MESSAGE_STORAGE != "compact",
+        )
+
+    async def close_live(self, live: LiveSession) -> None:
+        self.live_stats.open -= 1
+        try:
+            await live.flush()
+        except Exception:
+            logger.exception("pending writes failed on close session=%s", live.session_id)
+
+    async def get_profile(self, investor_id: Optional[str]) -> InvestorProfile:
+        key = investor_id or ""
+        profile = self._profiles.get(key)
+        if profile is not None:
+            return profile
+
+        if investor_id:
+            custom_input = await self.profile_store.get(investor_id)
+            if custom_input is None:
+                raise ProfileNotFound(f"Unknown investor_id: {investor_id}")
+        else:
+            custom_input = load_default_profile()
+
+        profile = InvestorProfile.build(investor_id or "default", custom_input)
+        self._profiles.put(key, profile)
+        self.context_stats.payload_builds += 1
+        return profile
+
+    async def upsert_profile(self, investor_id: str, custom_input: Dict[str, Any]) -> InvestorProfile:
+        profile = InvestorProfile.build(investor_id, custom_input)
+        await self.profile_store.upsert(investor_id, custom_input, profile.payload.content_hash)
+        self.context_stats.payload_builds += 1
+        # Other workers pick the new version up when their entry expires
+        self._profiles.put(investor_id, profile)
+        return profile
+
+    async def session_exists(self, session_id: str) -> bool:
+        return await self._make_session(session_id).exists()
+
+    async def create_session(self, session_id: str, investor_id: Optional[str] = None) -> bool:
+        """Seed a new session with the investor context. Idempotent: returns False if it already existed."""
+        created, _ = await self._seed(session_id, investor_id)
+        return created
+
+    async def _seed(self, session_id: str, investor_id: Optional[str]) -> Tuple[bool, str]:
+        session = self._make_session(session_id)
+        if SESSION_ARCHIVE and await self.archive.restore(session_id):
+            logger.info("restored archived session=%s", session_id)
+        # An existing session keeps the context it was seeded with: its investor_id is not looked up (nor required
+        # to exist any more). The profile is only loaded to create one.
+        created = False
+        if not await session.exists():
+            payload = (await self.get_profile(investor_id)).payload
+            created = await session.seed_if_absent(payload.items())
+
+        if created:
+            cache_key = f"{_PROMPT_CACHE_PREFIX}-{payload.content_hash[:16]}"
+            await self.session_state.set(session_id, "prompt_cache_key", cache_key)
+        else:
+            # The stored context may come from another profile than this request's; older sessions only share the instructions
+            cache_key = await self.session_state.get(session_id, "prompt_cache_key") or _PROMPT_CACHE_PREFIX
+        self._seeded.put(session_id, cache_key)
+
+        if created:
+            self.context_stats.seeded_sessions += 1
+            self.context_stats.bytes_saved += payload.bytes_saved
+            self.context_stats.tokens_saved += payload.tokens_saved
+            logger.info(
+                "seeded session=%s context=%s saved_bytes=%d saved_tokens~%d",
+                session_id,
+                payload.content_hash[:12],
+                payload.bytes_saved,
+                payload.tokens_saved,
+            )
+        return created, cache_key
+
+    async def _ensure_seeded(self, session_id: str, investor_id: Optional[str]) -> str:
+        # Hot path: no DB round trip once this worker has seen the session
+        cache_key = self._seeded.get(session_id)
+        if cache_key is None:
+            with timed_phase("seed"):
+                _, cache_key = await self._seed(session_id, investor_id)
+        return cache_key
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "context": self.context_stats.as_dict(),
+            "profile_cache": self._profiles.stats(),
+            "seeded_cache": self._seeded.stats(),
+            "context_blobs": self.context_blobs.stats(),
+            "history": self.history_stats.as_dict(),
+            "live_sessions": self.live_stats.as_dict(),
+            "writes": self.write_stats.as_dict(),
+            "phases": self.router.stats(),
+            "upstream": self.upstream.stats(),
+            "response_cache": self.response_cache.stats() if self.response_cache.enabled else None,
+            "db_pool": pool_stats(self._engine) if self._engine is not None else None,
+        }
+
+    def _run_config(self, windowed: bool = False, cache_key: Optional[str] = None) -> RunConfig:
+        config = RunConfig(
+            trace_metadata={
+                "__trace_source__": "fastapi-service",
+                "workflow_id": "wf_693a02d72190819097a8a7b5234510f70851015287e3b178",
+            },
+            # Also applied with the window off: it keeps the seeded context right after the instructions
+            call_model_input_filter=self._window_history if windowed else None,
+        )
+        if cache_key and PROMPT_CACHE_KEY == "investor":
+            # An explicit key also stops the SDK from generating its per-session one
+            config.model_settings = ModelSettings(extra_args={"prompt_cache_key": cache_key})
+        config.model_provider = self.upstream
+        return config
+
+    # ---- history window ----
+    async def _load_summary(self, session_id: str) -> HistorySummary:
+        summary = self._summaries.get(session_id)
+        if summary is None:
+            raw = await self.session_state.get(session_id, "history_summary")
+            summary = HistorySummary(**json.loads(raw)) if raw else NO_SUMMARY
+            self._summaries.put(session_id, summary)
+        return summary
+
+    async def _turn_context(self, session_id: str, message: str, live: Optional[LiveSession] = None) -> TurnContext:
+        turn = TurnContext(session_id=session_id)
+        if HISTORY_MAX_TURNS > 0:
+            turn.summary = await self._load_summary(session_id)
+        if live is not None and live.phase_state is not None:
+            turn.phase_state = live.phase_state  # advanced in place, so it stays current
+        else:
+            turn.phase_state = PhaseState.loads(await self.session_state.get(session_id, "phase"))
+            if live is not None:
+                live.phase_state = turn.phase_state
+        turn.phase = turn.phase_state.next_phase(message)
+        self._remember_state(session_id, "phase", turn.phase_state.dumps())
+        return turn
+
+    async def _advance_phase(self, turn: TurnContext, result: RunResult, seconds: float) -> None:
+        self.router.record(turn.session_id, turn.phase, result, seconds)
+        turn.phase_state.advance(turn.phase)
+        await self.session_state.set(turn.session_id, "phase", turn.phase_state.dumps())
+
+    def _window_history(self, data: CallModelData[Any]) -> ModelInputData:
+        """
+        Model input = seeded context + running summary + items the summary does not cover yet.
+        Only what is sent to the model changes; the session keeps the full transcript.
+        """
+        turn = data.context
+        if not isinstance(turn, TurnContext):
+            return data.model_data
+
+        head, rest = split_context(data.model_data.input)
+        summary = turn.summary
+        if not summary.text or summary.covered > len(rest):
+            turn.verbatim_turns = len(turn_starts(rest))
+            return ModelInputData(input=head + rest, instructions=data.model_data.instructions)
+
+        folded, kept = rest[: summary.covered], rest[summary.covered :]
+        summary_text = "RESUMEN — conversación anterior:\n" + summary.text
+        summary_item: TResponseInputItem = {"role": "user", "content": [{"type": "input_text", "text": summary_text}]}
+
+        turn.verbatim_turns = len(turn_starts(kept))
+        turn.tokens_saved = max(
+            0, sum(estimate_tokens(compact_json(item)) for item in folded) - estimate_tokens(summary_text)
+        )
+        return ModelInputData(input=head + [summary_item] + kept, instructions=data.model_data.instructions)
+
+    def _after_turn(self, turn: TurnContext) -> None:
+        self.history_stats.turns += 1
+        if turn.tokens_saved:
+            self.history_stats.windowed_turns += 1
+            self.history_stats.input_tokens_saved += turn.tokens_saved
+            logger.info("history window session=%s input_tokens_saved~%d", turn.session_id, turn.tokens_saved)
+
+        if (
+            HISTORY_MAX_TURNS > 0
+            and turn.verbatim_turns > HISTORY_MAX_TURNS + HISTORY_SUMMARY_BATCH
+            and turn.session_id not in self._compacting
+        ):
+            # Off the request path: the next turns use the new summary once it lands
+            self._compacting.add(turn.session_id)
+            task = asyncio.create_task(self._compact_history(turn.session_id))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+
+    async def _compact_history(self, session_id: str) -> None:
+        try:
+            session = self._make_session(session_id)
+            _, rest = split_context(await session.get_items())
+            summary = await self._load_summary(session_id)
+
+            starts = [i for i in turn_starts(rest) if i >= summary.covered]
+            if len(starts) <= HISTORY_MAX_TURNS:
+                return
+            fold_end = starts[-HISTORY_MAX_TURNS]
+
+            prompt = "NUEVOS TURNOS:\n" + render_transcript(rest[summary.covered : fold_end])
+            if summary.text:
+                prompt = "RESUMEN ANTERIOR:\n" + summary.text + "\n\n" + prompt
+            result = await Runner.run(history_summarizer, prompt, run_config=self._run_config())
+
+            new_summary = HistorySummary(text=result.final_output_as(str), covered=fold_end)
+            await self.session_state.set(
+                session_id, "history_summary", compact_json({"text": new_summary.text, "covered": new_summary.covered})
+            )
+            self._summaries.put(session_id, new_summary)
+            self.history_stats.compactions += 1
+        except Exception:
+            self.history_stats.compaction_failures += 1
+            logger.exception("history compaction failed session=%s", session_id)
+        finally:
+            self._compacting.discard(session_id)
+
+    # ---- server-side conversation state ----
+    async def _previous_response_id(self, session_id: str) -> Optional[str]:
+        # Always read from the DB: a stale id from another worker would silently drop turns
+        if CONVERSATION_STATE != "server":
+            return None
+        previous_id = await self.session_state.get(session_id, "last_response_id")
+        self._remember_state(session_id, "last_response_id", previous_id)
+        return previous_id
+
+    async def _remember_response_id(self, session_id: str, response_id: Optional[str]) -> None:
+        if CONVERSATION_STATE == "server" and response_id:
+            await self.session_state.set(session_id, "last_response_id", response_id)
+
+    async def _run(self, session: WowSession, message: str, turn: TurnContext) -> RunResult:
+        previous_id = await self._previous_response_id(session.session_id)
+        if previous_id:
+            try:
+                result = await Runner.run(
+                    self.router.agent(turn.phase),
+                    message,
+                    context=turn,
+                    previous_response_id=previous_id,  # only the new message goes upstream
+                    hooks=_ModelTimingHooks(),
+                    run_config=self._run_config(cache_key=turn.cache_key),
+                )
+            except (NotFoundError, BadRequestError) as e:
+                if not _is_expired_state_error(e):
+                    raise
+                self.history_stats.server_state_fallbacks += 1
+                logger.warning("server-side state expired session=%s, replaying history", session.session_id)
+            else:
+                await session.add_items(result.to_input_list())  # audit copy of the turn
+                await self._remember_response_id(session.session_id, result.last_response_id)
+                self.history_stats.server_state_turns += 1
+                return result
+
+        result = await Runner.run(
+            self.router.agent(turn.phase),
+            message,  # ✅ string input (NOT a list)
+            context=turn,
+            session=session,  # ✅ session memory enabled
+            hooks=_ModelTimingHooks(),
+            run_config=self._run_config(windowed=True, cache_key=turn.cache_key),
+        )
+        await self._remember_response_id(session.session_id, result.last_response_id)
+        return result
+
+    # ---- response cache ----
+    async def _response_key(
+        self, session: WowSession, turn: TurnContext, message: str, bypass_cache: bool
+    ) -> Optional[str]:
+        """Cache key for this turn, or None when the reply must come from the model."""
+        if not self.response_cache.enabled:
+            return None
+        if bypass_cache:
+            RESPONSE_CACHE_LOOKUPS.labels("bypass").inc()
+            return None
+        state = turn.phase_state
+        if state.round != 1 or state.stage != "questions" or state.asked >= RESPONSE_CACHE_MAX_TURNS:
+            return None
+
+        head, rest = split_context(await session.get_items())
+        dialogue = [
+            [item["role"], item_text(item)]
+            for item in rest
+            if isinstance(item, dict) and item.get("role") in ("user", "assistant")
+        ]
+        if not head or sum(1 for role, _ in dialogue if role == "user") != state.asked:
+            return None  # history the phase state does not account for (e.g. a session from before phases)
+        return ResponseCache.key(self.router.fingerprint(turn.phase), head[0], dialogue, message)
+
+    async def _cache_response(self, key: Optional[str], result: RunResult) -> None:
+        if not key:
+            return
+        # Only the reply itself: reasoning items belong to the response that produced them
+        items = []
+        for item in result.new_items:
+            if item.type == "message_output_item":
+                raw = dict(item.to_input_item())
+                raw.pop("id", None)
+                items.append(raw)
+        await self.response_cache.put(key, {"output_text": result.final_output_as(str), "items": items})
+
+    async def _replay_cached(self, session: WowSession, turn: TurnContext, message: str, cached: Dict[str, Any]) -> str:
+        """Persist a cached reply as this session's turn, exactly as a model call would have."""
+        await session.add_items([{"role": "user", "content": message}, *cached["items"]])
+        if CONVERSATION_STATE == "server":
+            # The stored response chain lacks this turn; the next one replays the transcript instead
+            await self._previous_response_id(turn.session_id)  # remembered in case the turn's rows are lost
+            await self.session_state.set(turn.session_id, "last_response_id", "")
+        turn.phase_state.advance(turn.phase)
+        await self.session_state.set(turn.session_id, "phase", turn.phase_state.dumps())
+        logger.info("response cache hit session=%s phase=%s", turn.session_id, turn.phase)
+        return cached["output_text"]
+
+    # ---- per-session serialization ----
+    @asynccontextmanager
+    async def _session_lock(self, session_id: str) -> AsyncIterator[None]:
+        """
+        Run one turn at a time per session: an asyncio.Lock inside this worker, plus a
+        transaction-scoped Postgres advisory lock across workers (released on commit or disconnect).
+        With write-behind, the lock is held until the turn's queued rows are in, so the next turn reads them.
+        """
+        if SESSION_LOCK == "off":
+            try:
+                yield
+            finally:
+                await self._settle_writes(session_id)
+            return
+
+        lock = self._local_locks.get(session_id)
+        if lock is None:
+            lock = self._local_locks[session_id] = asyncio.Lock()
+
+        started = time.perf_counter()
+        # Not wait_for(lock.acquire()): before Python 3.12 an acquire that completes as the timeout fires can be
+        # dropped with the lock still held. The acquire runs as its own task and is checked once the wait ends.
+        acquire = asyncio.ensure_future(lock.acquire())
+        try:
+            await asyncio.wait({acquire}, timeout=SESSION_LOCK_TIMEOUT)
+        except BaseException:
+            _abandon_acquire(acquire, lock)
+            raise
+        if not acquire.done():
+            _abandon_acquire(acquire, lock)
+            raise SessionBusy(f"Session {session_id} is busy with another turn")
+        try:
+            if self._lock_engine is None:
+                observe_phase("session_lock", time.perf_counter() - started)
+                try:
+                    yield
+                finally:
+                    await self._settle_writes(session_id)
+                return
+
+            try:
+                conn = await self._lock_engine.connect()
+            except SQLAlchemyTimeoutError as e:
+                raise SessionBusy(f"Session {session_id} is busy: no lock connection free") from e
+            try:
+                async with conn.begin():
+                    await conn.execute(sql_text(f"SET LOCAL lock_timeout = '{int(SESSION_LOCK_TIMEOUT * 1000)}ms'"))
+                    try:
+                        await conn.execute(
+                            sql_text("SELECT pg_advisory_xact_lock(:ns, hashtext(:session_id))"),
+                            {"ns": ADVISORY_LOCK_NAMESPACE, "session_id": session_id},
+                        )
+                    except DBAPIError as e:
+                        raise SessionBusy(f"Session {session_id} is busy with another turn") from e
+                    observe_phase("session_lock", time.perf_counter() - started)
+                    try:
+                        yield
+                    finally:
+                        await self._settle_writes(session_id)
+            finally:
+                await conn.close()
+        finally:
+            lock.release()
+
+    async def _settle_writes(self, session_id: str) -> None:
+        """
+        Wait for the session's queued rows, even if the turn was cancelled. If they are lost, the state rows
+        the turn moved (phase, response chain, idempotency result) go back to what they were before it, so the
+        next turn and a client retry see the same session as the transcript does.
+        """
+        undo = self._undo.pop(session_id, None)
+        future = self.writer.last(session_id)
+        if future is None:
+            return
+        self.write_stats.waits += 1
+        with timed_phase("write"):
+            try:
+                await _await_through_cancel(future)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("write-behind failed session=%s, rows of this turn were not saved: %s", session_id, e)
+                await self._undo_state(session_id, undo or {})
+            finally:
+                self.writer.reset(session_id)
+
+    def _remember_state(self, session_id: str, key: str, value: Optional[str]) -> None:
+        # A state row's value before this turn changes it (None = no row); see _settle_writes
+        self._undo.setdefault(session_id, {}).setdefault(key, value)
+
+    async def _undo_state(self, session_id: str, undo: Dict[str, Optional[str]]) -> None:
+        for key, value in undo.items():
+            try:
+                if value is None:
+                    await self.session_state.delete(session_id, key)
+                else:
+                    await self.session_state.set(session_id, key, value)
+            except Exception:
+                logger.exception("could not restore state session=%s key=%s", session_id, key)
+        if undo:
+            self.write_stats.rollbacks += 1
+
+    # ---- retention ----
+    async def archive_sessions(
+        self, idle_days: float = ARCHIVE_AFTER_DAYS, finished_only: bool = True, limit: int = 500
+    ) -> int:
+        """Archive up to `limit` sessions idle for `idle_days`; sessions with a turn in flight are skipped."""
+        cutoff = utcnow() - timedelta(days=idle_days)
+        archived = 0
+        for session_id in await self.archive.candidates(cutoff, finished_only, limit):
+            try:
+                async with self._session_lock(session_id):
+                    if not await self.archive.archive(session_id, cutoff):
+                        continue
+            except SessionBusy:
+                continue
+            self._seeded.pop(session_id)
+            self._summaries.pop(session_id)
+            archived += 1
+        return archived
+
+    async def restore_session(self, session_id: str) -> bool:
+        async with self._session_lock(session_id):
+            return await self.archive.restore(session_id)
+
+    async def rewind_input(self, session_id: str, message: str) -> bool:
+        """
+        Drop `message` if it is the newest item of the session. The SDK saves the input before calling the
+        model, so a turn that failed upstream leaves it behind and a plain retry would send it twice.
+        """
+        async with self._session_lock(session_id):
+            return await self._drop_input(session_id, message)
+
+    async def _drop_input(self, session_id: str, message: str, session: Optional[WowSession] = None) -> bool:
+        session = session or self._make_session(session_id)
+        last = await session.get_items(limit=1)
+        if last and last[0].get("role") == "user" and last[0].get("content") == message:
+            await session.pop_item()
+            return True
+        return False
+
+    async def chat(
+        self,
+        session_id: str,
+        message: str,
+        investor_id: Optional[str] = None,
+        idempotency_key: Optional[str] = None,
+        bypass_cache: bool = False,
+    ) -> str:
+        if not idempotency_key and SESSION_WRITES != "behind":
+            return await self._chat_serialized(session_id, message, investor_id, None, bypass_cache)
+
+        # The turn runs in its own task and answers through `reply` as soon as it has the output; with
+        # SESSION_WRITES=behind that is before its rows are written, and the task holds the lock until they are.
+        # Duplicates in this worker attach to the first request's reply instead of calling the model again.
+        # With a key the turn also finishes if the first client disconnects; without one it is cancelled.
+        key = (session_id, idempotency_key) if idempotency_key else None
+        reply = self._inflight.get(key) if key else None
+        if reply is not None:
+            self.history_stats.coalesced_requests += 1
+            return await asyncio.shield(reply)
+
+        reply = asyncio.get_running_loop().create_future()
+        task = asyncio.create_task(
+            self._chat_serialized(session_id, message, investor_id, idempotency_key, bypass_cache, reply)
+        )
+        self._background.add(task)
+        task.add_done_callback(lambda finished: self._chat_done(key, reply, finished))
+        if key:
+            self._inflight[key] = reply
+        try:
+            return await asyncio.shield(reply)
+        except asyncio.CancelledError:
+            if key is None and not reply.done():
+                task.cancel()
+            raise
+
+    def _chat_done(
+        self, key: Optional[Tuple[str, str]], reply: "asyncio.Future[str]", task: "asyncio.Task[str]"
+    ) -> None:
+        self._background.discard(task)
+        if key:
+            self._inflight.pop(key, None)
+        if reply.done():
+            return
+        if task.cancelled():
+            reply.cancel()
+        elif task.exception() is not None:
+            reply.set_exception(task.exception())
+        else:
+            reply.set_result(task.result())
+
+    async def _stored_result(self, session_id: str, idempotency_key: Optional[str]) -> Optional[str]:
+        if not idempotency_key:
+            return None
+        stored = await self.session_state.get(session_id, f"idempotency:{idempotency_key}")
+        if stored is not None:
+            self.history_stats.idempotent_replays += 1
+        return stored
+
+    async def _store_result(self, session_id: str, idempotency_key: Optional[str], output_text: str) -> None:
+        if idempotency_key:
+            self._remember_state(session_id, f"idempotency:{idempotency_key}", None)  # only stored when absent
+            await self.session_state.set(session_id, f"idempotency:{idempotency_key}", output_text)
+            self._results_stored += 1
+            if IDEMPOTENCY_PRUNE_EVERY > 0 and self._results_stored % IDEMPOTENCY_PRUNE_EVERY == 0:
+                # Off the request path, like history compaction
+                task = asyncio.create_task(self._prune_results())
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+
+    async def _prune_results(self) -> None:
+        try:
+            pruned = await self.session_state.prune("idempotency:", IDEMPOTENCY_TTL_SECONDS)
+        except Exception:
+            logger.exception("Could not prune stored idempotency results")
+            return
+        if pruned:
+            logger.info("Pruned %d stored idempotency results", pruned)
+
+    async def _chat_serialized(
+        self,
+        session_id: str,
+        message: str,
+        investor_id: Optional[str],
+        idempotency_key: Optional[str],
+        bypass_cache: bool = False,
+        reply: "Optional[asyncio.Future[str]]" = None,
+    ) -> str:
+        async with self._session_lock(session_id):
+            # Another worker may have finished the same request while we waited for the lock
+            output_text = await self._stored_result(session_id, idempotency_key)
+            if output_text is None:
+                try:
+                    output_text = await self._chat_turn(session_id, message, investor_id, bypass_cache)
+                except UpstreamUnavailable:
+                    # The turn never happened; leave the session ready for a plain retry
+                    await self._drop_input(session_id, message)
+                    raise
+                await self._store_result(session_id, idempotency_key, output_text)
+            if reply is not None and not reply.done():
+                reply.set_result(output_text)  # the caller has its answer; the lock still waits for queued rows
+        return output_text
+
+    async def _chat_turn(
+        self, session_id: str, message: str, investor_id: Optional[str], bypass_cache: bool = False
+    ) -> str:
+        cache_key = await self._ensure_seeded(session_id, investor_id)
+        session = self._make_session(session_id)
+        turn = await self._turn_context(session_id, message)
+        turn.cache_key = cache_key
+
+        response_key = await self._response_key(session, turn, message, bypass_cache)
+        if response_key:
+            cached = await self.response_cache.get(response_key)
+            if cached is not None:
+                return await self._replay_cached(session, turn, message, cached)
+
+        started = time.perf_counter()
+        with trace("Filosofia WOW (FastAPI)"), _upstream_deadline(self.router.deadline(turn.phase)):
+            result = await self._run(session, message, turn)
+
+        record_usage(result)
+        await self._advance_phase(turn, result, time.perf_counter() - started)
+        self._after_turn(turn)
+        await self._cache_response(response_key, result)
+        return result.final_output_as(str)
+
+    async def chat_stream(
+        self,
+        session_id: str,
+        message: str,
+        investor_id: Optional[str] = None,
+        idempotency_key: Optional[str] = None,
+        bypass_cache: bool = False,
+        live: Optional[LiveSession] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Same turn as `chat`, but yields events while the model is generating:
+        - {"event": "delta", ...}      output text deltas
+        - {"event": "reasoning", ...}  reasoning summary deltas
+        - {"event": "done", ...}       final output (the turn is already persisted)
+        A retried stream waits for the session lock and replays the stored result as a single "done".
+        With `live` (see open_live) history comes from the connection's cache. With `live` or
+        SESSION_WRITES=behind, "done" can go out while the turn's rows are still being written; the lock
+        is held until they are.
+        """
+        async with self._session_lock(session_id):
+            if live is not None:
+                await live.refresh()
+            stored = await self._stored_result(session_id, idempotency_key)
+            if stored is not None:
+                yield {"event": "done", "data": {"session_id": session_id, "output_text": stored}}
+                return
+
+            try:
+                async for frame in self._chat_stream_turn(session_id, message, investor_id, bypass_cache, live):
+                    if frame["event"] == "done":
+                        await self._store_result(session_id, idempotency_key, frame["data"]["output_text"])
+                    yield frame
+            except UpstreamUnavailable:
+                await self._drop_input(session_id, message, live)
+                raise
+            except BaseException:
+                if live is not None:
+                    live.invalidate()  # the turn stopped halfway; start the next one from the DB
+                raise
+            finally:
+                if live is not None:
+                    await live.flush()
+
+    async def _chat_stream_turn(
+        self,
+        session_id: str,
+        message: str,
+        investor_id: Optional[str],
+        bypass_cache: bool = False,
+        live: Optional[LiveSession] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        cache_key = await self._ensure_seeded(session_id, investor_id)
+        session = live or self._make_session(session_id)
+        turn = await self._turn_context(session_id, message, live)
+        turn.cache_key = cache_key
+
+        response_key = await self._response_key(session, turn, message, bypass_cache)
+        if response_key:
+            cached = await self.response_cache.get(response_key)
+            if cached is not None:
+                output_text = await self._replay_cached(session, turn, message, cached)
+                # The whole reply as one delta, so clients render it the same way
+                yield {"event": "delta", "data": {"text": output_text}}
+                yield {"event": "done", "data": {"session_id": session_id, "output_text": output_text}}
+                return
+
+        run_started = time.perf_counter()
+        with trace("Filosofia WOW (FastAPI, stream)"):
+            result: Optional[RunResultStreaming] = None
+            previous_id = await self._previous_response_id(session_id)
+            deadline = self.router.deadline(turn.phase)
+            if previous_id:
+                # The run task copies the context when it is created, deadline included
+                with _upstream_deadline(deadline):
+                    result = Runner.run_streamed(
+                        self.router.agent(turn.phase),
+                        message,
+                        context=turn,
+                        previous_response_id=previous_id,
+                        hooks=_ModelTimingHooks(),
+                        run_config=self._run_config(cache_key=turn.cache_key),
+                    )
+                started = False
+                try:
+                    async for frame in stream_frames(result):
+                        started = True
+                        yield frame
+                except (NotFoundError, BadRequestError) as e:
+                    # Expiry surfaces before the first delta; anything later is a real error
+                    if started or not _is_expired_state_error(e):
+                        raise
+                    self.history_stats.server_state_fallbacks += 1
+                    logger.warning("server-side state expired session=%s, replaying history", session_id)
+                    result = None
+                else:
+                    await session.add_items(result.to_input_list())
+                    self.history_stats.server_state_turns += 1
+
+            if result is None:
+                with _upstream_deadline(deadline):
+                    result = Runner.run_streamed(
+                        self.router.agent(turn.phase),
+                        message,
+                        context=turn,
+                        session=session,  # items are written to the session when the stream completes
+                        hooks=_ModelTimingHooks(),
+                        run_config=self._run_config(windowed=True, cache_key=turn.cache_key),
+                    )
+                async for frame in stream_frames(result):
+                    yield frame
+
+            await self._remember_response_id(session_id, result.last_response_id)
+
+        record_usage(result)
+        await self._advance_phase(turn, result, time.perf_counter() - run_started)
+        self._after_turn(turn)
+        await self._cache_response(response_key, result)
+        yield {"event": "done", "data": {"session_id": session_id, "output_text": result.final_output_as(str)}}
+
+
+# -----------------------------
+# Background chat jobs
+# -----------------------------
+class ChatJobRunner:
+    """
+    Per-worker pool of JOB_CONCURRENCY asyncio tasks running queued jobs off the request path.
+    - jobs created here are started right away; the rest (other workers, restarts) are picked up by polling
+    - a running job touches its row every JOB_STALE_SECONDS / 3; startup and the poll loop (as often) requeue
+      rows that stopped doing so
+    - on shutdown, running jobs go back to "queued" (minus the input the SDK already saved) so another
+      worker resumes them
+    - a job that finds its session busy or the model API unavailable is deferred: queued again with a
+      not-before time, without using up one of its JOB_MAX_ATTEMPTS
+    - the turn itself goes through AgentService.chat_stream with idempotency key "job:<id>", so a rerun
+      after a crash returns the stored result instead of adding a second turn
+    """
+
+    def __init__(self, service: AgentService, store: Optional[ChatJobStore] = None, concurrency: int = JOB_CONCURRENCY):
+        self.service = service
+        self.store = store or ChatJobStore()
+        self.concurrency = concurrency
+        self._owner = ""  # set in startup(): with --preload this object is built in the master, before the fork
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._workers: List["asyncio.Task[None]"] = []
+        self._running: Set[str] = set()
+        self._subscribers: Dict[str, Set["asyncio.Queue[Optional[Dict[str, Any]]]"]] = {}
+        self.counts: Dict[str, int] = {"enqueued": 0, "succeeded": 0, "failed": 0, "requeued": 0, "recovered": 0}
+        self._next_recovery = 0.0
+
+    async def startup(self) -> None:
+        self._owner = f"{os.uname().nodename}:{os.getpid()}"
+        await self.store.startup(self.service.engine)
+        await self._recover_stale()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def shutdown(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counts, "running": len(self._running), "concurrency": self.concurrency}
+
+    async def submit(
+        self, session_id: str, message: str, investor_id: Optional[str] = None, idempotency_key: Optional[str] = None
+    ) -> Tuple[ChatJob, bool]:
+        if idempotency_key:
+            job_id = hashlib.sha256(f"{session_id}\0{idempotency_key}".encode("utf-8")).hexdigest()[:32]
+        else:
+            job_id = uuid.uuid4().hex
+        job, created = await self.store.create(job_id, session_id, message, investor_id)
+        if created:
+            self.counts["enqueued"] += 1
+            if self._workers:
+                self._queue.put_nowait(job_id)
+        return job, created
+
+    # ---- progress fan-out (only for jobs running in this worker) ----
+    def subscribe(self, job_id: str) -> Optional["asyncio.Queue[Optional[Dict[str, Any]]]"]:
+        if job_id not in self._running:
+            return None
+        queue: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue()
+        self._subscribers.setdefault(job_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: "asyncio.Queue[Optional[Dict[str, Any]]]") -> None:
+        queues = self._subscribers.get(job_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                self._subscribers.pop(job_id, None)
+
+    def _publish(self, job_id: str, frame: Optional[Dict[str, Any]]) -> None:
+        for queue in self._subscribers.get(job_id, ()):
+            queue.put_nowait(frame)
+
+    # ---- execution ----
+    async def _recover_stale(self) -> None:
+        # A worker killed and respawned at once starts before its jobs' heartbeats go stale, so this also
+        # runs from the poll loop, at most once per heartbeat interval per worker process
+        self._next_recovery = time.monotonic() + JOB_STALE_SECONDS / 3
+        recovered = await self.store.requeue_stale(JOB_STALE_SECONDS)
+        if recovered:
+            self.counts["recovered"] += recovered
+            logger.warning("Requeued %d orphaned chat jobs", recovered)
+
+    async def _worker(self) -> None:
+        while True:
+            try:
+                try:
+                    job_id: Optional[str] = await asyncio.wait_for(self._queue.get(), timeout=JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    if time.monotonic() >= self._next_recovery:
+                        await self._recover_stale()
+                    job_id = await self.store.next_queued()
+                if job_id and await self.store.claim(job_id, self._owner):
+                    await self._run(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Chat job worker error")
+                await asyncio.sleep(JOB_POLL_SECONDS)
+
+    async def _heartbeat(self, job_id: str) -> None:
+        while True:
+            await asyncio.sleep(JOB_STALE_SECONDS / 3)
+            await self.store.heartbeat(job_id)
+
+    async def _run(self, job_id: str) -> None:
+        job = await self.store.get(job_id)
+        if job.attempts > JOB_MAX_ATTEMPTS:
+            await self.store.fail(job_id, f"gave up after {JOB_MAX_ATTEMPTS} attempts")
+            self.counts["failed"] += 1
+            return
+
+        JOB_QUEUE_SECONDS.observe(max(0.0, (utcnow() - job.created_at).total_seconds()))
+        self._running.add(job_id)
+        JOBS_RUNNING.inc()
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        started = time.perf_counter()
+        status = "failed"
+        try:
+            output_text = ""
+            with track_request("chat_job"):
+                async for frame in self.service.chat_stream(
+                    job.session_id, job.message, job.investor_id, idempotency_key=f"job:{job_id}"
+                ):
+                    self._publish(job_id, frame)
+                    if frame["event"] == "done":
+                        output_text = frame["data"]["output_text"]
+            await self.store.succeed(job_id, output_text)
+            status = "succeeded"
+        except asyncio.CancelledError:
+            status = "requeued"
+            # The SDK saved the input before the model answered; the rerun would otherwise add it a second time
+            try:
+                await self.service.rewind_input(job.session_id, job.message)
+            except Exception:
+                logger.exception("Could not rewind the input of a cancelled job (job_id=%s)", job_id)
+            await self.store.requeue(job_id)
+            raise
+        except SessionBusy:
+            # A synchronous turn holds the session; a later poll tries again
+            status = "requeued"
+            await self.store.defer(job_id, JOB_POLL_SECONDS)
+        except UpstreamUnavailable as e:
+            # Model API down: back in the queue until it may be up again, not held here as "running"
+            logger.warning("Chat job deferred (job_id=%s): %s", job_id, e)
+            status = "requeued"
+            await self.store.defer(job_id, e.retry_after or JOB_POLL_SECONDS)
+        except Exception as e:
+            logger.exception("Chat job failed (job_id=%s, session_id=%s)", job_id, job.session_id)
+            error = f"{type(e).__name__}: {e}"
+            await self.store.fail(job_id, error)
+            # same frame as polling a failed job (main.py)
+            self._publish(job_id, {"event": "error", "data": {"detail": error, "status": 500}})
+        finally:
+            heartbeat.cancel()
+            JOBS_RUNNING.dec()
+            JOB_SECONDS.labels(status).observe(time.perf_counter() - started)
+            self.counts[status] += 1
+            self._running.discard(job_id)
+            self._publish(job_id, None)
+            self._subscribers.pop(job_id, None)
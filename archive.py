@@ -0,0 +1,71 @@
+"""
+Session retention: move idle sessions out of agent_sessions / agent_messages / agent_session_state into
+one compressed row each in the archive table (AGENT_SESSION_ARCHIVE_TABLE), and back.
+
+    python archive.py                         # finished sessions idle ARCHIVE_AFTER_DAYS (30) or more
+    python archive.py --idle-days 90 --all    # also sessions that never reached the philosophy
+    python archive.py --dry-run               # list what would move
+    python archive.py --restore SESSION_ID
+
+Run it from cron (or a scheduled job) with the app's environment. Each session moves in one transaction
+under the session lock, so a turn in flight is never split; sessions written to meanwhile are skipped.
+With SESSION_ARCHIVE=1 the app restores an archived session by itself when a request names it.
+"""
+
+import argparse
+import asyncio
+import logging
+import sys
+from datetime import timedelta
+from typing import List, Optional
+
+import main
+from config import ARCHIVE_AFTER_DAYS
+from stores import utcnow
+
+logger = logging.getLogger("sabbi.archive")
+
+
+async def main_async(args: argparse.Namespace) -> int:
+    main.warm_imports()
+    service = main.service
+    await service.startup()
+    try:
+        if args.restore:
+            restored = await service.restore_session(args.restore)
+            logger.info("%s %s", "restored" if restored else "not archived (or id in use):", args.restore)
+            return 0 if restored else 1
+
+        if args.dry_run:
+            cutoff = utcnow() - timedelta(days=args.idle_days)
+            for session_id in await service.archive.candidates(cutoff, not args.all, args.batch):
+                print(session_id)
+            return 0
+
+        total = 0
+        while args.max is None or total < args.max:
+            limit = args.batch if args.max is None else min(args.batch, args.max - total)
+            archived = await service.archive_sessions(args.idle_days, finished_only=not args.all, limit=limit)
+            total += archived
+            logger.info("archived %d sessions (%d so far)", archived, total)
+            if archived == 0:
+                break
+        return 0
+    finally:
+        await service.shutdown()
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--idle-days", type=float, default=ARCHIVE_AFTER_DAYS, help="days since the last write")
+    parser.add_argument("--all", action="store_true", help="include sessions whose FLOW is not finished")
+    parser.add_argument("--batch", type=int, default=500, help="sessions picked per round")
+    parser.add_argument("--max", type=int, default=None, help="stop after this many sessions")
+    parser.add_argument("--dry-run", action="store_true", help="print the first batch of candidates and exit")
+    parser.add_argument("--restore", metavar="SESSION_ID", help="move one archived session back")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s", stream=sys.stderr)
+    sys.exit(asyncio.run(main_async(parse_args())))
@@ -0,0 +1,266 @@
+"""
+Offline WOW philosophy generation for many investors, straight through AgentService (no HTTP).
+
+    python batch.py --input investors.jsonl --output philosophies.jsonl --concurrency 8
+
+Input JSONL, one investor per line:
+
+    {"id": "inv-001", "investor_id": "inv-001", "profile": {...}, "answers": ["...", "...", "...", "..."]}
+
+- id:          batch key (defaults to investor_id); also names the session ("batch:<id>")
+- profile:     optional ProfileUpsertRequest fields; stored first so the session is seeded from it
+- investor_id: optional existing profile (the default profile when both are missing)
+- answers:     the answers to the first round's questions, in order (exactly QUESTIONS_PER_ROUND of them)
+- opening / generate: optional first message and closing "generate now" message
+
+Output JSONL gets one line per investor as soon as it finishes: status "ok" with the philosophy, "incomplete"
+when the flow had not reached its end after the last message (the model's last reply is kept as "reply"), or
+"error". Rerunning with the same --output skips ids already written with status "ok". Each turn carries an
+idempotency key, so an investor that was interrupted halfway replays its finished turns from the DB and
+continues where it stopped.
+
+Rate limits: a 429 pauses every worker (Retry-After when the API sends one, else exponential backoff
+with full jitter), then the turn is retried; other transient upstream errors are retried the same way.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set
+
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+
+import main
+from context import QUESTIONS_PER_ROUND, PhaseState
+from resilience import UpstreamUnavailable
+
+logger = logging.getLogger("sabbi.batch")
+
+DEFAULT_OPENING = "Hola, empecemos."
+DEFAULT_GENERATE = "Ya está bien así, genera mi filosofía de inversión."
+
+# The service retries within its own budget and then raises UpstreamUnavailable (cause: the API error)
+_TRANSIENT = (UpstreamUnavailable, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+
+@dataclass
+class BatchItem:
+    id: str
+    investor_id: Optional[str]
+    profile: Optional[Dict[str, Any]]
+    messages: List[str]
+
+    @classmethod
+    def parse(cls, raw: Dict[str, Any], opening: str, generate: str) -> "BatchItem":
+        item_id = raw.get("id") or raw.get("investor_id")
+        if not item_id:
+            raise ValueError("each line needs an id or investor_id")
+        answers = raw.get("answers") or []
+        if not isinstance(answers, list):
+            raise ValueError("answers must be a list")
+        if len(answers) != QUESTIONS_PER_ROUND:
+            raise ValueError(f"answers needs {QUESTIONS_PER_ROUND} entries, got {len(answers)}")
+        investor_id = raw.get("investor_id") or (item_id if raw.get("profile") else None)
+        messages = [raw.get("opening") or opening, *answers, raw.get("generate") or generate]
+        return cls(id=str(item_id), investor_id=investor_id, profile=raw.get("profile"), messages=messages)
+
+
+def load_items(path: str, opening: str, generate: str) -> List[BatchItem]:
+    items: List[BatchItem] = []
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                items.append(BatchItem.parse(json.loads(line), opening, generate))
+            except (ValueError, TypeError) as e:
+                raise SystemExit(f"{path}:{number}: {e}")
+    return items
+
+
+def completed_ids(path: str) -> Set[str]:
+    done: Set[str] = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by a crash; that id simply runs again
+            # "complete": false marks an unfinished flow written as "ok" by earlier versions
+            if row.get("status") == "ok" and row.get("complete", True):
+                done.add(row["id"])
+    return done
+
+
+# -----------------------------
+# Rate-limit aware retries
+# -----------------------------
+def _retry_after(e: Exception) -> Optional[float]:
+    if getattr(e, "retry_after", None):
+        return e.retry_after
+    e = e.__cause__ or e
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(headers[header]) * scale
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+class RateGate:
+    """Shared pause: a 429 on any worker holds back every worker's next call until it expires."""
+
+    def __init__(self) -> None:
+        self._resume_at = 0.0
+        self.pauses = 0
+
+    async def wait(self) -> None:
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        resume_at = time.monotonic() + seconds
+        if resume_at > self._resume_at:
+            self._resume_at = resume_at
+            self.pauses += 1
+
+
+@dataclass
+class Counters:
+    ok: int = 0
+    incomplete: int = 0
+    failed: int = 0
+    turns: int = 0
+    retries: int = 0
+
+
+class BatchRunner:
+    def __init__(self, args: argparse.Namespace, output) -> None:
+        self.args = args
+        self.output = output
+        self.gate = RateGate()
+        self.counters = Counters()
+        self.started = time.monotonic()
+
+    async def _turn(self, session_id: str, index: int, message: str, investor_id: Optional[str]) -> str:
+        attempt = 0
+        while True:
+            await self.gate.wait()
+            try:
+                return await main.service.chat(
+                    session_id, message, investor_id=investor_id, idempotency_key=f"batch:{index}"
+                )
+            except _TRANSIENT as e:
+                if attempt >= self.args.max_retries:
+                    raise
+                delay = _retry_after(e) or random.uniform(0, min(self.args.max_backoff, self.args.backoff * 2**attempt))
+                if isinstance(e, RateLimitError) or isinstance(e.__cause__, RateLimitError):
+                    self.gate.pause(delay)
+                attempt += 1
+                self.counters.retries += 1
+                logger.warning("retrying session=%s turn=%d in %.1fs (%s)", session_id, index, delay, type(e).__name__)
+                await asyncio.sleep(delay)
+
+    async def run_item(self, item: BatchItem) -> Dict[str, Any]:
+        session_id = f"batch:{item.id}"
+        started = time.perf_counter()
+        row: Dict[str, Any] = {"id": item.id, "investor_id": item.investor_id, "session_id": session_id}
+        try:
+            if item.profile is not None:
+                profile = main.ProfileUpsertRequest(investor_id=item.investor_id, **item.profile)
+                await main.service.upsert_profile(item.investor_id, profile.model_dump(exclude={"investor_id"}))
+            output_text = ""
+            for index, message in enumerate(item.messages):
+                output_text = await self._turn(session_id, index, message, item.investor_id)
+                self.counters.turns += 1
+            phase = PhaseState.loads(await main.service.session_state.get(session_id, "phase"))
+            row["turns"] = len(item.messages)
+            if phase.stage == "done":
+                row.update(status="ok", philosophy=output_text)
+                self.counters.ok += 1
+            else:
+                row.update(status="incomplete", stage=phase.stage, reply=output_text)
+                self.counters.incomplete += 1
+        except Exception as e:
+            logger.exception("batch item failed id=%s", item.id)
+            row.update(status="error", error=f"{type(e).__name__}: {e}")
+            self.counters.failed += 1
+        row["seconds"] = round(time.perf_counter() - started, 2)
+        return row
+
+    def write(self, row: Dict[str, Any]) -> None:
+        self.output.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self.output.flush()
+
+    def progress(self, total: int) -> str:
+        elapsed = time.monotonic() - self.started
+        done = self.counters.ok + self.counters.incomplete + self.counters.failed
+        rate = done / elapsed * 3600 if elapsed else 0.0
+        return (
+            f"{done}/{total} ok={self.counters.ok} incomplete={self.counters.incomplete} failed={self.counters.failed} "
+            f"retries={self.counters.retries} pauses={self.gate.pauses} {rate:.0f}/h"
+        )
+
+    async def run(self, items: List[BatchItem]) -> None:
+        queue: "asyncio.Queue[BatchItem]" = asyncio.Queue()
+        for item in items:
+            queue.put_nowait(item)
+
+        async def worker() -> None:
+            while True:
+                try:
+                    item = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                self.write(await self.run_item(item))
+                logger.info("%s", self.progress(len(items)))
+
+        await asyncio.gather(*(worker() for _ in range(min(self.args.concurrency, len(items)))))
+
+
+async def main_async(args: argparse.Namespace) -> Counters:
+    items = load_items(args.input, args.opening, args.generate)
+    done = completed_ids(args.output)
+    pending = [item for item in items if item.id not in done]
+    logger.info("%d investors, %d already done, %d to run", len(items), len(items) - len(pending), len(pending))
+
+    main.warm_imports()
+    await main.service.startup()
+    try:
+        with open(args.output, "a", encoding="utf-8") as output:
+            runner = BatchRunner(args, output)
+            await runner.run(pending)
+            logger.info("finished: %s", runner.progress(len(pending)))
+            return runner.counters
+    finally:
+        await main.service.shutdown()
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", required=True, help="investors JSONL")
+    parser.add_argument("--output", required=True, help="results JSONL (appended; also the resume checkpoint)")
+    parser.add_argument("--concurrency", type=int, default=8, help="investors in flight at once")
+    parser.add_argument("--max-retries", type=int, default=6, help="retries per turn on 429 / transient errors")
+    parser.add_argument("--backoff", type=float, default=2.0, help="first backoff ceiling (s), doubled per retry")
+    parser.add_argument("--max-backoff", type=float, default=60.0)
+    parser.add_argument("--opening", default=DEFAULT_OPENING, help="first user message when a line has none")
+    parser.add_argument("--generate", default=DEFAULT_GENERATE, help="closing message asking for the philosophy")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s", stream=sys.stderr)
+    args = parse_args()
+    counters = asyncio.run(main_async(args))
+    sys.exit(1 if counters.failed or counters.incomplete else 0)
@@ -0,0 +1,402 @@
+"""
+Load / latency benchmark for the FastAPI app, with a deterministic local stand-in for the model.
+
+In-process (one "worker", sessions in SQLite unless --db-url is given; SQLite needs `aiosqlite`):
+
+    python bench.py --conversations bench_conversations.jsonl --users 20 --iterations 5
+
+Against real gunicorn workers (the fake model is installed when the app is imported from this module):
+
+    SESSION_DB_URL=postgresql+asyncpg://... BENCH_LATENCY=0.8 \
+        gunicorn -k uvicorn.workers.UvicornWorker bench:app --workers 4 --bind 0.0.0.0:3000
+    python bench.py --url http://localhost:3000 --conversations bench_conversations.jsonl --users 50
+
+Conversations JSONL: one conversation per line, either {"turns": ["...", "..."], "investor_id": "..."}
+or ChatRequest-shaped lines ({"session_id", "message"}) that are grouped by session_id in file order.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import resource
+import sys
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+from openai.types.responses import (
+    Response,
+    ResponseCompletedEvent,
+    ResponseCreatedEvent,
+    ResponseOutputMessage,
+    ResponseOutputText,
+    ResponseTextDeltaEvent,
+    ResponseUsage,
+)
+from openai.types.responses.response_usage import InputTokensDetails, OutputTokensDetails
+
+from agents import Model, ModelProvider, Usage
+from agents.items import ModelResponse
+
+WORDS = (
+    "cómo equilibras liquidez y crecimiento cuando tu convicción en real estate choca con tu deseo de "
+    "reducir la exposición a propiedades directas y qué señal concreta te haría rebalancear hacia mercados públicos"
+).split()
+
+
+# -----------------------------
+# Fake model
+# -----------------------------
+@dataclass
+class FakeModelConfig:
+    latency: float = float(os.getenv("BENCH_LATENCY", "0.8"))  # seconds before the first token
+    tokens_per_sec: float = float(os.getenv("BENCH_TOKENS_PER_SEC", "60"))
+    output_tokens: int = int(os.getenv("BENCH_OUTPUT_TOKENS", "40"))
+
+
+@dataclass
+class ModelClock:
+    calls: int = 0
+    seconds: float = 0.0
+
+
+class FakeModel(Model):
+    """
+    Deterministic stand-in for the Responses API: same input -> same text.
+    Sleeps `latency` and then emits `output_tokens` at `tokens_per_sec`.
+    """
+
+    def __init__(self, name: str, config: FakeModelConfig, clock: ModelClock) -> None:
+        self.name = name
+        self.config = config
+        self.clock = clock
+
+    def _render(self, input: Any) -> tuple:
+        # Imported lazily so SESSION_DB_URL can be set before main is loaded
+        from context import compact_json, estimate_tokens
+
+        raw = input if isinstance(input, str) else compact_json(input)
+        rng = random.Random(hashlib.sha256(raw.encode("utf-8")).digest())
+        text = " ".join(rng.choice(WORDS) for _ in range(self.config.output_tokens)) + "?"
+        return text, estimate_tokens(raw)
+
+    def _response(self, text: str, input_tokens: int) -> Response:
+        message = ResponseOutputMessage(
+            id=f"msg_{uuid.uuid4().hex[:12]}",
+            type="message",
+            role="assistant",
+            status="completed",
+            content=[ResponseOutputText(type="output_text", text=text, annotations=[])],
+        )
+        return Response(
+            id=f"resp_{uuid.uuid4().hex[:12]}",
+            created_at=time.time(),
+            model=self.name,
+            object="response",
+            output=[message],
+            parallel_tool_calls=False,
+            tool_choice="auto",
+            tools=[],
+            # model_construct: the usage schema grows fields between openai releases
+            usage=ResponseUsage.model_construct(
+                input_tokens=input_tokens,
+                input_tokens_details=InputTokensDetails.model_construct(cached_tokens=0),
+                output_tokens=self.config.output_tokens,
+                output_tokens_details=OutputTokensDetails.model_construct(reasoning_tokens=0),
+                total_tokens=input_tokens + self.config.output_tokens,
+            ),
+        )
+
+    async def get_response(
+        self, system_instructions, input, model_settings, tools, output_schema, handoffs, tracing, **kwargs
+    ) -> ModelResponse:
+        started = time.perf_counter()
+        text, input_tokens = self._render(input)
+        await asyncio.sleep(self.config.latency + self.config.output_tokens / self.config.tokens_per_sec)
+        response = self._response(text, input_tokens)
+
+        self.clock.calls += 1
+        self.clock.seconds += time.perf_counter() - started
+        return ModelResponse(
+            output=response.output,
+            usage=Usage(
+                requests=1,
+                input_tokens=input_tokens,
+                output_tokens=self.config.output_tokens,
+                total_tokens=input_tokens + self.config.output_tokens,
+            ),
+            response_id=response.id,
+        )
+
+    async def stream_response(
+        self, system_instructions, input, model_settings, tools, output_schema, handoffs, tracing, **kwargs
+    ) -> AsyncIterator[Any]:
+        started = time.perf_counter()
+        text, input_tokens = self._render(input)
+        response = self._response(text, input_tokens)
+
+        await asyncio.sleep(self.config.latency)
+        yield ResponseCreatedEvent(type="response.created", response=response, sequence_number=0)
+        for i, word in enumerate(text.split(" ")):
+            await asyncio.sleep(1 / self.config.tokens_per_sec)
+            yield ResponseTextDeltaEvent(
+                type="response.output_text.delta",
+                delta=word + " ",
+                item_id=response.output[0].id,
+                output_index=0,
+                content_index=0,
+                sequence_number=i + 1,
+                logprobs=[],
+            )
+        yield ResponseCompletedEvent(type="response.completed", response=response, sequence_number=i + 2)
+
+        self.clock.calls += 1
+        self.clock.seconds += time.perf_counter() - started
+
+
+class FakeModelProvider(ModelProvider):
+    def __init__(self, config: Optional[FakeModelConfig] = None) -> None:
+        self.config = config or FakeModelConfig()
+        self.clock = ModelClock()
+
+    def get_model(self, model_name: Optional[str]) -> Model:
+        return FakeModel(model_name or "fake", self.config, self.clock)
+
+
+# -----------------------------
+# App wiring
+# -----------------------------
+@dataclass
+class DBClock:
+    statements: int = 0
+    seconds: float = 0.0
+
+
+_provider: Optional[FakeModelProvider] = None
+_db_clock = DBClock()
+
+
+def _install(config: Optional[FakeModelConfig] = None):
+    """Import the app with the fake model installed and a /bench/stats route (once per process)."""
+    global _provider
+    import main
+
+    main.warm_imports()
+    if _provider is None:
+        _provider = FakeModelProvider(config)
+        main.service.model_provider = _provider
+
+        @main.app.get("/bench/stats")
+        async def bench_stats():
+            return _worker_stats()
+
+        @main.app.on_event("startup")
+        async def _time_db() -> None:
+            _attach_db_clock(main.service._engine)
+
+    return main
+
+
+def _attach_db_clock(engine) -> None:
+    from sqlalchemy import event
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("bench_t0", []).append(time.perf_counter())
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        _db_clock.statements += 1
+        _db_clock.seconds += time.perf_counter() - conn.info["bench_t0"].pop()
+
+    event.listen(engine.sync_engine, "before_cursor_execute", before)
+    event.listen(engine.sync_engine, "after_cursor_execute", after)
+
+
+def _worker_stats() -> Dict[str, Any]:
+    return {
+        "pid": os.getpid(),
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "model_calls": _provider.clock.calls if _provider else 0,
+        "model_seconds": _provider.clock.seconds if _provider else 0.0,
+        "db_statements": _db_clock.statements,
+        "db_seconds": _db_clock.seconds,
+    }
+
+
+def __getattr__(name: str):
+    # `gunicorn bench:app` -> the real app, with the fake model installed
+    if name == "app":
+        return _install().app
+    raise AttributeError(name)
+
+
+# -----------------------------
+# Load generation
+# -----------------------------
+@dataclass
+class Conversation:
+    turns: List[str]
+    investor_id: Optional[str] = None
+
+
+@dataclass
+class Results:
+    latencies: List[float] = field(default_factory=list)
+    errors: Dict[str, int] = field(default_factory=dict)
+    wall_seconds: float = 0.0
+
+
+def load_conversations(path: str) -> List[Conversation]:
+    conversations: List[Conversation] = []
+    grouped: Dict[str, Conversation] = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if "turns" in row:
+                conversations.append(Conversation(turns=list(row["turns"]), investor_id=row.get("investor_id")))
+            elif "message" in row:
+                key = row.get("session_id") or f"line-{len(grouped)}"
+                if key not in grouped:
+                    grouped[key] = Conversation(turns=[], investor_id=row.get("investor_id"))
+                    conversations.append(grouped[key])
+                grouped[key].turns.append(row["message"])
+    if not conversations:
+        raise SystemExit(f"No conversations found in {path}")
+    return conversations
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+async def _replay(client: httpx.AsyncClient, conversation: Conversation, path: str, results: Results) -> None:
+    session_id = f"bench-{uuid.uuid4().hex}"
+    for message in conversation.turns:
+        body = {"session_id": session_id, "message": message}
+        if conversation.investor_id:
+            body["investor_id"] = conversation.investor_id
+
+        started = time.perf_counter()
+        try:
+            response = await client.post(path, json=body)
+            if path.endswith("/stream"):
+                await response.aread()
+            if response.status_code >= 400:
+                results.errors[str(response.status_code)] = results.errors.get(str(response.status_code), 0) + 1
+                return
+        except Exception as e:
+            results.errors[type(e).__name__] = results.errors.get(type(e).__name__, 0) + 1
+            return
+        results.latencies.append(time.perf_counter() - started)
+
+
+async def run_load(client: httpx.AsyncClient, conversations: List[Conversation], args: argparse.Namespace) -> Results:
+    results = Results()
+    queue: "asyncio.Queue[Conversation]" = asyncio.Queue()
+    for _ in range(args.iterations):
+        for conversation in conversations:
+            queue.put_nowait(conversation)
+
+    async def user() -> None:
+        while not queue.empty():
+            await _replay(client, queue.get_nowait(), args.path, results)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[user() for _ in range(args.users)])
+    results.wall_seconds = time.perf_counter() - started
+    return results
+
+
+def report(results: Results, workers: List[Dict[str, Any]]) -> Dict[str, Any]:
+    requests = len(results.latencies)
+    model_seconds = sum(w["model_seconds"] for w in workers)
+    db_seconds = sum(w["db_seconds"] for w in workers)
+    return {
+        "requests": requests,
+        "errors": results.errors,
+        "wall_seconds": round(results.wall_seconds, 3),
+        "throughput_rps": round(requests / results.wall_seconds, 2) if results.wall_seconds else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(results.latencies, 50) * 1000, 1),
+            "p95": round(percentile(results.latencies, 95) * 1000, 1),
+            "p99": round(percentile(results.latencies, 99) * 1000, 1),
+            "max": round(max(results.latencies, default=0.0) * 1000, 1),
+        },
+        "per_request_ms": {
+            "model": round(model_seconds / requests * 1000, 1) if requests else 0.0,
+            "db": round(db_seconds / requests * 1000, 1) if requests else 0.0,
+            "db_statements": round(sum(w["db_statements"] for w in workers) / requests, 1) if requests else 0.0,
+        },
+        "workers": [{"pid": w["pid"], "max_rss_mb": round(w["max_rss_mb"], 1)} for w in workers],
+    }
+
+
+async def _sample_workers(client: httpx.AsyncClient, attempts: int) -> List[Dict[str, Any]]:
+    # Each request lands on some worker; keep the latest sample per pid
+    seen: Dict[int, Dict[str, Any]] = {}
+    for _ in range(attempts):
+        stats = (await client.get("/bench/stats")).json()
+        seen[stats["pid"]] = stats
+    return list(seen.values())
+
+
+async def main_async(args: argparse.Namespace) -> Dict[str, Any]:
+    conversations = load_conversations(args.conversations)
+    timeout = httpx.Timeout(args.timeout)
+
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=timeout) as client:
+            results = await run_load(client, conversations, args)
+            workers = await _sample_workers(client, attempts=args.worker_samples)
+        return report(results, workers)
+
+    os.environ["SESSION_DB_URL"] = args.db_url
+    app_module = _install(
+        FakeModelConfig(latency=args.latency, tokens_per_sec=args.tokens_per_sec, output_tokens=args.output_tokens)
+    )
+    await app_module.service.startup()
+    _attach_db_clock(app_module.service.engine)
+    try:
+        transport = httpx.ASGITransport(app=app_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=timeout) as client:
+            results = await run_load(client, conversations, args)
+        return report(results, [_worker_stats()])
+    finally:
+        await app_module.service.shutdown()
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", default="bench_conversations.jsonl", help="JSONL with recorded conversations")
+    parser.add_argument("--users", type=int, default=10, help="concurrent virtual users")
+    parser.add_argument("--iterations", type=int, default=3, help="times each conversation is replayed")
+    parser.add_argument("--path", default="/chat", choices=["/chat", "/chat/stream"])
+    parser.add_argument("--timeout", type=float, default=120.0, help="client timeout per request (s)")
+    parser.add_argument("--url", help="benchmark a running server instead of the in-process app")
+    parser.add_argument("--worker-samples", type=int, default=20, help="/bench/stats probes used to find workers (--url)")
+    parser.add_argument("--db-url", default="sqlite+aiosqlite:///./bench_sessions.db", help="sessions DB (in-process)")
+    parser.add_argument("--latency", type=float, default=FakeModelConfig.latency, help="fake model latency (s)")
+    parser.add_argument("--tokens-per-sec", type=float, default=FakeModelConfig.tokens_per_sec)
+    parser.add_argument("--output-tokens", type=int, default=FakeModelConfig.output_tokens)
+    parser.add_argument("--json-out", help="also write the report to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    summary = asyncio.run(main_async(args))
+    print(json.dumps(summary, indent=2))
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+    sys.exit(1 if summary["errors"] else 0)
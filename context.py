@@ -0,0 +1,431 @@
+"""
+What the model is given: the seeded context (portfolio pre-analysis + the CONTEXTO blocks), helpers over a
+session's stored items for the history window, and the FLOW phase state that routes each turn.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import re
+import unicodedata
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from config import CONTEXT_PORTFOLIO_FORMAT
+
+# The Agents SDK is loaded lazily (see main.warm_imports); these names are only for annotations here
+if TYPE_CHECKING:
+    from agents import TResponseInputItem
+    from agents.result import RunResultStreaming
+
+logger = logging.getLogger("sabbi.agent")
+
+
+# -----------------------------
+# Portfolio pre-analysis
+# -----------------------------
+_Path = Tuple[str, ...]  # normalized labels: ("MERCADOS PUBLICOS", "RENTA FIJA", "BONOS PERU")
+_LABEL_ALIASES = {"OTROS ACTIVOS": "OTROS"}
+_TOTAL_LABELS = {"TOTAL", "TOTAL GENERAL"}
+_CLUB_DEALS = ("CLUB DEALS",)
+_PRIVATE = (("PROPIEDADES DIRECTAS",), ("ALTERNATIVES",), _CLUB_DEALS)
+
+
+def _norm_label(label: str) -> str:
+    # The two portfolios name things differently: "PROPIEDADES_DIRECTAS" / "PROPIEDADES DIRECTAS",
+    # "Prop Peru Oficinas" / "Propiedades Peru Oficinas", "(ex Peru)" / "(ex Perú)", "AAA–BBB" / "AAA-BBB"
+    text = re.sub("[\u2010-\u2015]", "-", str(label))
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+    text = re.sub(r"[^0-9A-Za-z]+", " ", text).strip().upper()
+    text = re.sub(r"\s+MERCADOS PUBLICOS$", "", text)  # "RENTA VARIABLE - Mercados Públicos"
+    text = re.sub(r"^PROP\b", "PROPIEDADES", text)
+    return _LABEL_ALIASES.get(text, text)
+
+
+class _Allocation:
+    """A portfolio flattened to path -> percent of the total, groups and positions alike, in document order."""
+
+    def __init__(self) -> None:
+        self.labels: Dict[_Path, str] = {}
+        self.pct: Dict[_Path, float] = {}
+        self.leaves: List[_Path] = []
+        self.mismatches: List[Tuple[str, float, float]] = []  # group, stated subtotal, sum of its parts
+
+    @classmethod
+    def parse(cls, raw: Any) -> "_Allocation":
+        """Both shapes: {"CAT": {"data": [...], "subtotal": x}, ...} and {"portfolio": [{"asset_class", ...}]}."""
+        alloc = cls()
+        rows = raw.get("portfolio") if isinstance(raw, dict) and "portfolio" in raw else raw
+        if isinstance(rows, list):
+            for node in rows:
+                alloc._add_class((), node)
+        elif isinstance(rows, dict):
+            for key, node in rows.items():
+                if isinstance(node, dict):
+                    alloc._add_group((_norm_label(key),), key, node)
+        if not alloc.leaves:
+            raise ValueError("no positions found")
+        return alloc
+
+    def _add_leaves(self, path: _Path, data: List[Dict[str, Any]]) -> None:
+        for row in data:
+            leaf = path + (_norm_label(row["name"]),)
+            self.labels[leaf] = row["name"]
+            if leaf not in self.pct:
+                self.leaves.append(leaf)
+            self.pct[leaf] = self.pct.get(leaf, 0.0) + float(row.get("percentage") or 0)
+
+    def _close(self, path: _Path, stated: Optional[float]) -> None:
+        parts = sum(pct for child, pct in self.pct.items() if len(child) == len(path) + 1 and child[:-1] == path)
+        total = parts if stated is None else float(stated)
+        if stated is not None and abs(parts - total) > 0.05:
+            self.mismatches.append((self.labels[path], total, parts))
+        self.pct[path] = total
+
+    def _add_group(self, path: _Path, label: str, node: Dict[str, Any]) -> None:
+        self.labels[path] = label.replace("_", " ")
+        if "data" in node:
+            self._add_leaves(path, node["data"])
+        else:
+            for key, child in node.items():
+                if isinstance(child, dict):
+                    self._add_group(path + (_norm_label(key),), key, child)
+        self._close(path, node.get("subtotal", node.get("subtotal_general")))
+
+    def _add_class(self, parent: _Path, node: Dict[str, Any]) -> None:
+        path = parent + (_norm_label(node["asset_class"]),)
+        if path[-1] in _TOTAL_LABELS:
+            return
+        self.labels[path] = node["asset_class"]
+        self._add_leaves(path, node.get("data") or [])
+        for child in node.get("subcategories") or []:
+            self._add_class(path, child)
+        self._close(path, node.get("percentage"))
+
+    def concentration(self) -> Tuple[float, float]:
+        """(Herfindahl index over positions, share of the 3 largest positions in %)."""
+        weights = [self.pct[leaf] for leaf in self.leaves if self.pct[leaf] > 0]
+        total = sum(weights)
+        if not total:
+            return 0.0, 0.0
+        hhi = sum((w / total) ** 2 for w in weights)
+        return hhi, sum(sorted(weights, reverse=True)[:3]) / total * 100
+
+
+@dataclass(frozen=True)
+class PortfolioAnalysis:
+    """
+    Investor vs average portfolio, computed once per profile (it travels inside ContextPayload):
+    per category / subclass / position deltas, concentration, club-deals exposure, and subtotals that
+    do not add up. render() is the compact table the model reads instead of both JSON documents.
+    """
+
+    rows: Tuple[Tuple[int, str, float, float], ...]  # depth, label, investor %, average %
+    hhi: Tuple[float, float]
+    top3: Tuple[float, float]
+    positions: Tuple[int, int]
+    club_deals: Tuple[float, float]
+    club_deals_private_share: Tuple[float, float]
+    overweights: Tuple[Tuple[str, float], ...]
+    underweights: Tuple[Tuple[str, float], ...]
+    notes: Tuple[str, ...]
+
+    @classmethod
+    def build(cls, investor: Any, average: Any, top: int = 3) -> "PortfolioAnalysis":
+        inv, avg = _Allocation.parse(investor), _Allocation.parse(average)
+
+        # Investor's order; a line only the average has goes after the last line under its parent (its
+        # siblings and everything below them), so it never lands between a group and that group's lines
+        order = list(inv.labels)
+        for path in avg.labels:
+            if path not in inv.labels:
+                parent = path[:-1]
+                under = [i for i, p in enumerate(order) if p[: len(parent)] == parent]
+                order.insert(under[-1] + 1 if under else len(order), path)
+
+        rows = []
+        deltas = []
+        for path in order:
+            mine, theirs = inv.pct.get(path, 0.0), avg.pct.get(path, 0.0)
+            if not mine and not theirs:
+                continue
+            label = inv.labels.get(path) or avg.labels[path]
+            rows.append((len(path) - 1, label, mine, theirs))
+            if path in inv.leaves or path in avg.leaves:
+                deltas.append((label, mine - theirs))
+        deltas.sort(key=lambda item: item[1])
+
+        def private_share(alloc: _Allocation) -> float:
+            private = sum(alloc.pct.get(path, 0.0) for path in _PRIVATE)
+            return alloc.pct.get(_CLUB_DEALS, 0.0) / private * 100 if private else 0.0
+
+        (inv_hhi, inv_top3), (avg_hhi, avg_top3) = inv.concentration(), avg.concentration()
+        notes = tuple(
+            f"{who}: {label} declara {stated:.2f} pero sus partes suman {parts:.2f}"
+            for who, alloc in (("inversionista", inv), ("promedio", avg))
+            for label, stated, parts in alloc.mismatches
+        )
+        return cls(
+            rows=tuple(rows),
+            hhi=(inv_hhi, avg_hhi),
+            top3=(inv_top3, avg_top3),
+            positions=(sum(1 for p in inv.leaves if inv.pct[p] > 0), sum(1 for p in avg.leaves if avg.pct[p] > 0)),
+            club_deals=(inv.pct.get(_CLUB_DEALS, 0.0), avg.pct.get(_CLUB_DEALS, 0.0)),
+            club_deals_private_share=(private_share(inv), private_share(avg)),
+            overweights=tuple(item for item in reversed(deltas[-top:]) if item[1] > 0),
+            underweights=tuple(item for item in deltas[:top] if item[1] < 0),
+            notes=notes,
+        )
+
+    def render(self) -> str:
+        def weights(items: Tuple[Tuple[str, float], ...]) -> str:
+            return "; ".join(f"{label} {delta:+.2f}" for label, delta in items) or "ninguna"
+
+        (inv_hhi, avg_hhi), (inv_club, avg_club) = self.hhi, self.club_deals
+        lines = ["clase | inversionista % | promedio % | Δ pp"]
+        lines += [
+            f"{'  ' * depth}{label} | {mine:.2f} | {theirs:.2f} | {mine - theirs:+.2f}"
+            for depth, label, mine, theirs in self.rows
+        ]
+        lines += [
+            f"Concentración (posiciones): HHI {inv_hhi:.3f} vs {avg_hhi:.3f}; "
+            f"N efectivo {1 / inv_hhi if inv_hhi else 0:.1f} vs {1 / avg_hhi if avg_hhi else 0:.1f}; "
+            f"top 3 = {self.top3[0]:.1f}% vs {self.top3[1]:.1f}%; "
+            f"posiciones > 0: {self.positions[0]} vs {self.positions[1]}",
+            f"Club deals: {inv_club:.2f}% vs {avg_club:.2f}% ({inv_club - avg_club:+.2f} pp); "
+            f"{self.club_deals_private_share[0]:.1f}% vs {self.club_deals_private_share[1]:.1f}% de lo privado "
+            "(propiedades directas + alternatives + club deals)",
+            f"Mayores sobreponderaciones: {weights(self.overweights)}",
+            f"Mayores infraponderaciones: {weights(self.underweights)}",
+        ]
+        lines += [f"Nota: {note}" for note in self.notes]
+        return "\n".join(lines)
+
+
+# -----------------------------
+# Seeded context
+# -----------------------------
+def _pretty(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False, indent=2)
+
+
+def compact_json(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def canonical_json(obj: Any) -> str:
+    # Byte-stable rendering (sorted keys): the same profile always yields the same prompt prefix
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+_TOKEN_PIECE = re.compile(r"\w+|[^\w\s]|\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    # Tokenizer-free estimate: words, punctuation and whitespace runs each count as one piece.
+    # Good enough to compare two renderings of the same data, not for billing.
+    return len(_TOKEN_PIECE.findall(text))
+
+
+@dataclass(frozen=True)
+class ContextPayload:
+    """
+    The seeded context, rendered once per custom_input.
+    - texts: the four CONTEXTO blocks, in the order the model sees them (canonical JSON, so byte-stable)
+    - content_hash: sha256 of the canonical custom_input (stable across processes)
+    - bytes_saved / tokens_saved: the portfolio blocks as sent (CONTEXT_PORTFOLIO_FORMAT) vs the old
+      indent=2 JSON of both, per seeded session
+    """
+
+    content_hash: str
+    texts: Tuple[str, ...]
+    bytes_saved: int
+    tokens_saved: int
+
+    @classmethod
+    def build(cls, custom_input: Dict[str, Any]) -> "ContextPayload":
+        canonical = canonical_json(custom_input)
+        keys = ("portafolio_promedio", "portafolio_inversionista")
+        portfolios = [f"CONTEXTO — {key} (JSON):\n" + canonical_json(custom_input[key]) for key in keys]
+        if CONTEXT_PORTFOLIO_FORMAT in ("summary", "both"):
+            try:
+                analysis = PortfolioAnalysis.build(custom_input[keys[1]], custom_input[keys[0]])
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                logger.warning("portfolio analysis failed (%s: %s); sending the JSON instead", type(e).__name__, e)
+            else:
+                summary = (
+                    "CONTEXTO — portafolio_inversionista vs portafolio_promedio (análisis precalculado de ambos "
+                    "JSON; % del portafolio total, Δ en puntos porcentuales):\n" + analysis.render()
+                )
+                portfolios = [summary] + (portfolios if CONTEXT_PORTFOLIO_FORMAT == "both" else [])
+        texts = (
+            *portfolios,
+            "CONTEXTO — mi_filosofia (texto):\n" + custom_input["mi_filosofia"],
+            "CONTEXTO — club_deals_information:\n" + custom_input["club_deals_information"],
+        )
+
+        # Only the portfolio blocks change between renderings
+        pretty = "".join(_pretty(custom_input[key]) for key in keys)
+        sent = "".join(portfolios)
+        saved_bytes = len(pretty.encode("utf-8")) - len(sent.encode("utf-8"))
+        saved_tokens = estimate_tokens(pretty) - estimate_tokens(sent)
+
+        return cls(
+            content_hash=hashlib.sha256(canonical.encode("utf-8")).hexdigest(),
+            texts=texts,
+            bytes_saved=saved_bytes,
+            tokens_saved=saved_tokens,
+        )
+
+    def items(self) -> List[TResponseInputItem]:
+        # Fresh containers every time: the SDK may mutate what it is given
+        return [
+            {
+                "role": "user",
+                "content": [{"type": "input_text", "text": text} for text in self.texts],
+            }
+        ]
+
+
+# -----------------------------
+# History window
+# -----------------------------
+@dataclass(frozen=True)
+class HistorySummary:
+    text: str
+    covered: int  # number of items after the seeded context folded into `text`
+
+
+NO_SUMMARY = HistorySummary(text="", covered=0)
+
+
+@dataclass
+class TurnContext:
+    """Per-run state handed to the SDK as `context` (read back in the model input filter)."""
+
+    session_id: str
+    summary: HistorySummary = NO_SUMMARY
+    verbatim_turns: int = 0
+    tokens_saved: int = 0
+    phase: str = "final"
+    phase_state: Optional["PhaseState"] = None
+    cache_key: Optional[str] = None
+
+
+def is_context_item(item: TResponseInputItem) -> bool:
+    content = item.get("content") if isinstance(item, dict) else None
+    return (
+        isinstance(content, list)
+        and bool(content)
+        and isinstance(content[0], dict)
+        and str(content[0].get("text", "")).startswith("CONTEXTO —")
+    )
+
+
+def split_context(items: List[TResponseInputItem]) -> Tuple[List[TResponseInputItem], List[TResponseInputItem]]:
+    # The seeded context is the first item of a session; one found further down (a session seeded after its
+    # first turn) is moved to the front, so instructions + context stay a stable, cacheable prefix
+    for i, item in enumerate(items):
+        if is_context_item(item):
+            return [item], items[:i] + items[i + 1 :]
+    return [], items
+
+
+def turn_starts(items: List[TResponseInputItem]) -> List[int]:
+    return [i for i, item in enumerate(items) if isinstance(item, dict) and item.get("role") == "user"]
+
+
+def item_text(item: TResponseInputItem) -> str:
+    content = item.get("content")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(str(part.get("text", "")) for part in content if isinstance(part, dict) and part.get("text"))
+    return ""
+
+
+async def stream_frames(result: RunResultStreaming) -> AsyncIterator[Dict[str, Any]]:
+    async for stream_event in result.stream_events():
+        if stream_event.type != "raw_response_event":
+            continue
+        data = stream_event.data
+        if data.type == "response.output_text.delta":
+            yield {"event": "delta", "data": {"text": data.delta}}
+        elif data.type == "response.reasoning_summary_text.delta":
+            yield {"event": "reasoning", "data": {"text": data.delta}}
+
+
+def render_transcript(items: List[TResponseInputItem]) -> str:
+    # Only dialogue goes to the summarizer; reasoning and other item types are dropped
+    speakers = {"user": "Inversionista", "assistant": "Asesor"}
+    lines = []
+    for item in items:
+        speaker = speakers.get(item.get("role")) if isinstance(item, dict) else None
+        text = item_text(item) if speaker else ""
+        if text:
+            lines.append(f"{speaker}: {text}")
+    return "\n\n".join(lines)
+
+
+# -----------------------------
+# Phase routing (model + reasoning effort per step of the FLOW)
+# -----------------------------
+QUESTIONS_PER_ROUND = 4
+
+# Effort only; a phase without "model" keeps the agent's model
+# Deadlines stay under gunicorn's --timeout (60 s by default in the Dockerfile)
+PHASE_DEFAULTS: Dict[str, Dict[str, Any]] = {
+    "question": {"effort": "medium", "deadline": 40},  # round 1, one question per reply
+    "refine": {"effort": "medium", "deadline": 40},  # later rounds after "afinar"
+    "gate": {"effort": "low", "deadline": 20},  # the fixed "¿afinar o generar?" question
+    "final": {"effort": "high", "deadline": 55},  # the WOW philosophy and anything after it
+}
+
+# USD per 1M tokens
+DEFAULT_PRICES: Dict[str, Dict[str, float]] = {
+    "gpt-5.1": {"input": 1.25, "cached_input": 0.125, "output": 10.0},
+    "gpt-5-mini": {"input": 0.25, "cached_input": 0.025, "output": 2.0},
+}
+
+_REFINE_WORDS = re.compile(r"\b(afin\w*|m[aá]s preguntas|contin[uú]\w*|sigamos|seguir|otra ronda|profundiz\w*)\b", re.I)
+_GENERATE_WORDS = re.compile(r"\b(gener\w*|listo|lista|ya|adelante|hazla|dale)\b", re.I)
+
+
+@dataclass
+class PhaseState:
+    """Where a session is in the FLOW, kept in SessionStateStore under "phase"."""
+
+    round: int = 1
+    asked: int = 0  # questions asked in the current round
+    stage: str = "questions"  # questions | gate | done
+
+    @classmethod
+    def loads(cls, raw: Optional[str]) -> "PhaseState":
+        return cls(**json.loads(raw)) if raw else cls()
+
+    def dumps(self) -> str:
+        return compact_json({"round": self.round, "asked": self.asked, "stage": self.stage})
+
+    def next_phase(self, message: str) -> str:
+        """Phase of the reply the model is about to write."""
+        if self.stage == "done":
+            return "final"
+        if self.stage == "gate":
+            # The model reads the answer itself; this only picks the effort for that reply
+            wants_more = _REFINE_WORDS.search(message) and not _GENERATE_WORDS.search(message)
+            return "refine" if wants_more else "final"
+        if self.asked >= QUESTIONS_PER_ROUND:
+            return "gate"
+        return "question" if self.round == 1 else "refine"
+
+    def advance(self, phase: str) -> None:
+        if phase == "gate":
+            self.stage = "gate"
+        elif phase == "final":
+            self.stage = "done"
+        elif self.stage == "gate":
+            self.round, self.asked, self.stage = self.round + 1, 1, "questions"
+        else:
+            self.asked += 1
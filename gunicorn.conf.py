@@ -0,0 +1,33 @@
+# Gunicorn loads this file automatically from the working directory (/app in the image).
+# CLI flags in the Dockerfile still win over anything set here.
+import gc
+import os
+import shutil
+
+# GUNICORN_PRELOAD=1 (same as --preload): import the app and the Agents SDK once in the master; workers
+# fork with everything loaded and share those pages copy-on-write instead of importing it again
+preload_app = os.environ.get("GUNICORN_PRELOAD", "0").strip().lower() in ("1", "true", "yes")
+
+
+def on_starting(server):
+    # Per-pid metric files from a previous run would otherwise be merged into /metrics
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+
+def pre_fork(server, worker):
+    if server.cfg.preload_app:
+        import main
+
+        main.warm_imports()  # no-op after the first worker
+        # Keep the GC from touching (and so copying) everything loaded so far in each worker
+        gc.freeze()
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
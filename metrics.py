@@ -0,0 +1,328 @@
+"""
+Prometheus metrics (multiprocess-aware), per-request phase timings, the DB pool instrumentation and the per-worker
+counters behind /stats.
+"""
+
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Dict, Iterator, Optional
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from config import (
+    DB_MAX_OVERFLOW,
+    DB_POOL_PRE_PING,
+    DB_POOL_RECYCLE,
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    PROMETHEUS_MULTIPROC_DIR,
+)
+
+# The Agents SDK is loaded lazily (see main.warm_imports); these names are only for annotations here
+if TYPE_CHECKING:
+    from agents.result import RunResult
+
+
+# -----------------------------
+# Prometheus metrics
+# -----------------------------
+_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+_TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 20000, 40000, 80000)
+
+REQUEST_SECONDS = Histogram(
+    "wow_request_seconds", "End-to-end time per chat request", ["endpoint"], buckets=_LATENCY_BUCKETS
+)
+PHASE_SECONDS = Histogram(
+    "wow_phase_seconds",
+    "Time per request phase (seed, history_load, model, write, pool_wait)",
+    ["phase"],
+    buckets=_LATENCY_BUCKETS,
+)
+TURN_TOKENS = Histogram("wow_turn_tokens", "Tokens per turn (input, cached, output, reasoning)", ["kind"], buckets=_TOKEN_BUCKETS)
+HISTORY_ITEMS = Histogram(
+    "wow_history_items", "Items loaded from the session per turn", buckets=(1, 2, 5, 10, 20, 40, 80, 160, 320)
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "wow_db_pool_checked_out", "Connections currently checked out", multiprocess_mode="livesum"
+)
+DB_POOL_CAPACITY = Gauge(
+    "wow_db_pool_capacity", "pool_size + max_overflow across live workers", multiprocess_mode="livesum"
+)
+FLOW_TURN_SECONDS = Histogram(
+    "wow_flow_turn_seconds", "Turn time per FLOW phase and model", ["flow_phase", "model"], buckets=_LATENCY_BUCKETS
+)
+FLOW_TURN_COST = Counter("wow_flow_turn_cost_usd", "Estimated model cost per FLOW phase and model", ["flow_phase", "model"])
+JOBS_RUNNING = Gauge("wow_jobs_running", "Chat jobs currently running", multiprocess_mode="livesum")
+JOB_SECONDS = Histogram(
+    "wow_job_seconds", "Chat job run time by outcome", ["status"], buckets=_LATENCY_BUCKETS + (300, 600)
+)
+UPSTREAM_SECONDS = Histogram(
+    "wow_upstream_seconds", "Model API time per attempt by outcome", ["model", "outcome"], buckets=_LATENCY_BUCKETS
+)
+UPSTREAM_RETRIES = Counter("wow_upstream_retries", "Model API retries by error kind", ["kind"])
+UPSTREAM_REJECTED = Counter(
+    "wow_upstream_rejected", "Model calls failed without a retry (breaker_open, budget_exhausted)", ["reason"]
+)
+UPSTREAM_BREAKER_OPEN = Gauge(
+    "wow_upstream_breaker_open", "Workers whose model API circuit breaker is open", multiprocess_mode="livesum"
+)
+CHAT_IN_FLIGHT = Gauge("wow_chat_in_flight", "Chat turns holding an admission slot", multiprocess_mode="livesum")
+CHAT_QUEUE_DEPTH = Gauge("wow_chat_queue_depth", "Chat turns waiting for an admission slot", multiprocess_mode="livesum")
+CHAT_QUEUE_SECONDS = Histogram(
+    "wow_chat_queue_seconds", "Wait for an admission slot (admitted turns)", buckets=_LATENCY_BUCKETS
+)
+CHAT_REJECTED = Counter(
+    "wow_chat_rejected", "Chat turns refused with 429 (queue_full, queue_timeout, session_rate, investor_rate)", ["reason"]
+)
+WRITE_QUEUE_ROWS = Gauge(
+    "wow_write_queue_rows", "Session rows queued for write-behind, not yet committed", multiprocess_mode="livesum"
+)
+WRITE_LAG_SECONDS = Histogram(
+    "wow_write_lag_seconds", "Time from queueing a session write to its commit", buckets=_LATENCY_BUCKETS
+)
+JOB_QUEUE_SECONDS = Histogram("wow_job_queue_seconds", "Time from enqueue to start", buckets=_LATENCY_BUCKETS)
+RESPONSE_CACHE_LOOKUPS = Counter(
+    "wow_response_cache_lookups", "Response cache lookups (memory_hit, db_hit, miss, bypass)", ["result"]
+)
+
+
+def metrics_registry() -> CollectorRegistry:
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+# -----------------------------
+# Request phase timings
+# -----------------------------
+class RequestTimings:
+    """Per-request phase totals (seconds), collected through a ContextVar."""
+
+    def __init__(self) -> None:
+        self.phases: Dict[str, float] = {}
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in self.phases.items())
+
+
+_request_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+
+def observe_phase(phase: str, seconds: float) -> None:
+    PHASE_SECONDS.labels(phase).observe(seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.add(phase, seconds)
+
+
+@contextmanager
+def timed_phase(phase: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_phase(phase, time.perf_counter() - started)
+
+
+@contextmanager
+def track_request(endpoint: str) -> Iterator[RequestTimings]:
+    timings = RequestTimings()
+    _request_timings.set(timings)
+    started = time.perf_counter()
+    try:
+        yield timings
+    finally:
+        elapsed = time.perf_counter() - started
+        timings.add("total", elapsed)
+        REQUEST_SECONDS.labels(endpoint).observe(elapsed)
+        _request_timings.set(None)
+
+
+def record_usage(result: RunResult) -> None:
+    usage = result.context_wrapper.usage
+    TURN_TOKENS.labels("input").observe(usage.input_tokens)
+    TURN_TOKENS.labels("cached").observe(getattr(usage.input_tokens_details, "cached_tokens", 0) or 0)
+    TURN_TOKENS.labels("output").observe(usage.output_tokens)
+    TURN_TOKENS.labels("reasoning").observe(getattr(usage.output_tokens_details, "reasoning_tokens", 0) or 0)
+
+
+# -----------------------------
+# Connection pool
+# -----------------------------
+class _TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that reports how long each checkout waited for a connection."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            observe_phase("pool_wait", time.perf_counter() - started)
+
+
+def engine_kwargs(url: str) -> Dict[str, Any]:
+    kwargs: Dict[str, Any] = {"pool_pre_ping": DB_POOL_PRE_PING}
+    if ":memory:" not in url:  # in-memory SQLite uses a single static connection
+        kwargs.update(
+            poolclass=_TimedQueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            # Reuse the most recently returned connection; the others sit idle until a checkout reopens them once
+            # they pass DB_POOL_RECYCLE (overflow connections are closed on checkin anyway)
+            pool_use_lifo=True,
+        )
+    return kwargs
+
+
+def watch_pool(engine: AsyncEngine) -> None:
+    pool = engine.sync_engine.pool
+    if not isinstance(pool, AsyncAdaptedQueuePool):
+        return
+    DB_POOL_CAPACITY.set(pool.size() + DB_MAX_OVERFLOW)
+
+    event.listen(pool, "checkout", lambda *_: DB_POOL_CHECKED_OUT.inc())
+    event.listen(pool, "checkin", lambda *_: DB_POOL_CHECKED_OUT.dec())
+
+
+def pool_stats(engine: AsyncEngine) -> Dict[str, Any]:
+    pool = engine.sync_engine.pool
+    if not isinstance(pool, AsyncAdaptedQueuePool):
+        return {"class": type(pool).__name__}
+    capacity = pool.size() + DB_MAX_OVERFLOW
+    return {
+        "class": type(pool).__name__,
+        "size": pool.size(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+        "saturation": round(pool.checkedout() / capacity, 3) if capacity else 0.0,
+    }
+
+
+# -----------------------------
+# Per-worker counters (/stats)
+# -----------------------------
+@dataclass
+class ContextStats:
+    seeded_sessions: int = 0
+    payload_builds: int = 0
+    bytes_saved: int = 0
+    tokens_saved: int = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "seeded_sessions": self.seeded_sessions,
+            "payload_builds": self.payload_builds,
+            "bytes_saved": self.bytes_saved,
+            "tokens_saved": self.tokens_saved,
+        }
+
+
+@dataclass
+class HistoryStats:
+    turns: int = 0
+    windowed_turns: int = 0
+    input_tokens_saved: int = 0
+    compactions: int = 0
+    compaction_failures: int = 0
+    server_state_turns: int = 0
+    server_state_fallbacks: int = 0
+    coalesced_requests: int = 0
+    idempotent_replays: int = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "turns": self.turns,
+            "windowed_turns": self.windowed_turns,
+            "input_tokens_saved": self.input_tokens_saved,
+            "compactions": self.compactions,
+            "compaction_failures": self.compaction_failures,
+            "server_state_turns": self.server_state_turns,
+            "server_state_fallbacks": self.server_state_fallbacks,
+            "coalesced_requests": self.coalesced_requests,
+            "idempotent_replays": self.idempotent_replays,
+        }
+
+
+@dataclass
+class LiveStats:
+    """WebSocket sessions: history served from the connection's memory vs loaded from the DB."""
+
+    open: int = 0
+    loads: int = 0
+    memory_reads: int = 0
+    reloads: int = 0  # another channel wrote to the session in between
+    writes: int = 0
+    write_failures: int = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "open": self.open,
+            "loads": self.loads,
+            "memory_reads": self.memory_reads,
+            "reloads": self.reloads,
+            "writes": self.writes,
+            "write_failures": self.write_failures,
+        }
+
+
+@dataclass
+class WriteStats:
+    """Write-behind session writes (SESSION_WRITES=behind and WebSocket sessions)."""
+
+    queued: int = 0  # rows
+    written: int = 0
+    batches: int = 0
+    max_batch: int = 0  # rows in the largest batch
+    retries: int = 0
+    failed: int = 0  # rows given up on
+    waits: int = 0  # reads and lock releases that had to wait for queued rows
+    rollbacks: int = 0  # turns whose state rows were put back because their rows were lost
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "queued": self.queued,
+            "written": self.written,
+            "batches": self.batches,
+            "max_batch": self.max_batch,
+            "retries": self.retries,
+            "failed": self.failed,
+            "waits": self.waits,
+            "rollbacks": self.rollbacks,
+        }
+
+
+@dataclass
+class PhaseStats:
+    turns: int = 0
+    seconds: float = 0.0
+    input_tokens: int = 0
+    cached_tokens: int = 0
+    output_tokens: int = 0
+    cost_usd: float = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "turns": self.turns,
+            "avg_seconds": round(self.seconds / self.turns, 3) if self.turns else 0.0,
+            "input_tokens": self.input_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cache_hit_ratio": round(self.cached_tokens / self.input_tokens, 3) if self.input_tokens else 0.0,
+            "output_tokens": self.output_tokens,
+            "cost_usd": round(self.cost_usd, 6),
+        }
@@ -0,0 +1,415 @@
+"""
+Replay recorded conversations against the current agent configuration and compare latency and token
+usage with a saved baseline, so a change to instructions, ModelSettings or the context format that makes
+turns heavier fails before it ships.
+
+1. Export stored sessions (read-only; decoded the way the app reads them, compact rows included):
+
+    SESSION_DB_URL=postgresql+asyncpg://... python replay.py export --out sessions.jsonl --limit 200
+
+2. Replay them in-process against a scratch SQLite DB, with the model replaced by a local backend:
+
+    python replay.py run --conversations sessions.jsonl --write-baseline    # on the old code: save baseline
+    python replay.py run --conversations sessions.jsonl                     # on the new code: compare
+
+Backends: "recorded" answers every turn with the reply stored for it (exports carry them), "fake" with
+deterministic bench-style text seeded by conversation and turn. Either way the replies do not depend on
+the prompt, so token differences come from what we send, not from what the model says. Tokens are
+estimated locally (instructions + input, and the reply), the same way for baseline and current run.
+
+Conversations JSONL: export lines ({"session_id", "turns", "replies"}), or bench.py's formats
+({"turns", "investor_id"} or ChatRequest-shaped lines). A line may carry "investor_id" and/or "profile"
+(ProfileUpsertRequest fields, stored first); otherwise the session is seeded from the default profile.
+
+Budgets are allowed increases over the baseline in percent (--budget input_tokens=5); the run exits 1
+when any is exceeded.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from agents import Model, ModelProvider
+
+from bench import WORDS, FakeModel, FakeModelConfig, ModelClock, percentile
+
+logger = logging.getLogger("sabbi.replay")
+
+# Allowed increase over the baseline, in percent (0 = must not grow)
+DEFAULT_BUDGETS: Dict[str, float] = {
+    "turns": 0,
+    "errors": 0,
+    "model_calls": 0,
+    "input_tokens": 5,
+    "output_tokens": 5,
+    "turn_p50_ms": 50,
+    "turn_p95_ms": 50,
+}
+
+# (seed, recorded reply or None) of the turn being replayed; the streamed run copies it into its task
+_TURN: ContextVar[Tuple[str, Optional[str]]] = ContextVar("replay_turn", default=("", None))
+
+
+@dataclass
+class Conversation:
+    key: str
+    turns: List[str]
+    replies: List[Optional[str]] = field(default_factory=list)
+    investor_id: Optional[str] = None
+    profile: Optional[Dict[str, Any]] = None
+
+
+def load_conversations(path: str) -> List[Conversation]:
+    conversations: List[Conversation] = []
+    grouped: Dict[str, Conversation] = {}
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if "turns" in row:
+                conversations.append(
+                    Conversation(
+                        key=str(row.get("session_id") or row.get("id") or f"line-{number}"),
+                        turns=list(row["turns"]),
+                        replies=list(row.get("replies") or []),
+                        investor_id=row.get("investor_id"),
+                        profile=row.get("profile"),
+                    )
+                )
+            elif "message" in row:
+                key = row.get("session_id") or f"line-{number}"
+                if key not in grouped:
+                    grouped[key] = Conversation(key=key, turns=[], investor_id=row.get("investor_id"))
+                    conversations.append(grouped[key])
+                grouped[key].turns.append(row["message"])
+    if not conversations:
+        raise SystemExit(f"No conversations found in {path}")
+    return conversations
+
+
+# -----------------------------
+# Export (reads SESSION_DB_URL, writes nothing there)
+# -----------------------------
+def _conversation_from_items(session_id: str, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    from context import item_text, split_context
+
+    _, items = split_context(items)
+    turns: List[str] = []
+    replies: List[Optional[str]] = []
+    for item in items:
+        role = item.get("role") if isinstance(item, dict) else None
+        if role == "user":
+            turns.append(item_text(item))
+            replies.append(None)
+        elif role == "assistant" and turns:
+            text = item_text(item)
+            replies[-1] = text if replies[-1] is None else f"{replies[-1]}\n{text}"
+    return {"session_id": session_id, "turns": turns, "replies": replies}
+
+
+async def export(args: argparse.Namespace) -> int:
+    os.environ["CREATE_SESSION_TABLES"] = "0"
+    import main
+    from sqlalchemy import select
+
+    from stores import utcnow
+
+    main.warm_imports()
+    service = main.service
+    await service.startup()
+    try:
+        sessions = service._make_session("export")._sessions
+        session_ids = list(args.session_id or [])
+        if not session_ids:
+            query = select(sessions.c.session_id).order_by(sessions.c.updated_at.desc()).limit(args.limit)
+            if args.since_days is not None:
+                query = query.where(sessions.c.updated_at >= utcnow() - timedelta(days=args.since_days))
+            async with service.engine.connect() as conn:
+                session_ids = [row[0] for row in await conn.execute(query)]
+
+        written = 0
+        with open(args.out, "w", encoding="utf-8") as out:
+            for session_id in session_ids:
+                row = _conversation_from_items(session_id, await service._make_session(session_id).get_items())
+                if len(row["turns"]) < args.min_turns:
+                    continue
+                out.write(json.dumps(row, ensure_ascii=False) + "\n")
+                written += 1
+        logger.info("exported %d of %d sessions to %s", written, len(session_ids), args.out)
+        return 0
+    finally:
+        await service.shutdown()
+
+
+# -----------------------------
+# Replay backend
+# -----------------------------
+@dataclass
+class TokenClock:
+    input_tokens: int = 0
+    output_tokens: int = 0
+    recorded: int = 0
+    unrecorded: int = 0
+
+
+class ReplayModel(FakeModel):
+    """bench.FakeModel answering with the replayed turn's reply (recorded, or seeded by turn), not from the input."""
+
+    def __init__(self, name: str, config: FakeModelConfig, clock: ModelClock, tokens: TokenClock) -> None:
+        super().__init__(name, config, clock)
+        self.tokens = tokens
+        self._instructions: Optional[str] = None
+
+    def _render(self, input: Any) -> tuple:
+        from context import compact_json, estimate_tokens
+
+        seed, text = _TURN.get()
+        if text is None:
+            self.tokens.unrecorded += 1
+            rng = random.Random(hashlib.sha256(seed.encode("utf-8")).digest())
+            text = " ".join(rng.choice(WORDS) for _ in range(self.config.output_tokens)) + "?"
+        else:
+            self.tokens.recorded += 1
+        raw = input if isinstance(input, str) else compact_json(input)
+        input_tokens = estimate_tokens(self._instructions or "") + estimate_tokens(raw)
+        self.tokens.input_tokens += input_tokens
+        self.tokens.output_tokens += estimate_tokens(text)
+        return text, input_tokens
+
+    async def get_response(self, system_instructions, input, *args, **kwargs):
+        self._instructions = system_instructions
+        return await super().get_response(system_instructions, input, *args, **kwargs)
+
+    async def stream_response(self, system_instructions, input, *args, **kwargs):
+        self._instructions = system_instructions
+        async for event in super().stream_response(system_instructions, input, *args, **kwargs):
+            yield event
+
+
+class ReplayModelProvider(ModelProvider):
+    def __init__(self, config: FakeModelConfig) -> None:
+        self.config = config
+        self.clock = ModelClock()
+        self.tokens = TokenClock()
+
+    def get_model(self, model_name: Optional[str]) -> Model:
+        return ReplayModel(model_name or "fake", self.config, self.clock, self.tokens)
+
+
+# -----------------------------
+# Replay run
+# -----------------------------
+@dataclass
+class Results:
+    latencies: List[float] = field(default_factory=list)
+    errors: Dict[str, int] = field(default_factory=dict)
+    wall_seconds: float = 0.0
+
+
+async def _replay_one(main, conversation: Conversation, args: argparse.Namespace, results: Results) -> None:
+    session_id = f"replay-{uuid.uuid4().hex}"
+    investor_id = conversation.investor_id
+    if conversation.profile is not None:
+        investor_id = investor_id or f"replay:{conversation.key}"
+        profile = main.ProfileUpsertRequest(investor_id=investor_id, **conversation.profile)
+        await main.service.upsert_profile(investor_id, profile.model_dump(exclude={"investor_id"}))
+
+    replies = conversation.replies if args.backend == "recorded" else []
+    for index, message in enumerate(conversation.turns):
+        token = _TURN.set((f"{conversation.key}:{index}", replies[index] if index < len(replies) else None))
+        started = time.perf_counter()
+        try:
+            if args.stream:
+                frames = main.service.chat_stream(session_id, message, investor_id=investor_id, bypass_cache=True)
+                async for frame in frames:
+                    if frame["event"] == "error":
+                        raise RuntimeError(frame["data"].get("detail"))
+            else:
+                await main.service.chat(session_id, message, investor_id=investor_id, bypass_cache=True)
+        except Exception as e:
+            logger.warning("conversation %s turn %d failed: %s: %s", conversation.key, index, type(e).__name__, e)
+            results.errors[type(e).__name__] = results.errors.get(type(e).__name__, 0) + 1
+            return
+        finally:
+            _TURN.reset(token)
+        results.latencies.append(time.perf_counter() - started)
+
+
+def report(conversations: List[Conversation], results: Results, provider: ReplayModelProvider) -> Dict[str, Any]:
+    turns = len(results.latencies)
+    return {
+        "conversations": len(conversations),
+        "turns": turns,
+        "errors": sum(results.errors.values()),
+        "model_calls": provider.clock.calls,
+        "input_tokens": provider.tokens.input_tokens,
+        "output_tokens": provider.tokens.output_tokens,
+        "input_tokens_per_turn": round(provider.tokens.input_tokens / turns, 1) if turns else 0.0,
+        "wall_seconds": round(results.wall_seconds, 3),
+        "turn_p50_ms": round(percentile(results.latencies, 50) * 1000, 1),
+        "turn_p95_ms": round(percentile(results.latencies, 95) * 1000, 1),
+        "error_kinds": results.errors,
+        "model_replies": {"recorded": provider.tokens.recorded, "generated": provider.tokens.unrecorded},
+    }
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    conversations = load_conversations(args.conversations)
+    if args.limit:
+        conversations = conversations[: args.limit]
+
+    # A scratch DB: replayed turns never touch the sessions they came from
+    os.environ["SESSION_DB_URL"] = args.db_url
+    import main
+
+    main.warm_imports()
+    provider = ReplayModelProvider(
+        FakeModelConfig(latency=args.latency, tokens_per_sec=args.tokens_per_sec, output_tokens=args.output_tokens)
+    )
+    main.service.model_provider = provider
+    await main.service.startup()
+    results = Results()
+    try:
+        queue: "asyncio.Queue[Conversation]" = asyncio.Queue()
+        for conversation in conversations:
+            queue.put_nowait(conversation)
+
+        async def worker() -> None:
+            while not queue.empty():
+                await _replay_one(main, queue.get_nowait(), args, results)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(max(1, args.concurrency))))
+        results.wall_seconds = time.perf_counter() - started
+    finally:
+        # Waits for background history compaction, whose model calls count too
+        await main.service.shutdown()
+    summary = report(conversations, results, provider)
+    summary["config"] = {"backend": args.backend, "stream": args.stream, "latency": args.latency, "db": args.db_url}
+    return summary
+
+
+# -----------------------------
+# Baseline comparison
+# -----------------------------
+def parse_budgets(items: List[str]) -> Dict[str, float]:
+    budgets = dict(DEFAULT_BUDGETS)
+    for item in items:
+        metric, _, pct = item.partition("=")
+        try:
+            budgets[metric.strip()] = float(pct.rstrip("%"))
+        except ValueError:
+            raise SystemExit(f"--budget expects METRIC=PERCENT, got {item!r}")
+    return budgets
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], budgets: Dict[str, float]) -> Dict[str, Dict[str, Any]]:
+    checks: Dict[str, Dict[str, Any]] = {}
+    for metric, budget in budgets.items():
+        if metric not in baseline or metric not in current:
+            continue
+        before, after = float(baseline[metric]), float(current[metric])
+        change = (after - before) / before * 100 if before else (0.0 if after == before else float("inf"))
+        checks[metric] = {
+            "baseline": baseline[metric],
+            "current": current[metric],
+            "change_pct": round(change, 1) if change != float("inf") else "inf",
+            "budget_pct": budget,
+            "ok": after <= before * (1 + budget / 100) if before else after <= before,
+        }
+    return checks
+
+
+def _export_subprocess(args: argparse.Namespace) -> str:
+    # Export runs in its own interpreter: main reads SESSION_DB_URL once, at import
+    out = os.path.join(tempfile.gettempdir(), f"replay-export-{uuid.uuid4().hex[:8]}.jsonl")
+    cmd = [sys.executable, os.path.abspath(__file__), "export", "--out", out, "--limit", str(args.limit or 200)]
+    subprocess.run(cmd, env={**os.environ, "SESSION_DB_URL": args.from_db}, check=True)
+    return out
+
+
+async def main_run(args: argparse.Namespace) -> int:
+    if args.from_db:
+        args.conversations = _export_subprocess(args)
+    current = await run(args)
+    output: Dict[str, Any] = {"current": current}
+
+    status = 0
+    if args.write_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+        logger.info("baseline written to %s", args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        checks = compare(baseline, current, parse_budgets(args.budget))
+        output["checks"] = checks
+        failed = [metric for metric, check in checks.items() if not check["ok"]]
+        output["status"] = "fail" if failed else "ok"
+        if failed:
+            logger.error("over budget: %s", ", ".join(failed))
+            status = 1
+    else:
+        logger.warning("no baseline at %s (use --write-baseline); nothing compared", args.baseline)
+
+    print(json.dumps(output, indent=2, ensure_ascii=False))
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2, ensure_ascii=False)
+    return status
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    exp = commands.add_parser("export", help="write stored sessions (SESSION_DB_URL) as conversations JSONL")
+    exp.add_argument("--out", required=True)
+    exp.add_argument("--limit", type=int, default=200, help="most recently updated sessions")
+    exp.add_argument("--since-days", type=float, help="only sessions updated in the last N days")
+    exp.add_argument("--session-id", action="append", help="export these sessions (repeatable) instead")
+    exp.add_argument("--min-turns", type=int, default=1)
+
+    rp = commands.add_parser("run", help="replay conversations and compare with the baseline")
+    source = rp.add_mutually_exclusive_group(required=True)
+    source.add_argument("--conversations", help="conversations JSONL (export, bench or ChatRequest lines)")
+    source.add_argument("--from-db", metavar="URL", help="export from this sessions DB first, then replay")
+    rp.add_argument("--limit", type=int, help="replay only the first N conversations")
+    rp.add_argument("--backend", choices=["recorded", "fake"], default="recorded")
+    rp.add_argument("--stream", action="store_true", help="replay through chat_stream instead of chat")
+    rp.add_argument("--concurrency", type=int, default=1, help="conversations in flight (1 keeps timings steady)")
+    rp.add_argument(
+        "--db-url",
+        default=f"sqlite+aiosqlite:///{tempfile.gettempdir()}/replay_sessions.db",
+        help="scratch sessions DB for the replay",
+    )
+    rp.add_argument("--latency", type=float, default=0.0, help="model latency (s); 0 times only our own overhead")
+    rp.add_argument("--tokens-per-sec", type=float, default=1e6)
+    rp.add_argument("--output-tokens", type=int, default=FakeModelConfig.output_tokens, help="fake reply length")
+    rp.add_argument("--baseline", default="replay_baseline.json")
+    rp.add_argument("--write-baseline", action="store_true", help="save this run as the baseline instead of comparing")
+    rp.add_argument("--budget", action="append", default=[], metavar="METRIC=PCT", help="override a budget")
+    rp.add_argument("--json-out", help="also write the result to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s", stream=sys.stderr)
+    args = parse_args()
+    if args.command == "export":
+        sys.exit(asyncio.run(export(args)))
+    sys.exit(asyncio.run(main_run(args)))
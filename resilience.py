@@ -0,0 +1,298 @@
+"""
+Failing fast instead of piling up: the retry budget and circuit breaker for the model API, and per-worker admission
+control (in-flight cap, wait queue, rate limits) for chat turns.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from config import (
+    CHAT_MAX_IN_FLIGHT,
+    CHAT_MAX_QUEUE,
+    CHAT_QUEUE_TIMEOUT,
+    INVESTOR_RATE_BURST,
+    INVESTOR_RATE_PER_MINUTE,
+    RATE_LIMIT_MAX_KEYS,
+    SESSION_RATE_BURST,
+    SESSION_RATE_PER_MINUTE,
+    UPSTREAM_BREAKER_FAILURES,
+    UPSTREAM_BREAKER_RESET_SECONDS,
+    UPSTREAM_RETRY_BUDGET,
+    UPSTREAM_RETRY_MIN,
+)
+from metrics import CHAT_IN_FLIGHT, CHAT_QUEUE_DEPTH, CHAT_QUEUE_SECONDS, CHAT_REJECTED, UPSTREAM_BREAKER_OPEN
+
+
+# -----------------------------
+# Upstream resilience (pure parts; the model wrapper is in agent_runtime)
+# -----------------------------
+class UpstreamUnavailable(RuntimeError):
+    """The model API kept failing (retries spent) or the circuit breaker is open: HTTP 503."""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UpstreamTimeout(UpstreamUnavailable):
+    """The phase deadline passed before the model answered: HTTP 504."""
+
+
+class RetryBudget:
+    """
+    Retries allowed as a share of recent calls (sliding window) plus a small floor, so that when the
+    API is struggling, retries cannot multiply the load on it.
+    """
+
+    def __init__(
+        self, ratio: float = UPSTREAM_RETRY_BUDGET, minimum: int = UPSTREAM_RETRY_MIN, window: float = 10.0
+    ) -> None:
+        self.ratio = ratio
+        self.minimum = minimum
+        self.window = window
+        self._calls: Deque[float] = deque()
+        self._retries: Deque[float] = deque()
+
+    def _trim(self, now: float) -> None:
+        for times in (self._calls, self._retries):
+            while times and times[0] < now - self.window:
+                times.popleft()
+
+    def deposit(self) -> None:
+        now = time.monotonic()
+        self._trim(now)
+        self._calls.append(now)
+
+    def withdraw(self) -> bool:
+        now = time.monotonic()
+        self._trim(now)
+        if len(self._retries) >= self.minimum + self.ratio * len(self._calls):
+            return False
+        self._retries.append(now)
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        self._trim(time.monotonic())
+        return {"calls": len(self._calls), "retries": len(self._retries)}
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `failures` consecutive transient errors; while open every call fails fast.
+    After `reset` seconds one trial call goes through (half_open): success closes, failure reopens.
+    Per worker: each process learns about an outage from its own calls.
+    """
+
+    def __init__(self, failures: int = UPSTREAM_BREAKER_FAILURES, reset: float = UPSTREAM_BREAKER_RESET_SECONDS) -> None:
+        self.failures = failures
+        self.reset = reset
+        self.state = "closed"
+        self.opens = 0
+        self._consecutive = 0
+        self._opened_at = 0.0
+
+    def allow(self) -> Optional[float]:
+        """None if a call may go ahead, else seconds until the next trial."""
+        if self.state == "closed":
+            return None
+        now = time.monotonic()
+        remaining = self._opened_at + self.reset - now
+        if remaining > 0:
+            return remaining
+        # This call is the trial; the clock restarts so a trial that never reports back frees the slot later
+        self.state, self._opened_at = "half_open", now
+        return None
+
+    def success(self) -> None:
+        self._consecutive = 0
+        if self.state != "closed":
+            self.state = "closed"
+            UPSTREAM_BREAKER_OPEN.dec()
+
+    def failure(self) -> None:
+        self._consecutive += 1
+        if self.state == "half_open" or (self.state == "closed" and self._consecutive >= self.failures):
+            if self.state == "closed":
+                UPSTREAM_BREAKER_OPEN.inc()
+                self.opens += 1
+            self.state, self._opened_at = "open", time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "opens": self.opens, "consecutive_failures": self._consecutive}
+
+
+# -----------------------------
+# Admission control
+# -----------------------------
+class Overloaded(RuntimeError):
+    """Admission control or a rate limit refused the turn: HTTP 429 with Retry-After."""
+
+    def __init__(self, message: str, reason: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """A held slot; release() is idempotent so every exit path may call it."""
+
+    def __init__(self, gate: Optional["AdmissionGate"]) -> None:
+        self._gate = gate
+        self._started = time.monotonic()
+
+    def release(self) -> None:
+        gate, self._gate = self._gate, None
+        if gate is not None:
+            gate._release(time.monotonic() - self._started)
+
+
+class AdmissionGate:
+    """
+    At most `limit` turns at once in this worker, FIFO wait queue of `queue` entries, each waiting at most
+    `timeout` seconds. A freed slot is handed to the oldest waiter, so the in-flight count never dips
+    while others wait. Past that, Overloaded: better a fast 429 than a turn that times out anyway.
+    """
+
+    def __init__(self, limit: int = CHAT_MAX_IN_FLIGHT, queue: int = CHAT_MAX_QUEUE, timeout: float = CHAT_QUEUE_TIMEOUT):
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self.admitted = self.rejected = 0
+        self._waiters: "Deque[asyncio.Future[None]]" = deque()
+        self._slot_seconds = 5.0  # moving average of how long a turn holds its slot, for Retry-After
+
+    def retry_after(self) -> float:
+        # Roughly when the turns ahead (running and queued) will have drained
+        return max(1.0, self._slot_seconds * (len(self._waiters) + 1) / max(1, self.limit))
+
+    def _reject(self, reason: str) -> Overloaded:
+        self.rejected += 1
+        CHAT_REJECTED.labels(reason).inc()
+        return Overloaded(f"Server busy ({reason}), retry later", reason, self.retry_after())
+
+    async def acquire(self) -> AdmissionTicket:
+        if self.limit <= 0:
+            return AdmissionTicket(None)
+        if self.in_flight < self.limit and not self._waiters:
+            return self._admit(0.0)
+        if len(self._waiters) >= self.queue:
+            raise self._reject("queue_full")
+
+        waiter: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        CHAT_QUEUE_DEPTH.inc()
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, self.timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the wait ended: keep it on a timeout, pass it on otherwise
+                if not isinstance(e, asyncio.TimeoutError):
+                    self.in_flight -= 1
+                    self._release(None)
+                    raise
+            else:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                if isinstance(e, asyncio.TimeoutError):
+                    raise self._reject("queue_timeout") from None
+                raise
+        finally:
+            CHAT_QUEUE_DEPTH.dec()
+        # The slot came from _release, which kept it counted in in_flight
+        self.in_flight -= 1
+        return self._admit(time.monotonic() - started)
+
+    def _admit(self, waited: float) -> AdmissionTicket:
+        self.in_flight += 1
+        self.admitted += 1
+        CHAT_IN_FLIGHT.inc()
+        CHAT_QUEUE_SECONDS.observe(waited)
+        return AdmissionTicket(self)
+
+    def _release(self, held: Optional[float]) -> None:
+        if held is not None:
+            self._slot_seconds += 0.1 * (held - self._slot_seconds)
+            self.in_flight -= 1
+            CHAT_IN_FLIGHT.dec()
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1  # reserved for the waiter; acquire() turns it into its own slot
+                waiter.set_result(None)
+                return
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "slot_seconds": round(self._slot_seconds, 3),
+        }
+
+
+class TokenBuckets:
+    """
+    One token bucket per key (`per_minute` refill, `burst` capacity), LRU-bounded to `max_keys`.
+    Per worker like the breaker: with N workers a client may get up to N times the rate, so size it per worker.
+    """
+
+    def __init__(self, per_minute: float, burst: int, max_keys: int = RATE_LIMIT_MAX_KEYS) -> None:
+        self.rate = per_minute / 60.0
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self.limited = 0
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    def take(self, key: Optional[str]) -> Optional[float]:
+        """None if `key` may go ahead (one token spent), else seconds until it has a token again."""
+        if self.rate <= 0 or not key:
+            return None
+        now = time.monotonic()
+        tokens, at = self._buckets.pop(key, (float(self.burst), now))
+        tokens = min(float(self.burst), tokens + (now - at) * self.rate)
+        wait = None if tokens >= 1 else (1 - tokens) / self.rate
+        self._buckets[key] = (tokens if wait else tokens - 1, now)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)  # an evicted key just starts over with a full bucket
+        if wait:
+            self.limited += 1
+        return wait
+
+    def stats(self) -> Dict[str, Any]:
+        return {"per_minute": self.rate * 60, "burst": self.burst, "keys": len(self._buckets), "limited": self.limited}
+
+
+class AdmissionControl:
+    """The rate limits first (cheap, no waiting), then a slot in the worker's gate."""
+
+    def __init__(self) -> None:
+        self.gate = AdmissionGate()
+        self.sessions = TokenBuckets(SESSION_RATE_PER_MINUTE, SESSION_RATE_BURST)
+        self.investors = TokenBuckets(INVESTOR_RATE_PER_MINUTE, INVESTOR_RATE_BURST)
+
+    def check_rate(self, session_id: str, investor_id: Optional[str]) -> None:
+        for reason, buckets, key in (
+            ("session_rate", self.sessions, session_id),
+            ("investor_rate", self.investors, investor_id),
+        ):
+            wait = buckets.take(key)
+            if wait is not None:
+                CHAT_REJECTED.labels(reason).inc()
+                raise Overloaded(f"Too many turns for this {reason.split('_')[0]}, retry later", reason, wait)
+
+    async def admit(self, session_id: str, investor_id: Optional[str]) -> AdmissionTicket:
+        self.check_rate(session_id, investor_id)
+        return await self.gate.acquire()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.gate.stats(),
+            "session_rate": self.sessions.stats(),
+            "investor_rate": self.investors.stats(),
+        }
@@ -0,0 +1,601 @@
+"""
+The service's own tables, next to the SDK's session tables: investor profiles, per-session state, shared context
+blobs, chat jobs and the response cache. Each store creates its table on startup (CREATE_SESSION_TABLES).
+"""
+
+from abc import ABC, abstractmethod
+
+import base64
+import hashlib
+import json
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Dict, Generic, List, Optional, Tuple, TypeVar
+
+from sqlalchemy import (
+    TIMESTAMP,
+    Column,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    delete,
+    insert,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy import text as sql_text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from config import (
+    CONTEXT_BLOB_CACHE_SIZE,
+    CONTEXT_BLOB_CACHE_TTL_SECONDS,
+    CONTEXT_BLOBS_TABLE,
+    CREATE_SESSION_TABLES,
+    DEFAULT_PROFILE_PATH,
+    JOBS_TABLE,
+    PROFILES_TABLE,
+    RESPONSE_CACHE,
+    RESPONSE_CACHE_MAX_ROWS,
+    RESPONSE_CACHE_PRUNE_EVERY,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TABLE,
+    RESPONSE_CACHE_TTL_SECONDS,
+    SESSION_STATE_TABLE,
+)
+from context import ContextPayload, canonical_json, compact_json
+from metrics import RESPONSE_CACHE_LOOKUPS
+
+
+# -----------------------------
+# Shared helpers
+# -----------------------------
+_K = TypeVar("_K")
+_V = TypeVar("_V")
+
+
+class TTLCache(Generic[_K, _V]):
+    """
+    Small in-process LRU with a per-entry TTL.
+    Not shared across gunicorn workers; each worker converges within `ttl` seconds.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[_K, Tuple[float, _V]]" = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key: _K) -> Optional[_V]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: _K, value: _V) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: _K) -> None:
+        self._data.pop(key, None)
+
+    def __contains__(self, key: _K) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+async def _upsert(
+    conn: AsyncConnection, table: Table, values: Dict[str, Any], keys: List[str], changes: Dict[str, Any]
+) -> None:
+    dialect = conn.dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        insert_ = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        stmt = insert_(table).values(**values)
+        await conn.execute(stmt.on_conflict_do_update(index_elements=keys, set_=changes))
+        return
+
+    result = await conn.execute(update(table).where(*[table.c[k] == values[k] for k in keys]).values(**changes))
+    if result.rowcount == 0:
+        await conn.execute(insert(table).values(**values))
+
+
+async def insert_ignore(conn: AsyncConnection, table: Table, values: Dict[str, Any], keys: List[str]) -> bool:
+    """Insert unless a row with the same key exists; True if this call inserted it."""
+    dialect = conn.dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        insert_ = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        stmt = insert_(table).values(**values).on_conflict_do_nothing(index_elements=keys)
+        return (await conn.execute(stmt)).rowcount == 1
+    try:
+        async with conn.begin_nested():
+            await conn.execute(insert(table).values(**values))
+        return True
+    except IntegrityError:
+        return False
+
+
+# -----------------------------
+# Investor profiles
+# -----------------------------
+class ProfileNotFound(LookupError):
+    pass
+
+
+@dataclass(frozen=True)
+class InvestorProfile:
+    investor_id: str
+    custom_input: Dict[str, Any]
+    payload: ContextPayload
+
+    @classmethod
+    def build(cls, investor_id: str, custom_input: Dict[str, Any]) -> "InvestorProfile":
+        return cls(investor_id=investor_id, custom_input=custom_input, payload=ContextPayload.build(custom_input))
+
+
+def load_default_profile() -> Dict[str, Any]:
+    with open(DEFAULT_PROFILE_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+class ProfileStore(ABC):
+    """
+    Where investor profiles (the custom_input each session is seeded with) live.
+    Subclass and pass to AgentService to plug another backend.
+    """
+
+    async def startup(self, engine: AsyncEngine) -> None:
+        pass
+
+    @abstractmethod
+    async def get(self, investor_id: str) -> Optional[Dict[str, Any]]:
+        """The stored custom_input, or None for an unknown investor."""
+
+    @abstractmethod
+    async def upsert(self, investor_id: str, custom_input: Dict[str, Any], content_hash: str) -> None:
+        """Create or replace the profile; content_hash is that of the payload built from it."""
+
+
+class SQLAlchemyProfileStore(ProfileStore):
+    """Profiles as one compact JSON row per investor, on the same engine as the sessions."""
+
+    def __init__(self, table_name: str = PROFILES_TABLE) -> None:
+        self._engine: Optional[AsyncEngine] = None
+        self._metadata = MetaData()
+        self._table = Table(
+            table_name,
+            self._metadata,
+            Column("investor_id", String, primary_key=True),
+            Column("profile", Text, nullable=False),
+            Column("content_hash", String(64), nullable=False),
+            Column(
+                "updated_at",
+                TIMESTAMP(timezone=False),
+                server_default=sql_text("CURRENT_TIMESTAMP"),
+                nullable=False,
+            ),
+        )
+
+    async def startup(self, engine: AsyncEngine) -> None:
+        self._engine = engine
+        if CREATE_SESSION_TABLES:
+            async with engine.begin() as conn:
+                await conn.run_sync(self._metadata.create_all)
+
+    async def get(self, investor_id: str) -> Optional[Dict[str, Any]]:
+        async with self._engine.connect() as conn:
+            row = (
+                await conn.execute(select(self._table.c.profile).where(self._table.c.investor_id == investor_id))
+            ).first()
+        return json.loads(row.profile) if row else None
+
+    async def upsert(self, investor_id: str, custom_input: Dict[str, Any], content_hash: str) -> None:
+        values = {"investor_id": investor_id, "profile": compact_json(custom_input), "content_hash": content_hash}
+        changes = {"profile": values["profile"], "content_hash": content_hash, "updated_at": sql_text("CURRENT_TIMESTAMP")}
+
+        async with self._engine.begin() as conn:
+            await _upsert(conn, self._table, values, ["investor_id"], changes)
+
+
+# -----------------------------
+# Per-session state
+# -----------------------------
+class SessionBusy(RuntimeError):
+    pass
+
+
+class SessionStateStore:
+    """Small per-session key/value rows kept next to the SDK tables (e.g. the running history summary)."""
+
+    def __init__(self, table_name: str = SESSION_STATE_TABLE) -> None:
+        self._engine: Optional[AsyncEngine] = None
+        self._metadata = MetaData()
+        self._table = Table(
+            table_name,
+            self._metadata,
+            Column("session_id", String, primary_key=True),
+            Column("key", String, primary_key=True),
+            Column("value", Text, nullable=False),
+            Column(
+                "updated_at",
+                TIMESTAMP(timezone=False),
+                server_default=sql_text("CURRENT_TIMESTAMP"),
+                nullable=False,
+            ),
+        )
+
+    async def startup(self, engine: AsyncEngine) -> None:
+        self._engine = engine
+        if CREATE_SESSION_TABLES:
+            async with engine.begin() as conn:
+                await conn.run_sync(self._metadata.create_all)
+
+    @property
+    def table(self) -> Table:
+        return self._table
+
+    async def get(self, session_id: str, key: str) -> Optional[str]:
+        async with self._engine.connect() as conn:
+            row = (
+                await conn.execute(
+                    select(self._table.c.value).where(self._table.c.session_id == session_id, self._table.c.key == key)
+                )
+            ).first()
+        return row.value if row else None
+
+    async def set(self, session_id: str, key: str, value: str) -> None:
+        values = {"session_id": session_id, "key": key, "value": value}
+        async with self._engine.begin() as conn:
+            await _upsert(
+                conn, self._table, values, ["session_id", "key"], {"value": value, "updated_at": sql_text("CURRENT_TIMESTAMP")}
+            )
+
+    async def delete(self, session_id: str, key: str) -> None:
+        async with self._engine.begin() as conn:
+            t = self._table
+            await conn.execute(delete(t).where(t.c.session_id == session_id, t.c.key == key))
+
+    async def prune(self, key_prefix: str, older_than: float) -> int:
+        """Delete rows whose key starts with `key_prefix` and that were last written `older_than` seconds ago."""
+        t = self._table
+        cutoff = utcnow() - timedelta(seconds=older_than)
+        async with self._engine.begin() as conn:
+            result = await conn.execute(delete(t).where(t.c.key.startswith(key_prefix), t.c.updated_at < cutoff))
+        return result.rowcount
+
+
+# -----------------------------
+# Compact message storage
+# -----------------------------
+_PACKED = "z:"  # zlib + base64, so it still fits the SDK's Text column
+CONTEXT_REF = "ctx:"  # sha256 of the context item's JSON, row in CONTEXT_BLOBS_TABLE
+
+
+def pack_text(text: str) -> str:
+    return _PACKED + base64.b64encode(zlib.compress(text.encode("utf-8"), 6)).decode("ascii")
+
+
+def unpack_text(raw: str) -> str:
+    # Rows written before compact storage (or below the size threshold) are plain JSON
+    if raw.startswith(_PACKED):
+        return zlib.decompress(base64.b64decode(raw[len(_PACKED) :])).decode("utf-8")
+    return raw
+
+
+class ContextBlobStore:
+    """
+    The seeded context item, stored once per distinct content instead of once per session.
+    Blobs are immutable (keyed by content hash), so each worker caches them without invalidation.
+    """
+
+    def __init__(self, table_name: str = CONTEXT_BLOBS_TABLE) -> None:
+        self._engine: Optional[AsyncEngine] = None
+        self._metadata = MetaData()
+        self._table = Table(
+            table_name,
+            self._metadata,
+            Column("blob_hash", String(64), primary_key=True),
+            Column("data", Text, nullable=False),
+            Column(
+                "created_at",
+                TIMESTAMP(timezone=False),
+                server_default=sql_text("CURRENT_TIMESTAMP"),
+                nullable=False,
+            ),
+        )
+        self._cache: TTLCache[str, str] = TTLCache(CONTEXT_BLOB_CACHE_SIZE, CONTEXT_BLOB_CACHE_TTL_SECONDS)
+
+    async def startup(self, engine: AsyncEngine) -> None:
+        self._engine = engine
+        if CREATE_SESSION_TABLES:
+            async with engine.begin() as conn:
+                await conn.run_sync(self._metadata.create_all)
+
+    async def put(self, text: str) -> str:
+        blob_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if self._cache.get(blob_hash) is None:
+            async with self._engine.begin() as conn:
+                await insert_ignore(conn, self._table, {"blob_hash": blob_hash, "data": pack_text(text)}, ["blob_hash"])
+            self._cache.put(blob_hash, text)
+        return blob_hash
+
+    async def get(self, blob_hash: str) -> Optional[str]:
+        text = self._cache.get(blob_hash)
+        if text is None:
+            async with self._engine.connect() as conn:
+                row = (
+                    await conn.execute(select(self._table.c.data).where(self._table.c.blob_hash == blob_hash))
+                ).first()
+            if row is None:
+                return None
+            text = unpack_text(row.data)
+            self._cache.put(blob_hash, text)
+        return text
+
+    def stats(self) -> Dict[str, int]:
+        return self._cache.stats()
+
+
+# -----------------------------
+# Background chat jobs
+# -----------------------------
+def utcnow() -> datetime:
+    # Job timestamps are written from Python so staleness checks don't depend on the DB timezone
+    return datetime.utcnow()
+
+
+@dataclass(frozen=True)
+class ChatJob:
+    job_id: str
+    session_id: str
+    investor_id: Optional[str]
+    message: str
+    status: str
+    output_text: Optional[str]
+    error: Optional[str]
+    attempts: int
+    created_at: datetime
+    updated_at: datetime
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+
+class ChatJobStore:
+    """Job rows (queued -> running -> succeeded | failed); a conditional UPDATE is the claim, so any worker can run any job."""
+
+    def __init__(self, table_name: str = JOBS_TABLE) -> None:
+        self._engine: Optional[AsyncEngine] = None
+        self._metadata = MetaData()
+        self._table = Table(
+            table_name,
+            self._metadata,
+            Column("job_id", String(32), primary_key=True),
+            Column("session_id", String, nullable=False),
+            Column("investor_id", String, nullable=True),
+            Column("message", Text, nullable=False),
+            Column("status", String(16), nullable=False),
+            Column("output_text", Text, nullable=True),
+            Column("error", Text, nullable=True),
+            Column("attempts", Integer, nullable=False, default=0),
+            Column("owner", String, nullable=True),
+            # a deferred job is not picked up before this (NULL: right away); existing tables need
+            # ALTER TABLE ... ADD COLUMN not_before TIMESTAMP
+            Column("not_before", TIMESTAMP(timezone=False), nullable=True),
+            Column("created_at", TIMESTAMP(timezone=False), nullable=False),
+            Column("updated_at", TIMESTAMP(timezone=False), nullable=False),
+            Index(f"ix_{table_name}_status_created", "status", "created_at"),
+        )
+
+    async def startup(self, engine: AsyncEngine) -> None:
+        self._engine = engine
+        if CREATE_SESSION_TABLES:
+            async with engine.begin() as conn:
+                await conn.run_sync(self._metadata.create_all)
+
+    @staticmethod
+    def _job(row: Any) -> ChatJob:
+        return ChatJob(**{field: getattr(row, field) for field in ChatJob.__dataclass_fields__})
+
+    async def create(self, job_id: str, session_id: str, message: str, investor_id: Optional[str]) -> Tuple[ChatJob, bool]:
+        """Insert a queued job; an existing row with the same id (idempotent retry) is returned as-is."""
+        now = utcnow()
+        values = {
+            "job_id": job_id,
+            "session_id": session_id,
+            "investor_id": investor_id,
+            "message": message,
+            "status": "queued",
+            "attempts": 0,
+            "created_at": now,
+            "updated_at": now,
+        }
+        created = True
+        try:
+            async with self._engine.begin() as conn:
+                await conn.execute(insert(self._table).values(**values))
+        except IntegrityError:
+            created = False
+        return await self.get(job_id), created
+
+    async def get(self, job_id: str) -> Optional[ChatJob]:
+        async with self._engine.connect() as conn:
+            row = (await conn.execute(select(self._table).where(self._table.c.job_id == job_id))).first()
+        return self._job(row) if row else None
+
+    async def next_queued(self) -> Optional[str]:
+        t = self._table
+        async with self._engine.connect() as conn:
+            row = (
+                await conn.execute(
+                    select(t.c.job_id)
+                    .where(t.c.status == "queued", or_(t.c.not_before.is_(None), t.c.not_before <= utcnow()))
+                    .order_by(t.c.created_at)
+                    .limit(1)
+                )
+            ).first()
+        return row.job_id if row else None
+
+    async def _transition(self, job_id: str, from_status: str, **values: Any) -> bool:
+        t = self._table
+        async with self._engine.begin() as conn:
+            result = await conn.execute(
+                update(t).where(t.c.job_id == job_id, t.c.status == from_status).values(updated_at=utcnow(), **values)
+            )
+        return result.rowcount == 1
+
+    async def claim(self, job_id: str, owner: str) -> bool:
+        return await self._transition(job_id, "queued", status="running", owner=owner, attempts=self._table.c.attempts + 1)
+
+    async def heartbeat(self, job_id: str) -> None:
+        await self._transition(job_id, "running")
+
+    async def succeed(self, job_id: str, output_text: str) -> None:
+        await self._transition(job_id, "running", status="succeeded", output_text=output_text, error=None)
+
+    async def fail(self, job_id: str, error: str) -> None:
+        await self._transition(job_id, "running", status="failed", error=error)
+
+    async def requeue(self, job_id: str) -> None:
+        await self._transition(job_id, "running", status="queued", owner=None)
+
+    async def defer(self, job_id: str, delay: float) -> None:
+        """Back to the queue for `delay` seconds without using up an attempt (the job never got to run)."""
+        await self._transition(
+            job_id,
+            "running",
+            status="queued",
+            owner=None,
+            attempts=self._table.c.attempts - 1,
+            not_before=utcnow() + timedelta(seconds=delay),
+        )
+
+    async def requeue_stale(self, older_than: float) -> int:
+        """Jobs left "running" by a worker that died (no heartbeat for `older_than` seconds) go back to the queue."""
+        t = self._table
+        cutoff = utcnow() - timedelta(seconds=older_than)
+        async with self._engine.begin() as conn:
+            result = await conn.execute(
+                update(t)
+                .where(t.c.status == "running", t.c.updated_at < cutoff)
+                .values(status="queued", owner=None, updated_at=utcnow())
+            )
+        return result.rowcount
+
+
+# -----------------------------
+# Response cache
+# -----------------------------
+class ResponseCache:
+    """
+    Replies of early turns keyed by agent config + seeded context + dialogue so far (see RESPONSE_CACHE).
+    A per-worker LRU answers first; with "db" a shared table backs it, trimmed by age and by row count.
+    Values are JSON: {"output_text": ..., "items": [...]} where items are what the turn appended.
+    """
+
+    def __init__(self, mode: str = RESPONSE_CACHE, table_name: str = RESPONSE_CACHE_TABLE) -> None:
+        self.mode = mode
+        self.enabled = mode in ("memory", "db")
+        self._engine: Optional[AsyncEngine] = None
+        self._memory: TTLCache[str, Dict[str, Any]] = TTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SECONDS)
+        self._writes = 0
+        self.db_hits = self.db_misses = self.pruned = 0
+        self._metadata = MetaData()
+        self._table = Table(
+            table_name,
+            self._metadata,
+            Column("key", String(64), primary_key=True),
+            Column("value", Text, nullable=False),
+            Column("created_at", TIMESTAMP(timezone=False), nullable=False, index=True),
+        )
+
+    async def startup(self, engine: AsyncEngine) -> None:
+        self._engine = engine
+        if self.mode == "db" and CREATE_SESSION_TABLES:
+            async with engine.begin() as conn:
+                await conn.run_sync(self._metadata.create_all)
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        return hashlib.sha256(canonical_json(parts).encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self._memory.get(key)
+        if value is not None:
+            RESPONSE_CACHE_LOOKUPS.labels("memory_hit").inc()
+            return value
+        if self.mode == "db":
+            t = self._table
+            cutoff = utcnow() - timedelta(seconds=RESPONSE_CACHE_TTL_SECONDS)
+            async with self._engine.connect() as conn:
+                row = (await conn.execute(select(t.c.value).where(t.c.key == key, t.c.created_at >= cutoff))).first()
+            if row is not None:
+                self.db_hits += 1
+                RESPONSE_CACHE_LOOKUPS.labels("db_hit").inc()
+                value = json.loads(row.value)
+                self._memory.put(key, value)
+                return value
+            self.db_misses += 1
+        RESPONSE_CACHE_LOOKUPS.labels("miss").inc()
+        return None
+
+    async def put(self, key: str, value: Dict[str, Any]) -> None:
+        self._memory.put(key, value)
+        if self.mode != "db":
+            return
+        raw, now = compact_json(value), utcnow()
+        async with self._engine.begin() as conn:
+            await _upsert(
+                conn, self._table, {"key": key, "value": raw, "created_at": now}, ["key"], {"value": raw, "created_at": now}
+            )
+        self._writes += 1
+        if RESPONSE_CACHE_PRUNE_EVERY > 0 and self._writes % RESPONSE_CACHE_PRUNE_EVERY == 0:
+            await self.prune()
+
+    async def prune(self) -> int:
+        """Delete expired rows, then the oldest ones beyond RESPONSE_CACHE_MAX_ROWS."""
+        t = self._table
+        cutoff = utcnow() - timedelta(seconds=RESPONSE_CACHE_TTL_SECONDS)
+        keep = max(RESPONSE_CACHE_MAX_ROWS, 1)
+        async with self._engine.begin() as conn:
+            deleted = (await conn.execute(delete(t).where(t.c.created_at < cutoff))).rowcount
+            oldest_kept = (
+                await conn.execute(select(t.c.created_at).order_by(t.c.created_at.desc()).offset(keep - 1).limit(1))
+            ).first()
+            if oldest_kept is not None:
+                deleted += (await conn.execute(delete(t).where(t.c.created_at < oldest_kept.created_at))).rowcount
+        self.pruned += deleted
+        return deleted
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "memory": self._memory.stats(),
+            "db_hits": self.db_hits,
+            "db_misses": self.db_misses,
+            "pruned": self.pruned,
+        }
@@ -0,0 +1,15 @@
+"""
+Settings for the whole suite. config reads the environment once, when the first test module imports it, so they
+are set here rather than per module: a scratch SQLite DB, write-behind session writes, no job workers.
+"""
+
+import os
+import sys
+import tempfile
+
+_DB_DIR = tempfile.mkdtemp(prefix="wow-tests-")
+os.environ["SESSION_DB_URL"] = f"sqlite+aiosqlite:///{_DB_DIR}/sessions.db"
+os.environ["SESSION_WRITES"] = "behind"
+os.environ["SESSION_WRITE_RETRIES"] = "0"
+os.environ["JOB_CONCURRENCY"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,124 @@
+"""
+The portfolio pre-analysis (label matching across the two portfolio shapes, the delta table) and the FLOW phase
+state. Pure functions, no DB.
+
+    python -m pytest -q tests
+"""
+
+import pytest
+
+from context import QUESTIONS_PER_ROUND, PhaseState, PortfolioAnalysis, _norm_label
+
+# Investor: {"CAT": {"data": [...], "subtotal": x}} shape
+INVESTOR = {
+    "PROPIEDADES_DIRECTAS": {"data": [{"name": "Prop Peru Oficinas", "percentage": 10}], "subtotal": 10},
+    "MERCADOS_PUBLICOS": {
+        "RENTA_FIJA": {"data": [{"name": "Bonos (ex Perú)", "percentage": 60}], "subtotal": 60},
+        "subtotal": 60,
+    },
+    "CLUB_DEALS": {"data": [{"name": "Deal A–B", "percentage": 30}], "subtotal": 30},
+}
+
+# Average: {"portfolio": [{"asset_class": ...}]} shape, other spellings of the same lines
+AVERAGE = {
+    "portfolio": [
+        {
+            "asset_class": "PROPIEDADES DIRECTAS",
+            "percentage": 15,
+            "data": [{"name": "Propiedades Peru Oficinas", "percentage": 15}],
+        },
+        {"asset_class": "Alternatives", "percentage": 5, "data": [{"name": "Fondo X", "percentage": 5}]},
+        {
+            "asset_class": "Mercados Públicos",
+            "percentage": 70,
+            "subcategories": [
+                {
+                    "asset_class": "Renta Fija",
+                    "percentage": 70,
+                    "data": [{"name": "Bonos (ex Peru)", "percentage": 70}],
+                }
+            ],
+        },
+        {"asset_class": "Club Deals", "percentage": 10, "data": [{"name": "Deal A-B", "percentage": 10}]},
+        {"asset_class": "Total", "percentage": 100},
+    ]
+}
+
+
+@pytest.mark.parametrize(
+    "a, b",
+    [
+        ("PROPIEDADES_DIRECTAS", "Propiedades Directas"),
+        ("Prop Peru Oficinas", "Propiedades Peru Oficinas"),
+        ("Bonos (ex Peru)", "Bonos (ex Perú)"),
+        ("AAA–BBB", "AAA-BBB"),
+        ("RENTA VARIABLE - Mercados Públicos", "Renta Variable"),
+        ("Otros Activos", "OTROS"),
+    ],
+)
+def test_labels_of_both_portfolios_normalize_alike(a, b):
+    assert _norm_label(a) == _norm_label(b)
+
+
+def test_delta_table_matches_lines_across_shapes():
+    analysis = PortfolioAnalysis.build(INVESTOR, AVERAGE)
+
+    assert analysis.rows == (
+        (0, "PROPIEDADES DIRECTAS", 10.0, 15.0),
+        (1, "Prop Peru Oficinas", 10.0, 15.0),
+        (0, "MERCADOS PUBLICOS", 60.0, 70.0),
+        (1, "RENTA FIJA", 60.0, 70.0),
+        (2, "Bonos (ex Perú)", 60.0, 70.0),
+        (0, "CLUB DEALS", 30.0, 10.0),
+        (1, "Deal A–B", 30.0, 10.0),
+        (0, "Alternatives", 0.0, 5.0),  # only in the average: after everything under its parent
+        (1, "Fondo X", 0.0, 5.0),
+    )
+    assert analysis.overweights == (("Deal A–B", 20.0),)
+    assert analysis.underweights == (("Bonos (ex Perú)", -10.0), ("Prop Peru Oficinas", -5.0), ("Fondo X", -5.0))
+    assert analysis.club_deals == (30.0, 10.0)
+    assert analysis.club_deals_private_share == pytest.approx((75.0, 100 / 3))
+    assert analysis.positions == (3, 4)
+    assert analysis.notes == ()
+
+    table = analysis.render().splitlines()
+    assert table[0] == "clase | inversionista % | promedio % | Δ pp"
+    assert "  Prop Peru Oficinas | 10.00 | 15.00 | -5.00" in table
+    assert "    Bonos (ex Perú) | 60.00 | 70.00 | -10.00" in table
+
+
+def test_subtotal_that_does_not_add_up_becomes_a_note():
+    investor = {"CLUB_DEALS": {"data": [{"name": "Deal", "percentage": 25}], "subtotal": 30}}
+    analysis = PortfolioAnalysis.build(investor, AVERAGE)
+    assert analysis.notes == ("inversionista: CLUB DEALS declara 30.00 pero sus partes suman 25.00",)
+
+
+def test_portfolio_without_positions_is_rejected():
+    with pytest.raises(ValueError):
+        PortfolioAnalysis.build({"portfolio": []}, AVERAGE)
+
+
+def _turn(state: PhaseState, message: str) -> str:
+    phase = state.next_phase(message)
+    state.advance(phase)
+    return phase
+
+
+def test_round_of_questions_then_gate_then_refine_round():
+    state = PhaseState()
+    assert [_turn(state, "respuesta") for _ in range(QUESTIONS_PER_ROUND + 1)] == ["question"] * 4 + ["gate"]
+    assert (state.round, state.asked, state.stage) == (1, QUESTIONS_PER_ROUND, "gate")
+
+    assert _turn(state, "Quiero afinar más") == "refine"
+    assert (state.round, state.asked, state.stage) == (2, 1, "questions")
+    assert [_turn(state, "respuesta") for _ in range(QUESTIONS_PER_ROUND)] == ["refine"] * 3 + ["gate"]
+    assert state.stage == "gate"
+
+
+@pytest.mark.parametrize("reply", ["Genera mi filosofía", "ya, afinemos", "no sé"])
+def test_gate_reply_other_than_refine_goes_to_final(reply):
+    state = PhaseState(round=1, asked=QUESTIONS_PER_ROUND, stage="gate")
+    assert _turn(state, reply) == "final"
+    assert state.stage == "done"
+    assert _turn(state, "afinemos") == "final"  # done stays done
+    assert PhaseState.loads(state.dumps()) == state
@@ -0,0 +1,112 @@
+"""
+Admission control (the wait queue behind the in-flight cap, 429s) and the circuit breaker's half-open trial.
+
+    python -m pytest -q tests
+"""
+
+import asyncio
+import time
+
+import pytest
+
+from resilience import AdmissionGate, CircuitBreaker, Overloaded
+
+
+def test_full_gate_queues_then_hands_the_slot_over_in_order():
+    async def scenario() -> None:
+        gate = AdmissionGate(limit=1, queue=2, timeout=5)
+        first = await gate.acquire()
+        second = asyncio.create_task(gate.acquire())
+        third = asyncio.create_task(gate.acquire())
+        await asyncio.sleep(0)
+        assert gate.stats()["queued"] == 2
+
+        with pytest.raises(Overloaded) as rejected:
+            await gate.acquire()
+        assert rejected.value.reason == "queue_full"
+        assert rejected.value.retry_after >= 1
+
+        first.release()
+        ticket = await second
+        assert not third.done()
+        assert gate.in_flight == 1  # the slot moved to the waiter; it never dipped to 0 in between
+        ticket.release()
+        (await third).release()
+        assert gate.in_flight == 0
+        assert (gate.admitted, gate.rejected) == (3, 1)
+
+    asyncio.run(scenario())
+
+
+def test_queued_turn_times_out_with_overloaded():
+    async def scenario() -> None:
+        gate = AdmissionGate(limit=1, queue=4, timeout=0.05)
+        held = await gate.acquire()
+        with pytest.raises(Overloaded) as rejected:
+            await gate.acquire()
+        assert rejected.value.reason == "queue_timeout"
+        assert gate.stats()["queued"] == 0
+        held.release()
+        held.release()  # idempotent
+        assert gate.in_flight == 0
+        (await gate.acquire()).release()
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario() -> None:
+        gate = AdmissionGate(limit=1, queue=4, timeout=5)
+        held = await gate.acquire()
+        waiter = asyncio.create_task(gate.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert gate.stats()["queued"] == 0
+        held.release()
+        assert gate.in_flight == 0
+
+    asyncio.run(scenario())
+
+
+def _open(breaker: CircuitBreaker) -> None:
+    for _ in range(breaker.failures):
+        breaker.failure()
+    assert breaker.state == "open"
+
+
+def test_breaker_opens_after_consecutive_failures_only():
+    breaker = CircuitBreaker(failures=3, reset=60)
+    breaker.failure()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.state == "closed"
+    assert breaker.allow() is None
+    _open(breaker)
+    wait = breaker.allow()
+    assert wait is not None and 0 < wait <= 60
+
+
+def test_half_open_trial_success_closes():
+    breaker = CircuitBreaker(failures=2, reset=0.05)
+    _open(breaker)
+    time.sleep(0.06)
+    assert breaker.allow() is None  # the trial call
+    assert breaker.state == "half_open"
+    assert breaker.allow() is not None  # one trial at a time
+    breaker.success()
+    assert breaker.state == "closed"
+    assert breaker.allow() is None
+
+
+def test_half_open_trial_failure_reopens():
+    breaker = CircuitBreaker(failures=2, reset=0.05)
+    _open(breaker)
+    time.sleep(0.06)
+    assert breaker.allow() is None
+    breaker.failure()
+    assert breaker.state == "open"
+    assert breaker.allow() is not None
+    assert breaker.opens == 1  # still the same outage
@@ -0,0 +1,37 @@
+"""
+Compact message storage: what pack_text writes, unpack_text reads back, including rows stored before packing.
+
+    python -m pytest -q tests
+"""
+
+import json
+
+import pytest
+
+from stores import pack_text, unpack_text
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "Hola",
+        json.dumps({"role": "user", "content": "¿Afinamos o genero tu filosofía? — ñ, €, 漢字"}, ensure_ascii=False),
+        "x" * 100_000,
+    ],
+)
+def test_pack_round_trip(text):
+    packed = pack_text(text)
+    assert packed.startswith("z:")
+    packed.encode("ascii")  # fits a Text column as plain ASCII
+    assert unpack_text(packed) == text
+
+
+def test_pack_shrinks_repetitive_json():
+    item = json.dumps([{"role": "assistant", "content": "texto " * 500}])
+    assert len(pack_text(item)) < len(item) / 10
+
+
+def test_unpacked_rows_read_as_is():
+    raw = '{"role":"user","content":"z: not packed"}'
+    assert unpack_text(raw) == raw
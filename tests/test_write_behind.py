@@ -0,0 +1,95 @@
+"""
+Write-behind session writes (SESSION_WRITES=behind) against a scratch SQLite DB and the bench fake model.
+
+    python -m pytest -q tests
+"""
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiosqlite")
+
+# The scratch DB and SESSION_WRITES=behind come from conftest.py (main reads its config at import time)
+import bench  # noqa: E402
+import main  # noqa: E402
+from context import PhaseState  # noqa: E402
+
+main.warm_imports()
+
+
+async def _started() -> bench.FakeModelProvider:
+    provider = bench.FakeModelProvider(bench.FakeModelConfig(latency=0, tokens_per_sec=1e6, output_tokens=5))
+    await main.service.startup()
+    main.service.model_provider = provider
+    return provider
+
+
+async def _turn_settled() -> None:
+    # /chat answers before the rows are in; the turn's task holds the session lock until they are
+    while main.service._background:
+        await asyncio.sleep(0.01)
+
+
+async def _user_messages(session_id: str) -> list:
+    items = await main.service._make_session(session_id).get_items()
+    return [item["content"] for item in items if isinstance(item, dict) and item.get("role") == "user"][1:]
+
+
+async def _phase(session_id: str) -> PhaseState:
+    return PhaseState.loads(await main.service.session_state.get(session_id, "phase"))
+
+
+def test_rows_are_written_in_order_after_the_reply():
+    async def scenario() -> None:
+        await _started()
+        try:
+            for message in ("Hola", "uno", "dos"):
+                await main.service.chat("ordered", message)
+            await _turn_settled()
+            assert await _user_messages("ordered") == ["Hola", "uno", "dos"]
+            assert (await _phase("ordered")).asked == 3
+            assert main.service.write_stats.failed == 0
+        finally:
+            await main.service.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_lost_turn_rolls_back_phase_and_idempotency_result():
+    async def scenario() -> None:
+        provider = await _started()
+        writer = main.service.writer
+        insert = writer._insert
+        try:
+            await main.service.chat("lost", "Hola", idempotency_key="t1")
+            await _turn_settled()
+            before = (await _phase("lost")).dumps()
+
+            async def failing(batch):
+                raise RuntimeError("db down")
+
+            writer._insert = failing
+            calls = provider.clock.calls
+            await main.service.chat("lost", "uno", idempotency_key="t2")  # answered, then its rows are lost
+            await _turn_settled()
+            writer._insert = insert
+
+            assert provider.clock.calls == calls + 1
+            assert await _user_messages("lost") == ["Hola"]
+            assert (await _phase("lost")).dumps() == before
+            assert await main.service.session_state.get("lost", "idempotency:t2") is None
+            assert main.service.write_stats.rollbacks == 1
+
+            # The client retries with the same key: the turn runs again instead of replaying unsaved output
+            await main.service.chat("lost", "uno", idempotency_key="t2")
+            await _turn_settled()
+            assert provider.clock.calls == calls + 2
+            assert await _user_messages("lost") == ["Hola", "uno"]
+            assert (await _phase("lost")).asked == 2
+            assert await main.service.session_state.get("lost", "idempotency:t2") is not None
+        finally:
+            writer._insert = insert
+            await main.service.shutdown()
+
+    asyncio.run(scenario())